@@ -10,6 +10,7 @@ from queue import Queue
 from datetime import datetime
 from typing import List, Tuple
 import uuid
+from modules.tracing import span, count, tracing_enabled, export_run
 
 
 # Configure logging
@@ -96,13 +97,14 @@ class FileTransfer:
         Comment:
             Gathers flight information by processing directories.
         '''
-        dirs = sorted(os.listdir(self.input_path))
-        for directory in dirs:
-            if 'FPLAN' in directory or 'MEDIA' in directory:
-                self.Phantomdata_system(directory)
-            else:
-                self._process_directory(directory)
-        self._count_flight_types()
+        with span("get_information"):
+            dirs = sorted(os.listdir(self.input_path))
+            for directory in dirs:
+                if 'FPLAN' in directory or 'MEDIA' in directory:
+                    self.Phantomdata_system(directory)
+                else:
+                    self._process_directory(directory)
+            self._count_flight_types()
         logging.info("Successfully gathered flight information.")
 
     def _process_directory(self, directory: str):
@@ -584,13 +586,17 @@ class FileTransfer:
         try:
             os.makedirs(os.path.dirname(destination_path), exist_ok=True)
             command = f'xcopy "{source_path}\\*" "{destination_path}\\" /E /I /Y'
-            result = subprocess.run(command, shell=True, capture_output=True, text=True)
+            with span("move_directory"):
+                result = subprocess.run(command, shell=True, capture_output=True, text=True)
             if result.returncode != 0:
                 logging.error(f"Error copying {source_path} to {destination_path}: {result.stderr}")
+                count("move_errors")
             else:
                 logging.info(f"Completed moving directory {source_path} to {destination_path}")
+                count("directories_moved")
         except Exception as e:
             logging.error(f"Exception moving {source_path} to {destination_path}: {e}")
+            count("move_errors")
 
     def move_files_to_output(self, streamlit_mode=False):
         '''
@@ -625,6 +631,11 @@ class FileTransfer:
         for t in threads:
             t.join()
 
+        # Run metrics next to the temporary flight log when tracing is enabled (see modules/tracing.py)
+        if tracing_enabled():
+            metrics_paths = export_run(os.path.dirname(self.temp_log_file), f"file_transfer_{datetime.now():%Y%m%d_%H%M%S}")
+            logging.info(f"Saved transfer metrics to {', '.join(metrics_paths)}")
+
         #pbar.close()
         if not streamlit_mode:
             self._save_flight_log()
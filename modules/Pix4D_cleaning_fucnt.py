@@ -1,4 +1,5 @@
 from file_system_functions import find_files_in_folder
+from tracing import traced, span, count
 
 import os
 import csv
@@ -8,6 +9,7 @@ import pandas as pd
 from datetime import datetime
 from tqdm import tqdm # Progress Bar
 import hashlib # Checksum of files before copying
+import concurrent.futures
 
 def append_list_to_csv(data_list, comment, file_name='event.csv'):
     """
@@ -63,6 +65,7 @@ def append_dict_to_csv(data_dict, comment, file_name='event.csv'):
 
 
 # Funcion to check if two files are identicals or not
+@traced
 def calculate_md5(file_path, buffer_size=1024*1024):
     """
     Calculate the MD5 checksum of a file.
@@ -78,6 +81,7 @@ def calculate_md5(file_path, buffer_size=1024*1024):
     return md5.hexdigest()
 
 # File copy function with progress bar
+@traced
 def copy_file_with_progress(src_file, dst, chk_size=True, buffer_size=1024*1024):
     """
     Copy a file from src_file to dst with a progress bar, content check, and metadata preservation.
@@ -111,11 +115,13 @@ def copy_file_with_progress(src_file, dst, chk_size=True, buffer_size=1024*1024)
             # If files are identical, skip the copy
             if src_file_md5 == dst_file_md5:
                 print("Files are identical. Skipping copy.")
+                count("files_skipped")
                 return
             else:
                 print("Files differ. Proceeding with copy.")
         else:
             print(f"Skipping copy.")
+            count("files_skipped")
             return
     
     # If we reach here, it means the files are different or the destination doesn't exist
@@ -125,7 +131,7 @@ def copy_file_with_progress(src_file, dst, chk_size=True, buffer_size=1024*1024)
     total_size = os.path.getsize(src_file)
     
     # Open source and destination files
-    with open(src_file, 'rb') as fsrc_file, open(dst_file, 'wb') as fdst:
+    with span("copy_file_data"), open(src_file, 'rb') as fsrc_file, open(dst_file, 'wb') as fdst:
         # Create a progress bar
         with tqdm(total=total_size, unit='B', unit_scale=True, desc="Copying", leave=False) as pbar:
             # Copy file in chunks and update the progress bar
@@ -148,10 +154,13 @@ def copy_file_with_progress(src_file, dst, chk_size=True, buffer_size=1024*1024)
     src_file_md5 = calculate_md5(src_file, buffer_size)
     dst_file_md5 = calculate_md5(dst_file, buffer_size)
     
+    count("files_copied")
+    count("bytes_copied", total_size)
     if src_file_md5 == dst_file_md5:
         print(f"Verification successful: The files are identical.")
     else:
         print(f"Verification failed: The files are different.")
+        count("verification_failed")
 
 # Example usage:
 # copy_file_with_progress("path/to/source/file", "path/to/destination")
@@ -184,7 +193,8 @@ def copy_everything(src_dir, dest_dir, chk_size=True):
             # Recursively call the function for each subdirectory
             # Using copy tree function since this preserves the metadata for the sub folders as well
             # And copytree is faster than copy_file_with_progress since it does not perform filesize check
-            shutil.copytree(item_path_src, item_path_dest, dirs_exist_ok=True)
+            with span("copy_tree"):
+                shutil.copytree(item_path_src, item_path_dest, dirs_exist_ok=True)
 
 
 def create_proj_dict(src_drive, path_pix4d_gnrl, field_id, flight_type):
@@ -242,6 +252,7 @@ def create_proj_dict(src_drive, path_pix4d_gnrl, field_id, flight_type):
     return proj_dict, pix4d_path_src
 
 
+@traced
 def copy_p4d_log(dest_path, pix4d_path_src):
     """
     Copies Pix4D project files (.p4d) and log files from a source directory to a destination directory,
@@ -321,6 +332,7 @@ def copy_p4d_log(dest_path, pix4d_path_src):
 
 # Copying Reports for all projects
 # This step overwrites all the files already in the destination dir with the same name
+@traced
 def copy_reports(dest_path, proj_dict):
     """
     Copies report directories and PDF reports from source projects to the destination directory.
@@ -500,7 +512,9 @@ def process_directories(src_proj_path, dest_proj_path, subdirs):
 
 
 # Copying Orthomosaics
-def copy_ortho(dest_path, proj_dict, combination, state_file, type_of_data_to_copy=["ortho_primary", "ortho_extra", "dsm_dtm", "mesh_extras"], chk_size=True):
+@traced
+def copy_ortho(dest_path, proj_dict, combination, state_file, type_of_data_to_copy=["ortho_primary", "ortho_extra", "dsm_dtm", "mesh_extras"], chk_size=True,
+               convert_cog=False, cog_manifest_file="cog_manifest.json", cog_workers=None):
     """
     Copies orthomosaic (tiff) files from the source project directories to destination directories, 
     including progress tracking. Creates missing destination directories and logs missing files.
@@ -514,6 +528,12 @@ def copy_ortho(dest_path, proj_dict, combination, state_file, type_of_data_to_co
         - "ortho_extra": Extra orthomosaic files.
         - "dsm_dtm": DSM and DTM files.
         - "mesh_extras": Additional point cloud files.
+    - convert_cog (bool): If True, rewrite the copied index, mosaic and DSM/DTM tiffs as tiled, compressed
+                          GeoTIFFs with internal overviews after each project is copied (see convert_tifs_to_cog()).
+                          Files already converted from the same source (path, size and modification time)
+                          according to the manifest are not copied again.
+    - cog_manifest_file (str): JSON manifest recording the converted files.
+    - cog_workers (int, optional): Number of parallel conversion processes (default: number of CPUs).
         
     Returns:
     - tuple: A tuple containing three dictionaries:
@@ -526,6 +546,9 @@ def copy_ortho(dest_path, proj_dict, combination, state_file, type_of_data_to_co
     mesh_found_dict = {}      # To store found and copied mesh files per project
     mesh_extra_found_dict = {}      # To store found and copied mesh extras per project
     
+    # Load the record of files already converted to tiled GeoTIFF
+    cog_manifest = load_cog_manifest(cog_manifest_file) if convert_cog else {}
+
     # Print information about progress bar initialization
     print("Calculating number of files to be copied for the progress bar")
 
@@ -566,6 +589,7 @@ def copy_ortho(dest_path, proj_dict, combination, state_file, type_of_data_to_co
             ortho_found = []
             mesh_found = []
             mesh_extra_found = []
+            copied_tifs = {}  # Destination tiffs to convert to tiled GeoTIFF when convert_cog is set, with their source
             
             # Retrieve source and destination paths for orthomosaics and point clouds
             src_proj_path = proj_dict[proj_name][0]
@@ -646,15 +670,23 @@ def copy_ortho(dest_path, proj_dict, combination, state_file, type_of_data_to_co
                                 # Apply the condition for ortho_extra files so they are coped in the Extras folder
                                 if "2_mosaic" in file_path and not '_mosaic_group1' in file_name:
                                     if "ortho_extra" in type_of_data_to_copy:
-                                        copy_file_with_progress(file_path, dest_ortho_extra, chk_size=chk_size)
-                                        total_pbar.update(1)  # Update progress bar
+                                        target_folder = dest_ortho_extra
                                     else:
                                         continue
+                                else:
+                                    target_folder = dest_folder
+
+                                target_file = os.path.join(target_folder, file_name)
+                                if convert_cog and file_name.endswith(".tif") and is_cog_current(cog_manifest, target_file, source_path=file_path):
+                                    # The destination is a converted copy, so its checksum no longer matches the source
+                                    print(f"{file_name} already converted to tiled GeoTIFF. Skipping copy.")
                                 else:
                                     # Copy the file with progress tracking
-                                    copy_file_with_progress(file_path, dest_folder, chk_size=chk_size)
+                                    copy_file_with_progress(file_path, target_folder, chk_size=chk_size)
+                                    if convert_cog and file_name.endswith(".tif"):
+                                        copied_tifs[target_file] = file_path
 
-                                    total_pbar.update(1)
+                                total_pbar.update(1)  # Update progress bar
                             else:
                                 print(f"""Warning-2: Project name mismatch! 
                                 Source path {file_path} or destination path {dest_folder} 
@@ -680,6 +712,10 @@ def copy_ortho(dest_path, proj_dict, combination, state_file, type_of_data_to_co
                             does not contain the project name {proj_name}.""")
                             project_complete = False
 
+            # Rewrite the copied tiffs as tiled, compressed GeoTIFFs with internal overviews
+            if convert_cog and copied_tifs:
+                cog_manifest = convert_tifs_to_cog(list(copied_tifs), cog_manifest_file, max_workers=cog_workers, source_paths=copied_tifs)
+
             # Log missing and found orthomosaics and meshes to respective CSV files
             ortho_found_dict[proj_name] = ortho_found
             mesh_found_dict[proj_name] = mesh_found
@@ -727,6 +763,161 @@ def copy_ortho(dest_path, proj_dict, combination, state_file, type_of_data_to_co
 import os
 import json
 
+# Cloud-optimized GeoTIFF conversion
+# Pix4D writes striped tiffs without overviews, so any windowed or downscaled read has to decode whole strips
+# of the full-resolution image. Rewriting them as tiled, compressed GeoTIFFs with internal overviews lets the
+# extraction and preview code read only the blocks (or overview level) it needs.
+
+def convert_to_cog(file_path, blocksize=512, compress="DEFLATE", resampling="AVERAGE", source_path=None):
+    """
+    Rewrites a GeoTIFF in place as a tiled, compressed GeoTIFF with internal overviews.
+
+    Uses GDAL's COG driver (GDAL >= 3.1), or tiled GTiff + build_overviews() on older versions.
+    The file is written next to the original and swapped in with os.replace(), so an interrupted
+    conversion never leaves a half-written file behind.
+
+    Parameters:
+    - file_path (str): Path to the GeoTIFF to convert.
+    - blocksize (int): Tile size in pixels (default is 512).
+    - compress (str): Compression (default is lossless "DEFLATE").
+    - resampling (str): Overview resampling method (default is "AVERAGE").
+    - source_path (str, optional): File the GeoTIFF was copied from, recorded in the manifest entry.
+
+    Returns:
+    - dict: Manifest entry describing the converted file and the source it was copied from.
+    """
+    # rasterio is only needed for this optional stage, so the copy scripts keep working without it
+    import rasterio
+    import rasterio.shutil
+    from rasterio.enums import Resampling
+    from rasterio.env import GDALVersion
+
+    tmp_path = file_path + ".cog_tmp.tif"
+    # The copy keeps the size and timestamps of its source (see copy_file_with_progress())
+    source_size = os.path.getsize(file_path)
+    source_mtime = os.path.getmtime(file_path)
+
+    with rasterio.open(file_path) as src:
+        predictor = 3 if src.dtypes[0].startswith("float") else 2
+
+    if GDALVersion.runtime().at_least("3.1"):
+        rasterio.shutil.copy(
+            file_path, tmp_path, driver="COG", BLOCKSIZE=blocksize, COMPRESS=compress,
+            PREDICTOR="YES", OVERVIEWS="AUTO", RESAMPLING=resampling, BIGTIFF="IF_SAFER"
+        )
+    else:
+        tiled_path = file_path + ".tiled_tmp.tif"
+        rasterio.shutil.copy(
+            file_path, tiled_path, driver="GTiff", TILED="YES", BLOCKXSIZE=blocksize, BLOCKYSIZE=blocksize,
+            COMPRESS=compress, PREDICTOR=predictor, BIGTIFF="IF_SAFER"
+        )
+        with rasterio.open(tiled_path, "r+") as dst:
+            factors = [2 ** i for i in range(1, 12) if max(dst.width, dst.height) / 2 ** i >= blocksize / 2]
+            dst.build_overviews(factors, Resampling[resampling.lower()])
+        rasterio.shutil.copy(
+            tiled_path, tmp_path, driver="GTiff", TILED="YES", BLOCKXSIZE=blocksize, BLOCKYSIZE=blocksize,
+            COMPRESS=compress, PREDICTOR=predictor, COPY_SRC_OVERVIEWS="YES", BIGTIFF="IF_SAFER"
+        )
+        os.remove(tiled_path)
+
+    # Keep the original timestamps, as copy_file_with_progress() does
+    shutil.copystat(file_path, tmp_path)
+    os.replace(tmp_path, file_path)
+
+    with rasterio.open(file_path) as dst:
+        overviews = dst.overviews(1)
+
+    return {
+        "source_path": source_path,
+        "source_size": source_size,
+        "source_mtime": source_mtime,
+        "size": os.path.getsize(file_path),
+        "mtime": os.path.getmtime(file_path),
+        "blocksize": blocksize,
+        "compress": compress,
+        "overviews": overviews,
+        "converted": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+    }
+
+
+def load_cog_manifest(manifest_file="cog_manifest.json"):
+    """
+    Loads the manifest of converted GeoTIFFs.
+
+    Parameters:
+    - manifest_file (str): Path to the JSON manifest.
+
+    Returns:
+    - dict: {file_path: manifest entry}, empty if the manifest does not exist.
+    """
+    if not os.path.exists(manifest_file):
+        return {}
+    with open(manifest_file, 'r') as f:
+        return json.load(f)
+
+
+def is_cog_current(manifest, file_path, source_path=None):
+    """
+    Checks whether a file was converted by convert_to_cog() and has not changed since.
+
+    Parameters:
+    - manifest (dict): Manifest loaded with load_cog_manifest().
+    - file_path (str): Path to the GeoTIFF.
+    - source_path (str, optional): File the GeoTIFF is copied from; it must also match the manifest entry.
+
+    Returns:
+    - bool: True if the file on disk (and its source) match its manifest entry.
+    """
+    entry = manifest.get(file_path)
+    if not entry or not os.path.exists(file_path):
+        return False
+    if os.path.getsize(file_path) != entry["size"] or os.path.getmtime(file_path) != entry["mtime"]:
+        return False
+    if source_path is None:
+        return True
+    return (
+        entry.get("source_path") == source_path and os.path.exists(source_path)
+        and os.path.getsize(source_path) == entry.get("source_size") and os.path.getmtime(source_path) == entry.get("source_mtime")
+    )
+
+
+def convert_tifs_to_cog(tif_files, manifest_file="cog_manifest.json", max_workers=None, source_paths=None, **cog_options):
+    """
+    Converts GeoTIFFs to tiled, compressed GeoTIFFs with internal overviews in parallel,
+    skipping files that are already converted, and records the results in a JSON manifest.
+
+    Parameters:
+    - tif_files (list): Paths of the GeoTIFFs to convert (in place).
+    - manifest_file (str): Path to the JSON manifest (default is 'cog_manifest.json').
+    - max_workers (int, optional): Number of parallel processes (default: number of CPUs).
+    - source_paths (dict, optional): {GeoTIFF path: file it was copied from}, recorded in the manifest.
+    - **cog_options: Passed on to convert_to_cog() (blocksize, compress, resampling).
+
+    Returns:
+    - dict: The updated manifest.
+    """
+    manifest = load_cog_manifest(manifest_file)
+    source_paths = source_paths or {}
+    to_convert = [f for f in tif_files if f and not is_cog_current(manifest, f, source_paths.get(f))]
+    print(f"Converting {len(to_convert)} of {len(tif_files)} tiffs to tiled GeoTIFF with overviews")
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(convert_to_cog, f, source_path=source_paths.get(f), **cog_options): f for f in to_convert}
+        for future in tqdm(concurrent.futures.as_completed(futures), total=len(futures), desc="COG conversion", unit="file", leave=False):
+            file_path = futures[future]
+            try:
+                manifest[file_path] = future.result()
+            except Exception as e:
+                print(f"Conversion failed for {file_path}: {e}")
+
+    # Save the manifest once, from the parent process only
+    with open(manifest_file, 'w') as f:
+        json.dump(manifest, f, indent=4)
+    print(f"COG manifest saved to {manifest_file}")
+
+    return manifest
+
+
 def save_proj_data(proj_dict, proj_list, state_file="proj_dict_state_temp.json"):
     """
     Save a dictionary and a list to a specified file in JSON format.
@@ -1,7 +1,9 @@
 from Pix4D_cleaning_fucnt import *
+from tracing import tracing_enabled, tracing_summary, export_run
 import os
 import pandas as pd
 import itertools
+from datetime import datetime
 
 
 # Import all CSV Logs
@@ -97,4 +99,9 @@ for key in field_data_combinations_keys:
         Field ID: {field_id}
         Flight Type: {flight_type}
         Destination Path: {dest_path}
-        """)
\ No newline at end of file
+        """)
+# Save the copy metrics of this run when tracing is enabled (UAV_TRACING=1, see tracing.py)
+if tracing_enabled():
+    print("\n".join(tracing_summary()))
+    metrics_paths = export_run(os.path.join(dest_drive, path_pix4d_gnrl), f"pix4d_copy_{datetime.now():%Y%m%d_%H%M%S}")
+    print(f"Run metrics saved to {', '.join(metrics_paths)}")
@@ -0,0 +1,197 @@
+import os
+import numpy as np
+import rasterio
+from xml.sax.saxutils import escape
+from rasterio.enums import Resampling, MaskFlags
+from rasterio.windows import Window, from_bounds, bounds
+from block_cache import read_cached, read_masks_cached
+
+# Virtual multi-band stack of the Pix4D single-band index files.
+# Pix4D writes every band to its own "_index_<band>_<band>.tif". When the bands share one grid they are
+# stacked in a VRT, so all bands of a window are read with a single call; bands on another grid are
+# resampled to the reference grid window by window, so callers always get one aligned array.
+# Callers reading overlapping windows (one per plot) read the bands on the reference grid through the
+# process-wide block cache instead (see block_cache.py), so shared blocks are decoded once.
+
+# File name markers of the bands, in stacking order
+BAND_FILE_MARKERS = {
+    "red": "red_red",
+    "green": "green_green",
+    "nir": "nir_nir",
+    "rededge": "red_edge_red_edge",
+    "blue": "blue_blue",
+}
+
+
+def find_band_paths(paths):
+    """
+    Identifies the band files of a flight in one pass over its raster paths.
+
+    Parameters:
+    - paths (list of str): Raster file paths of the flight.
+
+    Returns:
+    - dict: {band: path} in BAND_FILE_MARKERS order, for the bands found (the first match wins).
+    """
+    found = {}
+    for path in paths:
+        name = os.path.basename(path)
+        for band_name, marker in BAND_FILE_MARKERS.items():
+            if marker in name and band_name not in found:
+                found[band_name] = path
+                break
+    return {band_name: found[band_name] for band_name in BAND_FILE_MARKERS if band_name in found}
+
+
+def grid_of(dataset):
+    """Returns a key identifying the pixel grid (CRS, transform and size) of a dataset."""
+    return (str(dataset.crs), tuple(dataset.transform), dataset.width, dataset.height)
+
+
+def stack_vrt_xml(datasets):
+    """
+    Builds the XML of a VRT stacking the first band of datasets on one grid.
+
+    Parameters:
+    - datasets (list): Open datasets sharing the grid of the first one.
+
+    Returns:
+    - str: VRT XML, openable with rasterio.open().
+    """
+    reference = datasets[0]
+    geotransform = ", ".join(repr(value) for value in reference.transform.to_gdal())
+    parts = [f'<VRTDataset rasterXSize="{reference.width}" rasterYSize="{reference.height}">']
+    if reference.crs:
+        parts.append(f"<SRS>{escape(reference.crs.to_wkt())}</SRS>")
+    parts.append(f"<GeoTransform>{geotransform}</GeoTransform>")
+    for band_index, dataset in enumerate(datasets, start=1):
+        data_type = rasterio.dtypes._gdal_typename(dataset.dtypes[0])
+        parts.append(f'<VRTRasterBand dataType="{data_type}" band="{band_index}">')
+        if dataset.nodata is not None:
+            parts.append(f"<NoDataValue>{dataset.nodata!r}</NoDataValue>")
+        parts.append(
+            f'<SimpleSource><SourceFilename relativeToVRT="0">{escape(os.path.abspath(dataset.name))}</SourceFilename>'
+            f"<SourceBand>1</SourceBand></SimpleSource></VRTRasterBand>"
+        )
+    parts.append("</VRTDataset>")
+    return "".join(parts)
+
+
+class BandStack:
+    """
+    Multi-band view of single-band rasters on the grid of a reference band.
+
+    Parameters:
+    - band_paths (dict): {band: path}, e.g. from find_band_paths().
+    - reference (str): Band whose grid the stack uses (default "red", or the first band).
+    - resampling (Resampling): Resampling of bands on another grid.
+    - cached (bool): Read the bands on the reference grid and their masks through the block cache
+      (block_cache.read_cached()) instead of the VRT; for overlapping windows.
+
+    Attributes:
+    - datasets (dict): {band: open dataset}.
+    - aligned (bool): True if every band is on the reference grid (the bands are then read through one VRT).
+    - transform, width, height, crs: Reference grid.
+    """
+
+    def __init__(self, band_paths, reference="red", resampling=Resampling.bilinear, cached=False):
+        if not band_paths:
+            raise ValueError("A band stack needs at least one band.")
+        self.datasets = {band_name: rasterio.open(path) for band_name, path in band_paths.items() if path}
+        self.band_names = list(self.datasets)
+        self.reference = reference if reference in self.datasets else self.band_names[0]
+        self.resampling = resampling
+        self.cached = cached
+
+        reference_dataset = self.datasets[self.reference]
+        self.transform = reference_dataset.transform
+        self.width, self.height = reference_dataset.width, reference_dataset.height
+        self.crs = reference_dataset.crs
+
+        reference_grid = grid_of(reference_dataset)
+        self.on_grid = {band_name: grid_of(dataset) == reference_grid for band_name, dataset in self.datasets.items()}
+        self.aligned = all(self.on_grid.values())
+        self.vrt = rasterio.open(stack_vrt_xml(list(self.datasets.values()))) if self.aligned else None
+        self.dtype = np.result_type(*[dataset.dtypes[0] for dataset in self.datasets.values()])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self.vrt is not None:
+            self.vrt.close()
+        for dataset in self.datasets.values():
+            dataset.close()
+
+    def _source_window(self, band_name, window):
+        """Window of a band's own grid covering a window of the reference grid."""
+        return from_bounds(*bounds(window, self.transform), transform=self.datasets[band_name].transform)
+
+    def read(self, window=None, bands=None, out_dtype=None):
+        """
+        Reads bands for a window of the reference grid.
+
+        Parameters:
+        - window (Window, optional): Window of the reference grid; default: the full grid.
+        - bands (list, optional): Band names to read, in output order; default: all bands.
+        - out_dtype (optional): Output dtype; default: the common dtype of the bands.
+
+        Returns:
+        - np.ndarray: (len(bands), window.height, window.width) array. Bands on another grid are resampled
+          to the window; their pixels outside the band raster are 0.
+        """
+        window = window or Window(0, 0, self.width, self.height)
+        bands = bands or self.band_names
+        out_dtype = out_dtype or self.dtype
+
+        if self.aligned and not self.cached:
+            return self.vrt.read([self.band_names.index(band_name) + 1 for band_name in bands], window=window, out_dtype=out_dtype)
+
+        stacked = np.empty((len(bands), window.height, window.width), dtype=out_dtype)
+        for k, band_name in enumerate(bands):
+            dataset = self.datasets[band_name]
+            if self.on_grid[band_name] and self.cached:
+                stacked[k] = read_cached(dataset, 1, window=window, out_dtype=out_dtype)
+            elif self.on_grid[band_name]:
+                stacked[k] = dataset.read(1, window=window, out_dtype=out_dtype)
+            else:
+                stacked[k] = dataset.read(
+                    1, window=self._source_window(band_name, window), out_shape=(window.height, window.width),
+                    boundless=True, fill_value=0, resampling=self.resampling, out_dtype=out_dtype
+                )
+        return stacked
+
+    def read_masks(self, window=None, bands=None):
+        """
+        Returns the pixels of a window of the reference grid that are valid in every band
+        (nodata, internal mask, alpha; nearest-neighbour resampled for bands on another grid).
+
+        Parameters:
+        - window (Window, optional): Window of the reference grid; default: the full grid.
+        - bands (list, optional): Band names to combine; default: all bands.
+
+        Returns:
+        - np.ndarray or None: Boolean mask of the window, or None if every pixel is valid.
+        """
+        window = window or Window(0, 0, self.width, self.height)
+        valid = None
+        for band_name in bands or self.band_names:
+            dataset = self.datasets[band_name]
+            if self.on_grid[band_name]:
+                if MaskFlags.all_valid in dataset.mask_flag_enums[0]:
+                    continue
+                if self.cached:
+                    band_valid = read_masks_cached(dataset, 1, window=window) != 0
+                else:
+                    band_valid = dataset.read_masks(1, window=window) != 0
+            else:
+                # Pixels outside the band raster are invalid
+                band_valid = dataset.read_masks(
+                    1, window=self._source_window(band_name, window), out_shape=(window.height, window.width),
+                    boundless=True, resampling=Resampling.nearest
+                ) != 0
+            valid = band_valid if valid is None else valid & band_valid
+        return valid
@@ -0,0 +1,250 @@
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+from rasterio.windows import Window
+from tracing import count
+
+# Process-wide cache of decoded raster blocks.
+# The extraction engines, the validity masks and the progress plots read overlapping windows of the same
+# compressed GeoTIFFs many times (neighbouring plots share blocks, the "full" engine reads whole bands for
+# every plot). Decoded blocks are kept in one size-bounded LRU cache per process, keyed by
+# (file, mtime, band, block index), so every block is decompressed once while it stays in the cache.
+# Blocks follow the native tiling of the file; strips are grouped to at least MIN_CACHE_BLOCK_ROWS rows.
+
+# Environment variable with the cache size in GB (inherited by worker processes)
+BLOCK_CACHE_ENV_VAR = "UAV_BLOCK_CACHE_GB"
+
+# Default cache size in GB
+DEFAULT_BLOCK_CACHE_GB = 1.0
+
+# Minimum rows of a cached block of a striped file
+MIN_CACHE_BLOCK_ROWS = 64
+
+# Reads needing more than this fraction of the cache are read directly, so one large read
+# does not evict everything else
+MAX_READ_FRACTION = 0.25
+
+
+class BlockCache:
+    """
+    Size-bounded LRU cache of decoded raster blocks, safe to share between threads.
+
+    Parameters:
+    - max_bytes (int): Maximum size of the cached arrays; 0 disables the cache.
+
+    Attributes:
+    - hits, misses, evictions, bypassed (int): Block lookups served from the cache, blocks decoded,
+      blocks evicted, and reads too large for the cache (read directly).
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = int(max_bytes)
+        self._blocks = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = self.bypassed = 0
+
+    def get(self, key, load):
+        """
+        Returns the block stored under key, decoding it with load() on a miss.
+
+        Parameters:
+        - key (tuple): (file, mtime, band, block row, block column); the band is ("mask", band) for masks.
+        - load (callable): Returns the decoded block.
+
+        Returns:
+        - tuple: (np.ndarray block (read-only, shared), True if it was served from the cache).
+        """
+        with self._lock:
+            block = self._blocks.get(key)
+            if block is not None:
+                self._blocks.move_to_end(key)
+                self.hits += 1
+                return block, True
+
+        block = load()
+        block.flags.writeable = False
+        with self._lock:
+            self.misses += 1
+            if key not in self._blocks:
+                self._blocks[key] = block
+                self._bytes += block.nbytes
+            while self._bytes > self.max_bytes and self._blocks:
+                _, evicted = self._blocks.popitem(last=False)
+                self._bytes -= evicted.nbytes
+                self.evictions += 1
+        return block, False
+
+    def clear(self):
+        """Drops every cached block and resets the counters."""
+        with self._lock:
+            self._blocks.clear()
+            self._bytes = 0
+            self.hits = self.misses = self.evictions = self.bypassed = 0
+
+    def stats(self):
+        """
+        Returns the cache counters.
+
+        Returns:
+        - dict: hits, misses, evictions, bypassed, hit_rate (hits per block lookup, NaN before the first),
+          blocks and bytes (cached now) and max_bytes.
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "bypassed": self.bypassed,
+                "hit_rate": self.hits / lookups if lookups else float("nan"),
+                "blocks": len(self._blocks),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+
+_cache = BlockCache(float(os.environ.get(BLOCK_CACHE_ENV_VAR, DEFAULT_BLOCK_CACHE_GB)) * 1024**3)
+
+
+def block_cache():
+    """Returns the block cache of this process."""
+    return _cache
+
+
+def configure_block_cache(max_gb):
+    """
+    Sets the size of the block cache of this process and of the worker processes it starts afterwards.
+    Blocks over the new size are evicted on the next miss; 0 disables the cache.
+
+    Parameters:
+    - max_gb (float): Maximum cache size in GB.
+    """
+    os.environ[BLOCK_CACHE_ENV_VAR] = str(max_gb)
+    with _cache._lock:
+        _cache.max_bytes = int(max_gb * 1024**3)
+
+
+def block_cache_stats():
+    """Returns the counters of the block cache of this process (see BlockCache.stats())."""
+    return _cache.stats()
+
+
+def _file_version(dataset):
+    """(path, mtime) of the file behind a dataset, or None for datasets without a file (VRT XML, MEM)."""
+    try:
+        return os.path.abspath(dataset.name), os.stat(dataset.name).st_mtime_ns
+    except (OSError, TypeError, ValueError):
+        return None
+
+
+def _cache_block_shape(dataset, band):
+    """Rows and columns of the cached blocks of a band: its native blocks, strips grouped to MIN_CACHE_BLOCK_ROWS rows."""
+    block_rows, block_cols = dataset.block_shapes[band - 1]
+    return block_rows * max(1, MIN_CACHE_BLOCK_ROWS // block_rows), block_cols
+
+
+def _integer_window(dataset, window):
+    """The window as integers, or None if it is fractional or not inside the dataset."""
+    if window is None:
+        return 0, 0, dataset.height, dataset.width
+    values = (window.row_off, window.col_off, window.height, window.width)
+    if any(value != int(value) for value in values):
+        return None
+    row_off, col_off, height, width = (int(value) for value in values)
+    if row_off < 0 or col_off < 0 or row_off + height > dataset.height or col_off + width > dataset.width:
+        return None
+    return row_off, col_off, height, width
+
+
+def _read_band(dataset, band, bounds_, version, masks, out):
+    """Copies the cached blocks of one band (or its mask) covering bounds_ into out; returns (hits, misses)."""
+    hits = misses = 0
+    row_off, col_off, height, width = bounds_
+    block_rows, block_cols = _cache_block_shape(dataset, band)
+    for block_row in range(row_off // block_rows, (row_off + height - 1) // block_rows + 1):
+        for block_col in range(col_off // block_cols, (col_off + width - 1) // block_cols + 1):
+            top, left = block_row * block_rows, block_col * block_cols
+            block_window = Window(left, top, min(block_cols, dataset.width - left), min(block_rows, dataset.height - top))
+            if masks:
+                load = lambda: dataset.read_masks(band, window=block_window)
+            else:
+                load = lambda: dataset.read(band, window=block_window)
+            block, hit = _cache.get((*version, ("mask", band) if masks else band, block_row, block_col), load)
+            hits += hit
+            misses += not hit
+
+            # Overlap of the block and the requested window
+            r0, r1 = max(top, row_off), min(top + block_window.height, row_off + height)
+            c0, c1 = max(left, col_off), min(left + block_window.width, col_off + width)
+            out[r0 - row_off:r1 - row_off, c0 - col_off:c1 - col_off] = block[r0 - top:r1 - top, c0 - left:c1 - left]
+    return hits, misses
+
+
+def _bypass():
+    """Counts a read done without the cache."""
+    with _cache._lock:
+        _cache.bypassed += 1
+    count("block_cache_bypassed")
+
+
+def _count_lookups(hits, misses):
+    count("block_cache_hits", hits)
+    count("block_cache_misses", misses)
+
+
+def read_cached(dataset, indexes=1, window=None, out_dtype=None, masked=False):
+    """
+    Reads bands of a window like dataset.read(), through the block cache.
+
+    Windows that are fractional or cross the raster edge, datasets without a file and reads needing more than
+    MAX_READ_FRACTION of the cache are read directly.
+
+    Parameters:
+    - dataset (DatasetReader): Open raster.
+    - indexes (int or list of int): Band index, or band indexes for a (bands, rows, columns) array.
+    - window (Window, optional): Window to read; default: the full raster.
+    - out_dtype (optional): Output dtype; default: the dtype of the bands.
+    - masked (bool): Return a masked array, masking the pixels invalid in the band masks.
+
+    Returns:
+    - np.ndarray: As dataset.read(indexes, window=window, out_dtype=out_dtype, masked=masked).
+    """
+    bands = [indexes] if isinstance(indexes, int) else list(indexes)
+    out_dtype = np.dtype(out_dtype or np.result_type(*[dataset.dtypes[band - 1] for band in bands]))
+    version = _file_version(dataset)
+    bounds_ = _integer_window(dataset, window)
+
+    if version is None or bounds_ is None or bounds_[2] * bounds_[3] * out_dtype.itemsize * len(bands) > _cache.max_bytes * MAX_READ_FRACTION:
+        _bypass()
+        return dataset.read(indexes, window=window, out_dtype=out_dtype, masked=masked)
+
+    lookups = np.zeros(2, dtype=np.int64)
+    _, _, height, width = bounds_
+    out = np.empty((len(bands), height, width), dtype=out_dtype)
+    for k, band in enumerate(bands):
+        lookups += _read_band(dataset, band, bounds_, version, False, out[k])
+    if masked:
+        valid = np.empty((len(bands), height, width), dtype=np.uint8)
+        for k, band in enumerate(bands):
+            lookups += _read_band(dataset, band, bounds_, version, True, valid[k])
+        out = np.ma.MaskedArray(out, mask=valid == 0)
+    _count_lookups(*lookups.tolist())
+    return out[0] if isinstance(indexes, int) else out
+
+
+def read_masks_cached(dataset, band=1, window=None):
+    """
+    Reads the mask of a band like dataset.read_masks(band, window=window) (0 invalid, 255 valid),
+    through the block cache.
+    """
+    version = _file_version(dataset)
+    bounds_ = _integer_window(dataset, window)
+    if version is None or bounds_ is None or bounds_[2] * bounds_[3] > _cache.max_bytes * MAX_READ_FRACTION:
+        _bypass()
+        return dataset.read_masks(band, window=window)
+
+    out = np.empty(bounds_[2:], dtype=np.uint8)
+    _count_lookups(*_read_band(dataset, band, bounds_, version, True, out))
+    return out
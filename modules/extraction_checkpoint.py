@@ -0,0 +1,197 @@
+import os
+import json
+import hashlib
+import sqlite3
+from datetime import datetime
+
+# Per-plot checkpoint store for the raster extraction.
+# Every finished plot is committed to a small SQLite database keyed by (flight, plot id, band), so a crashed
+# or killed run resumes at the next unprocessed plot. A flight is only marked complete after every plot has
+# been checkpointed or has results and its output file has been written in full.
+# Every flight also stores the signature of the run that wrote its rows (plot geometries, extraction mode, index
+# formulas); rows written under another signature are discarded instead of being restored.
+
+def open_checkpoint_store(db_path):
+    """
+    Opens (and creates if needed) the checkpoint database.
+
+    Parameters:
+    - db_path (str): Path to the SQLite checkpoint file.
+
+    Returns:
+    - sqlite3.Connection: Open connection to the checkpoint store.
+    """
+    os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+
+    # Several flights of the same project may write to the store from different processes
+    conn = sqlite3.connect(db_path, timeout=60)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS plot_stats (
+            flight TEXT NOT NULL,
+            plot_id TEXT NOT NULL,
+            band TEXT NOT NULL,
+            stats TEXT NOT NULL,
+            PRIMARY KEY (flight, plot_id, band)
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS flights (
+            flight TEXT PRIMARY KEY,
+            status TEXT NOT NULL,
+            output_path TEXT,
+            updated TEXT NOT NULL
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS flight_runs (
+            flight TEXT PRIMARY KEY,
+            signature TEXT NOT NULL
+        )
+    """)
+    conn.commit()
+    return conn
+
+
+def run_signature(**settings):
+    """
+    Returns a digest of the settings a flight's statistics depend on.
+
+    Parameters:
+    - settings: JSON-serializable values, e.g. extraction_mode="windowed", plots={plot_id: geometry hash}.
+
+    Returns:
+    - str: Hex digest.
+    """
+    return hashlib.sha256(json.dumps(settings, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def start_flight_run(conn, flight, signature):
+    """
+    Records the run signature of a flight and discards its checkpointed plots if they were written
+    under another (or an unknown) signature.
+
+    Parameters:
+    - conn (sqlite3.Connection): Checkpoint store.
+    - flight (str): Flight name.
+    - signature (str): Output of run_signature().
+
+    Returns:
+    - int: Number of discarded checkpoint rows.
+    """
+    with conn:
+        row = conn.execute("SELECT signature FROM flight_runs WHERE flight = ?", (flight,)).fetchone()
+        discarded = 0
+        if row is None or row[0] != signature:
+            discarded = conn.execute("DELETE FROM plot_stats WHERE flight = ?", (flight,)).rowcount
+        conn.execute("INSERT OR REPLACE INTO flight_runs VALUES (?, ?)", (flight, signature))
+    return discarded
+
+
+def _to_json_value(value):
+    """Converts numpy scalars to plain Python values; NaN is stored as null."""
+    value = float(value)
+    return None if value != value else value
+
+
+def save_plot_checkpoint(conn, flight, plot_id, band_stats):
+    """
+    Stores the statistics of one plot for one or more bands in a single transaction,
+    so a plot is either fully checkpointed or not at all.
+
+    Parameters:
+    - conn (sqlite3.Connection): Checkpoint store.
+    - flight (str): Flight name.
+    - plot_id: Plot ID.
+    - band_stats (dict): {band: {stat_name: value}}.
+    """
+    rows = [
+        (flight, str(plot_id), band, json.dumps({stat: _to_json_value(v) for stat, v in stats.items()}))
+        for band, stats in band_stats.items()
+    ]
+    with conn:
+        conn.executemany("INSERT OR REPLACE INTO plot_stats VALUES (?, ?, ?, ?)", rows)
+        conn.execute(
+            "INSERT OR REPLACE INTO flights VALUES (?, 'running', NULL, ?)",
+            (flight, datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+        )
+
+
+def save_band_checkpoint(conn, flight, band, plot_ids, stats):
+    """
+    Stores the statistics of every plot for one band in a single transaction
+    (used by the single-pass engines, which finish a whole band at a time).
+
+    Parameters:
+    - conn (sqlite3.Connection): Checkpoint store.
+    - flight (str): Flight name.
+    - band (str): Band name.
+    - plot_ids (list): Plot IDs, in the order of the statistics arrays.
+    - stats (dict): {stat_name: array of values per plot}.
+    """
+    rows = [
+        (flight, str(plot_id), band, json.dumps({stat: _to_json_value(values[i]) for stat, values in stats.items()}))
+        for i, plot_id in enumerate(plot_ids)
+    ]
+    with conn:
+        conn.executemany("INSERT OR REPLACE INTO plot_stats VALUES (?, ?, ?, ?)", rows)
+        conn.execute(
+            "INSERT OR REPLACE INTO flights VALUES (?, 'running', NULL, ?)",
+            (flight, datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+        )
+
+
+def load_checkpoint(conn, flight):
+    """
+    Loads every checkpointed plot of a flight.
+
+    Parameters:
+    - conn (sqlite3.Connection): Checkpoint store.
+    - flight (str): Flight name.
+
+    Returns:
+    - dict: {plot_id (str): {band: {stat_name: value}}}. Missing values are NaN.
+    """
+    checkpoint = {}
+    for plot_id, band, stats in conn.execute("SELECT plot_id, band, stats FROM plot_stats WHERE flight = ?", (flight,)):
+        checkpoint.setdefault(plot_id, {})[band] = {
+            stat: float("nan") if value is None else value for stat, value in json.loads(stats).items()
+        }
+    return checkpoint
+
+
+def checkpointed_plot_ids(conn, flight):
+    """Returns the IDs (as str) of the plots of a flight with at least one checkpointed band."""
+    return {plot_id for (plot_id,) in conn.execute("SELECT DISTINCT plot_id FROM plot_stats WHERE flight = ?", (flight,))}
+
+
+def mark_flight_complete(conn, flight, output_path):
+    """
+    Marks a flight complete once its output file is in place and drops its per-plot rows.
+
+    Parameters:
+    - conn (sqlite3.Connection): Checkpoint store.
+    - flight (str): Flight name.
+    - output_path (str): Path of the complete output file.
+    """
+    with conn:
+        conn.execute("DELETE FROM plot_stats WHERE flight = ?", (flight,))
+        conn.execute(
+            "INSERT OR REPLACE INTO flights VALUES (?, 'complete', ?, ?)",
+            (flight, output_path, datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+        )
+
+
+def write_csv_atomically(df, output_csv_path, **to_csv_kwargs):
+    """
+    Writes a DataFrame to CSV through a temporary '.partial' file that is renamed into place,
+    so an interrupted write never leaves a truncated CSV that looks complete.
+
+    Parameters:
+    - df (DataFrame): Data to write.
+    - output_csv_path (str): Final CSV path.
+    - **to_csv_kwargs: Passed on to DataFrame.to_csv().
+    """
+    partial_path = output_csv_path + ".partial"
+    df.to_csv(partial_path, **to_csv_kwargs)
+    os.replace(partial_path, output_csv_path)
@@ -0,0 +1,433 @@
+from ortho_data_extract_funct import STATISTICS_LIST, TOP_FRACTIONS, STREAM_HISTOGRAM_BINS, process_rasters, process_rasters_parallel, process_rasters_parallel_threaded, \
+    process_rasters_windowed, process_rasters_labelled, process_rasters_shared_memory, process_rasters_streaming
+
+import os
+import math
+import time
+import shutil
+import threading
+import multiprocessing
+from queue import Empty
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import psutil
+import rasterio
+from shapely.geometry import box
+from rasterio.windows import Window
+from rasterio.transform import from_origin
+
+# Benchmark harness for the zonal-statistics engines.
+# Synthetic multi-band orthomosaics and plot-grid GeoJSONs are generated at several sizes. Every engine
+# runs in its own process, so its wall time and peak memory (RSS of the process and its workers) are
+# measured in isolation, and its statistics are checked against a reference engine.
+
+# Benchmark sizes: number of plots and mosaic size in pixels (square mosaics)
+BENCHMARK_SIZES = {
+    "tiny": {"n_plots": 100, "mosaic_pixels": 2_000},
+    "small": {"n_plots": 500, "mosaic_pixels": 10_000},
+    "medium": {"n_plots": 2_000, "mosaic_pixels": 20_000},
+    "large": {"n_plots": 10_000, "mosaic_pixels": 40_000},
+}
+
+# Band file suffixes, as produced by Pix4D
+BENCHMARK_BANDS = {"red": "red_red", "green": "green_green", "nir": "nir_nir", "rededge": "red_edge_red_edge", "blue": "blue_blue"}
+
+# Nodata value of the synthetic bands (as written by Pix4D), the fraction of pixels set to it (the same pixels in
+# every band), and the width of the transparent border of the synthetic mosaic as a fraction of its width
+BENCHMARK_NODATA = -10000
+BENCHMARK_HOLE_FRACTION = 0.01
+BENCHMARK_TRANSPARENT_BORDER = 0.05
+
+# Engines that extract one plot at a time in Python; they are run on the first slow_plot_limit plots only
+SLOW_ENGINES = ("process_rasters", "process_rasters_parallel_threaded", "process_rasters_parallel")
+
+
+def generate_synthetic_flight(output_folder, n_plots, mosaic_pixels, pixel_size=0.015, seed=0, block_rows=512):
+    """
+    Writes a synthetic 5-band multispectral flight (one float32 GeoTIFF per band), its transparent RGBA mosaic
+    and a plot-grid GeoJSON.
+
+    The rasters are written in row blocks, so even 40k x 40k mosaics are generated without holding a band
+    in memory. Values are reflectances in [0, 0.6) quantized to 1/4096 (so plots contain ties), and the
+    top-left 64 x 64 pixels are 0 in every band (NDVI is NaN there). BENCHMARK_HOLE_FRACTION of the pixels
+    are BENCHMARK_NODATA, and the mosaic is transparent on a border of every edge that cuts through the outer
+    plots, so engines that do not leave out the same pixels disagree.
+
+    Parameters:
+    - output_folder (str): Folder for the rasters and the GeoJSON.
+    - n_plots (int): Number of plots in the grid.
+    - mosaic_pixels (int): Width and height of the mosaic in pixels.
+    - pixel_size (float): Ground sampling distance in metres.
+    - seed (int): Random seed; the same seed gives the same data.
+    - block_rows (int): Number of rows written per block.
+
+    Returns:
+    - dict: {"red", "green", "nir", "rededge", "blue": raster path, "transparency": transparent mosaic path,
+      "geojson": GeoJSON path}.
+    """
+    os.makedirs(output_folder, exist_ok=True)
+    transform = from_origin(600000, 6600000, pixel_size, pixel_size)
+    profile = {
+        "driver": "GTiff", "width": mosaic_pixels, "height": mosaic_pixels, "count": 1, "dtype": "float32",
+        "crs": "EPSG:32632", "transform": transform, "tiled": True, "blockxsize": 512, "blockysize": 512,
+        "BIGTIFF": "IF_SAFER", "nodata": BENCHMARK_NODATA,
+    }
+
+    dataset = {}
+    for band_index, (band_name, suffix) in enumerate(BENCHMARK_BANDS.items()):
+        path = os.path.join(output_folder, f"benchmark_index_{suffix}.tif")
+        with rasterio.open(path, "w", **profile) as dst:
+            for row_start in range(0, mosaic_pixels, block_rows):
+                rows = min(block_rows, mosaic_pixels - row_start)
+                rng = np.random.default_rng([seed, band_index, row_start])
+                block = (rng.integers(0, int(0.6 * 4096), (rows, mosaic_pixels)) / 4096).astype(np.float32)
+                if row_start < 64:
+                    block[:64 - row_start, :64] = 0
+                holes = np.random.default_rng([seed, row_start]).random((rows, mosaic_pixels)) < BENCHMARK_HOLE_FRACTION
+                block[holes] = BENCHMARK_NODATA
+                dst.write(block, 1, window=Window(0, row_start, mosaic_pixels, rows))
+        dataset[band_name] = path
+
+    # Transparent mosaic on the band grid: opaque grey inside the border, transparent on it
+    border = int(BENCHMARK_TRANSPARENT_BORDER * mosaic_pixels)
+    mosaic_profile = {key: value for key, value in profile.items() if key != "nodata"}
+    mosaic_profile.update(count=4, dtype="uint8", photometric="RGB", alpha="YES", compress="deflate")
+    path = os.path.join(output_folder, "benchmark_transparent_mosaic.tif")
+    with rasterio.open(path, "w", **mosaic_profile) as dst:
+        for row_start in range(0, mosaic_pixels, block_rows):
+            rows = min(block_rows, mosaic_pixels - row_start)
+            row = np.arange(row_start, row_start + rows)[:, None]
+            col = np.arange(mosaic_pixels)[None, :]
+            opaque = (row >= border) & (row < mosaic_pixels - border) & (col >= border) & (col < mosaic_pixels - border)
+            block = np.full((4, rows, mosaic_pixels), 128, dtype=np.uint8)
+            block[3] = np.where(opaque, 255, 0)
+            dst.write(block, window=Window(0, row_start, mosaic_pixels, rows))
+    dataset["transparency"] = path
+
+    # Plot grid over the mosaic; each plot fills 80% of its grid cell
+    grid_cols = math.ceil(math.sqrt(n_plots))
+    grid_rows = math.ceil(n_plots / grid_cols)
+    extent = mosaic_pixels * pixel_size
+    cell_width, cell_height = extent / grid_cols, extent / grid_rows
+    left, top = transform.c, transform.f
+
+    plots = []
+    for i in range(n_plots):
+        row, col = divmod(i, grid_cols)
+        x0 = left + col * cell_width + 0.1 * cell_width
+        y1 = top - row * cell_height - 0.1 * cell_height
+        plots.append(box(x0, y1 - 0.8 * cell_height, x0 + 0.8 * cell_width, y1))
+
+    geojson_path = os.path.join(output_folder, "benchmark_plots.geojson")
+    gpd.GeoDataFrame({"id": np.arange(1, n_plots + 1)}, geometry=plots, crs="EPSG:32632").to_file(geojson_path, driver="GeoJSON")
+    dataset["geojson"] = geojson_path
+
+    return dataset
+
+
+def _empty_stats_df(shp):
+    columns = [f"{band}_{stat}" for band in ["NDVI", "green", "nir", "red", "rededge", "blue"] for stat in STATISTICS_LIST]
+    return pd.DataFrame(np.nan, index=shp["id"], columns=columns)
+
+
+def _band_paths(dataset):
+    return (dataset["green"], dataset["nir"], dataset["red"], dataset["rededge"], dataset["blue"])
+
+
+def _run_process_rasters(shp, dataset):
+    stats_df = _empty_stats_df(shp)
+    process_rasters(shp, "benchmark", "benchmark", *_band_paths(dataset), None, stats_df, transparency_mask_path=dataset["transparency"])
+    return stats_df
+
+
+def _run_process_rasters_parallel(shp, dataset):
+    stats_df = _empty_stats_df(shp)
+    process_rasters_parallel(shp.copy(), {band: dataset[band] for band in ["red", "green", "nir", "rededge"]}, stats_df,
+                              transparency_mask_path=dataset["transparency"])
+    return stats_df
+
+
+def _run_process_rasters_parallel_threaded(shp, dataset):
+    stats_df = _empty_stats_df(shp)
+    process_rasters_parallel_threaded(shp, {band: dataset[band] for band in ["red", "green", "nir", "rededge"]}, stats_df,
+                              transparency_mask_path=dataset["transparency"])
+    return stats_df
+
+
+def _run_windowed(shp, dataset):
+    stats_df = _empty_stats_df(shp)
+    process_rasters_windowed(shp, "benchmark", "benchmark", *_band_paths(dataset), None, stats_df, transparency_mask_path=dataset["transparency"])
+    return stats_df
+
+
+def _run_label(shp, dataset):
+    stats_df = _empty_stats_df(shp)
+    process_rasters_labelled(shp, "benchmark", "benchmark", *_band_paths(dataset), None, stats_df, transparency_mask_path=dataset["transparency"])
+    return stats_df
+
+
+def _run_stream(shp, dataset):
+    stats_df = _empty_stats_df(shp)
+    process_rasters_streaming(shp, "benchmark", "benchmark", *_band_paths(dataset), None, stats_df, transparency_mask_path=dataset["transparency"])
+    return stats_df
+
+
+def _run_shared(shp, dataset):
+    stats_df = _empty_stats_df(shp)
+    process_rasters_shared_memory(shp, {band: dataset[band] for band in BENCHMARK_BANDS}, stats_df, transparency_mask_path=dataset["transparency"])
+    return stats_df
+
+
+def _run_extract_raster_stats_multiple(shp, dataset):
+    # rasterstats based extraction; imported here so the other engines run without rasterstats installed
+    from ortho_data_extract import extract_raster_stats_multiple
+
+    geojson_path = dataset["geojson"]
+    if len(shp) != len(gpd.read_file(geojson_path)):
+        geojson_path = os.path.splitext(geojson_path)[0] + "_subset.geojson"
+        shp.to_file(geojson_path, driver="GeoJSON")
+
+    df = extract_raster_stats_multiple(geojson_path, {band: dataset[band] for band in BENCHMARK_BANDS}, "benchmark", "benchmark")
+    df = df.drop(columns=["geometry", "project", "flight"], errors="ignore")
+    df.index = shp["id"].to_numpy()
+    return df.astype(float)
+
+
+# Benchmarked engines: runner and the bands (or indices) whose statistics it produces
+BENCHMARK_ENGINES = {
+    "process_rasters": (_run_process_rasters, ["NDVI", "green", "nir", "red", "rededge", "blue"]),
+    "process_rasters_parallel_threaded": (_run_process_rasters_parallel_threaded, ["NDVI", "green", "nir", "red", "rededge"]),
+    "process_rasters_parallel": (_run_process_rasters_parallel, ["NDVI", "green", "nir", "red", "rededge"]),
+    "extract_raster_stats_multiple": (_run_extract_raster_stats_multiple, ["green", "nir", "red", "rededge", "blue"]),
+    "windowed": (_run_windowed, ["NDVI", "green", "nir", "red", "rededge", "blue"]),
+    "label": (_run_label, ["NDVI", "green", "nir", "red", "rededge", "blue"]),
+    "shared": (_run_shared, ["NDVI", "green", "nir", "red", "rededge", "blue"]),
+    "stream": (_run_stream, ["NDVI", "green", "nir", "red", "rededge", "blue"]),
+}
+
+# Engines whose failure does not fail the agreement check (rasterstats is an optional dependency, and
+# extract_raster_stats_multiple() does not read the transparent mosaic)
+OPTIONAL_ENGINES = ("extract_raster_stats_multiple",)
+
+# Engines reading quantiles from per-plot histograms, and their bins per plot (see streamed_band_statistics())
+HISTOGRAM_ENGINES = {"stream": STREAM_HISTOGRAM_BINS}
+
+# Statistics those engines read from the histograms: within one bin width of the exact values (iqr: two).
+# The bin width of a plot is at most twice its value range divided by the number of bins.
+HISTOGRAM_STATISTICS = {
+    "median": 1, "q25": 1, "q75": 1, "iqr": 2, "top_10": 1, "top_15": 1, "top_20": 1, "top_25": 1, "top_35": 1, "top_50": 1,
+    **{f"top_{fraction}_{stat}": 1 for fraction in TOP_FRACTIONS for stat in ("mean", "median", "std")},
+}
+
+# Statistics of the binned values (mode and distinct values), not compared for those engines
+BINNED_STATISTICS = ("majority", "minority", "variety")
+
+
+def _sample_peak_memory(stop_event, peak, interval=0.05):
+    """Samples the RSS of the current process and all its children until stop_event is set."""
+    process = psutil.Process()
+    while not stop_event.is_set():
+        try:
+            rss = process.memory_info().rss
+            for child in process.children(recursive=True):
+                try:
+                    rss += child.memory_info().rss
+                except psutil.Error:
+                    pass
+            peak[0] = max(peak[0], rss)
+        except psutil.Error:
+            pass
+        stop_event.wait(interval)
+
+
+def _benchmark_engine_worker(engine_name, dataset, plot_limit, result_path, queue):
+    """Runs one engine in a fresh process and reports (seconds, peak bytes above baseline, n_plots, error)."""
+    try:
+        shp = gpd.read_file(dataset["geojson"])
+        shp.columns = shp.columns.str.lower()
+        if plot_limit:
+            shp = shp.iloc[:plot_limit].reset_index(drop=True)
+
+        baseline = psutil.Process().memory_info().rss
+        peak = [baseline]
+        stop_event = threading.Event()
+        sampler = threading.Thread(target=_sample_peak_memory, args=(stop_event, peak), daemon=True)
+        sampler.start()
+
+        start_time = time.perf_counter()
+        stats_df = BENCHMARK_ENGINES[engine_name][0](shp, dataset)
+        elapsed = time.perf_counter() - start_time
+
+        stop_event.set()
+        sampler.join()
+
+        stats_df.to_pickle(result_path)
+        queue.put((elapsed, peak[0] - baseline, len(shp), None))
+    except Exception as e:
+        queue.put((None, None, None, f"{type(e).__name__}: {e}"))
+
+
+def run_engine_benchmark(engine_name, dataset, result_path, plot_limit=None):
+    """
+    Runs one engine on a synthetic flight in a separate process.
+
+    Parameters:
+    - engine_name (str): Key of BENCHMARK_ENGINES.
+    - dataset (dict): Output of generate_synthetic_flight().
+    - result_path (str): Pickle file the engine's statistics are written to.
+    - plot_limit (int, optional): Only process the first plot_limit plots.
+
+    Returns:
+    - dict: {"seconds", "peak_memory_mb", "plots", "error"}.
+    """
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    process = context.Process(target=_benchmark_engine_worker, args=(engine_name, dataset, plot_limit, result_path, queue))
+    process.start()
+
+    # The engine process may die without reporting (e.g. killed for running out of memory)
+    while True:
+        try:
+            elapsed, peak_bytes, n_plots, error = queue.get(timeout=1)
+            break
+        except Empty:
+            if not process.is_alive():
+                elapsed, peak_bytes, n_plots, error = None, None, None, f"Engine process exited with code {process.exitcode}"
+                break
+    process.join()
+
+    return {
+        "seconds": elapsed,
+        "peak_memory_mb": peak_bytes / 1024**2 if peak_bytes is not None else None,
+        "plots": n_plots,
+        "error": error,
+    }
+
+
+def compare_statistics(reference_df, stats_df, bands, rtol=1e-5, atol=1e-6, histogram_bins=None):
+    """
+    Compares the statistics of an engine with the reference engine on their common plots and columns.
+
+    The default tolerance allows for the vegetation indices being evaluated in float32 by the newer engines.
+
+    Parameters:
+    - reference_df (DataFrame): Statistics of the reference engine.
+    - stats_df (DataFrame): Statistics of the compared engine.
+    - bands (list of str): Bands (or indices) produced by the compared engine.
+    - rtol, atol (float): Tolerances of np.isclose().
+    - histogram_bins (int, optional): Histogram bins per plot of a HISTOGRAM_ENGINES engine. The
+      HISTOGRAM_STATISTICS are then compared within their bin widths and the BINNED_STATISTICS are skipped.
+
+    Returns:
+    - tuple: (max_abs_diff, list of mismatching columns).
+    """
+    columns = [
+        c for c in stats_df.columns if c in reference_df.columns and c.split("_", 1)[0] in bands
+        and not (histogram_bins and c.split("_", 1)[1] in BINNED_STATISTICS)
+    ]
+    plots = reference_df.index.intersection(stats_df.index)
+    expected = reference_df.loc[plots, columns].to_numpy(dtype=float)
+    actual = stats_df.loc[plots, columns].to_numpy(dtype=float)
+
+    tolerance = np.full(expected.shape, float(atol))
+    if histogram_bins:
+        for k, column in enumerate(columns):
+            band, stat = column.split("_", 1)
+            if stat in HISTOGRAM_STATISTICS:
+                bin_width = 2 * reference_df.loc[plots, f"{band}_range"].to_numpy(dtype=float) / histogram_bins
+                tolerance[:, k] += HISTOGRAM_STATISTICS[stat] * np.nan_to_num(bin_width)
+
+    close = np.isclose(actual, expected, rtol=rtol, atol=tolerance, equal_nan=True)
+    mismatches = [column for column, ok in zip(columns, close.all(axis=0)) if not ok]
+    both = ~np.isnan(actual) & ~np.isnan(expected)
+    max_abs_diff = float(np.abs(actual - expected)[both].max()) if both.any() else 0.0
+    return max_abs_diff, mismatches
+
+
+def run_benchmark(work_folder, sizes=("tiny",), engines=None, reference_engine="windowed", slow_plot_limit=20,
+                  rtol=1e-5, atol=1e-6, seed=0, keep_data=False, assert_agreement=True, optional_engines=OPTIONAL_ENGINES):
+    """
+    Generates synthetic flights, runs every engine on them, and reports time, peak memory and agreement.
+
+    Parameters:
+    - work_folder (str): Folder for the synthetic data, the engine outputs and the report.
+    - sizes (iterable of str): Keys of BENCHMARK_SIZES.
+    - engines (list of str, optional): Keys of BENCHMARK_ENGINES (default: all). Engines that fail
+      (raise or are killed) are reported in the "error" column.
+    - reference_engine (str): Engine the others are compared with. It is run on all plots.
+    - slow_plot_limit (int): Number of plots the SLOW_ENGINES are run on.
+    - rtol, atol (float): Agreement tolerances, see compare_statistics().
+    - seed (int): Random seed of the synthetic data.
+    - keep_data (bool): Keep the synthetic rasters after each size.
+    - assert_agreement (bool): Raise an AssertionError if any engine disagrees with the reference, or if
+      the reference or an engine not in optional_engines fails.
+    - optional_engines (iterable of str): Engines whose failure is only reported (e.g. extract_raster_stats_multiple
+      without rasterstats installed).
+
+    Returns:
+    - DataFrame: One row per size and engine. Also saved as benchmark_report.csv in work_folder.
+    """
+    engines = list(engines or BENCHMARK_ENGINES)
+    if reference_engine not in engines:
+        engines.insert(0, reference_engine)
+    # The reference runs first so the others can be compared as they finish
+    engines.remove(reference_engine)
+    engines.insert(0, reference_engine)
+
+    os.makedirs(work_folder, exist_ok=True)
+    rows = []
+
+    for size in sizes:
+        config = BENCHMARK_SIZES[size]
+        print(f"\n🧪 Benchmark size '{size}': {config['n_plots']} plots, {config['mosaic_pixels']} x {config['mosaic_pixels']} pixels")
+        data_folder = os.path.join(work_folder, size)
+        dataset = generate_synthetic_flight(data_folder, config["n_plots"], config["mosaic_pixels"], seed=seed)
+
+        reference_df = None
+        for engine_name in engines:
+            plot_limit = slow_plot_limit if engine_name in SLOW_ENGINES and engine_name != reference_engine else None
+            result_path = os.path.join(data_folder, f"{engine_name}_statistics.pkl")
+            result = run_engine_benchmark(engine_name, dataset, result_path, plot_limit=plot_limit)
+
+            row = {"size": size, "engine": engine_name, **result, "seconds_per_plot": None, "max_abs_diff": None, "mismatched_columns": None}
+            if result["error"] is None:
+                row["seconds_per_plot"] = result["seconds"] / max(result["plots"], 1)
+                stats_df = pd.read_pickle(result_path)
+                if engine_name == reference_engine:
+                    reference_df = stats_df
+                elif reference_df is not None:
+                    max_abs_diff, mismatches = compare_statistics(reference_df, stats_df, BENCHMARK_ENGINES[engine_name][1], rtol=rtol, atol=atol,
+                                                                  histogram_bins=HISTOGRAM_ENGINES.get(engine_name))
+                    row["max_abs_diff"] = max_abs_diff
+                    row["mismatched_columns"] = ", ".join(mismatches)
+                print(f"⏱️ {engine_name}: {result['seconds']:.2f} s for {result['plots']} plots, peak {result['peak_memory_mb']:.0f} MB")
+            else:
+                print(f"❌ {engine_name} failed: {result['error']}")
+            rows.append(row)
+
+        if not keep_data:
+            shutil.rmtree(data_folder, ignore_errors=True)
+
+    report = pd.DataFrame(rows)
+    report_path = os.path.join(work_folder, "benchmark_report.csv")
+    report.to_csv(report_path, index=False)
+    print(f"\n📁 Saved benchmark report to {report_path}")
+    print(report[["size", "engine", "plots", "seconds", "seconds_per_plot", "peak_memory_mb", "max_abs_diff", "mismatched_columns"]].to_string(index=False))
+
+    if assert_agreement:
+        failed = report[report["error"].notna() & ((report["engine"] == reference_engine) | ~report["engine"].isin(optional_engines))]
+        assert failed.empty, f"Engines failed:\n{failed[['size', 'engine', 'error']].to_string(index=False)}"
+        disagreeing = report[report["mismatched_columns"].fillna("") != ""]
+        assert disagreeing.empty, f"Statistics disagree with {reference_engine}:\n{disagreeing[['size', 'engine', 'mismatched_columns']].to_string(index=False)}"
+
+    return report
+
+
+if __name__ == "__main__":
+    # Example usage
+    work_folder = r"D:\PhenoCrop\benchmark"
+    sizes = ["tiny", "small"]   # Also "medium" (2,000 plots, 20k pixels) and "large" (10,000 plots, 40k pixels)
+    engines = None   # All engines; e.g. ["windowed", "label", "shared"] to compare only the newer engines
+
+    run_benchmark(work_folder, sizes=sizes, engines=engines)
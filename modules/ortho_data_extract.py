@@ -171,24 +171,25 @@ def extract_raster_stats_multiple(shp, raster_paths, project_name, flight, plot_
     logging.info("Processing complete! Returning final DataFrame.")
     return final_df
 
-# # Example Usage
-src_folder = r'D:\PhenoCrop\2_pix4d_cleaned\PHENO_CROP\MS\20240619 PHENO_CROP P4M 20m MS 70 75\2_Orthomosaics'
-paths = find_files_in_folder(src_folder, 'tif')
-raster_files = {
-    "red": next((tif for tif in paths if "red_red" in tif), None),
-    "blue": next((tif for tif in paths if "blue_blue" in tif), None),
-    "green": next((tif for tif in paths if "green_green" in tif), None),
-    "nir": next((tif for tif in paths if "nir_nir" in tif), None),
-    "red_edge": next((tif for tif in paths if "red_edge_red_edge" in tif), None)
-}
-
-shapefile_path = r"D:\PhenoCrop\3_qgis\3_Extraction Polygons\3. FINAL MASKS PYTHON\24 PHENO_CROP Avlingsregistrering_sorted_ID_polygons_shrinked.geojson"  # Replace with the path to your GeoJSON file
-
-project = "PHENO_CROP"
-flight = "20240619 PHENO_CROP P4M 20m MS 70 75"
-
-stats_df = extract_raster_stats_multiple(shapefile_path, raster_files, project, flight)
-print(stats_df.head())  # View the extracted statistics
+if __name__ == "__main__":
+    # Example Usage
+    src_folder = r'D:\PhenoCrop\2_pix4d_cleaned\PHENO_CROP\MS\20240619 PHENO_CROP P4M 20m MS 70 75\2_Orthomosaics'
+    paths = find_files_in_folder(src_folder, 'tif')
+    raster_files = {
+        "red": next((tif for tif in paths if "red_red" in tif), None),
+        "blue": next((tif for tif in paths if "blue_blue" in tif), None),
+        "green": next((tif for tif in paths if "green_green" in tif), None),
+        "nir": next((tif for tif in paths if "nir_nir" in tif), None),
+        "red_edge": next((tif for tif in paths if "red_edge_red_edge" in tif), None)
+    }
+
+    shapefile_path = r"D:\PhenoCrop\3_qgis\3_Extraction Polygons\3. FINAL MASKS PYTHON\24 PHENO_CROP Avlingsregistrering_sorted_ID_polygons_shrinked.geojson"  # Replace with the path to your GeoJSON file
+
+    project = "PHENO_CROP"
+    flight = "20240619 PHENO_CROP P4M 20m MS 70 75"
+
+    stats_df = extract_raster_stats_multiple(shapefile_path, raster_files, project, flight)
+    print(stats_df.head())  # View the extracted statistics
 
 
 
@@ -1,29 +1,50 @@
 from file_system_functions import find_files_in_folder
+from extraction_checkpoint import open_checkpoint_store, load_checkpoint, save_plot_checkpoint, save_band_checkpoint, \
+    mark_flight_complete, write_csv_atomically, run_signature, start_flight_run, checkpointed_plot_ids
+from results_store import RESULTS_DATASET_FOLDER, results_partition_path, write_results_parquet
+from vegetation_indices import resolve_indices, required_bands, evaluate_index
+from thumbnail_service import write_thumbnails
+from band_stack import BandStack, find_band_paths
+from block_cache import read_cached, read_masks_cached, block_cache, block_cache_stats
+from progress_preview import ProgressPreview
+from stat_kernels import masked_ndvi, grouped_moments, warmup_kernels, pool_threads, kernel_pool_context, \
+    PlotHistogramAccumulator, HISTOGRAM_BINS
+from tracing import traced, span, count, tracing_enabled, tracing_snapshot, merge_tracing, reset_tracing, export_run, \
+    tracing_summary
+from plot_mask_cache import DEFAULT_CACHE_FOLDER, DEFAULT_MAX_CACHE_GB, load_plot_geometries, plot_mask_key, \
+    load_cached_plot_masks, save_cached_plot_masks, load_cached_plot_coverage, save_cached_plot_coverage
 
 import os
 import gc
 import re
 import csv
+import json
+import hashlib
 import math
 import time
 import glob
 import rasterio
+import shapely
+import shapely.wkt
 import itertools
 import cupy as cp
 import numpy as np
 import pandas as pd
-from numba import njit
 import geopandas as gpd
 import concurrent.futures
+from multiprocessing import shared_memory
 from rasterio.plot import show
 from collections import Counter
+from datetime import datetime
 import matplotlib.pyplot as plt
 from shapely.geometry import box
 import cupy as cp  # GPU acceleration
-from rasterio.enums import Resampling
+from rasterio.enums import Resampling, MaskFlags, ColorInterp
 import psutil  # To monitor memory usage
-from rasterio.transform import from_origin
-from rasterio.features import geometry_mask
+from rasterio.windows import Window
+from rasterio.vrt import WarpedVRT
+from rasterio.transform import from_origin, rowcol
+from rasterio.features import geometry_mask, rasterize
 
 def add_suffix_to_file_name(file_path, suffix):
     """
@@ -48,160 +69,325 @@ def add_suffix_to_file_name(file_path, suffix):
     return new_file_path
 
 
-def downscale_image(file_path, output_folder, scale_factor):
+def downscale_image(file_path, output_folder, scale_factor, check="mtime"):
     """
     Downscale a TIFF/JPG file and save it in the structured output directory.
+    Uses the thumbnail service (see thumbnail_service.write_thumbnails()): the mosaic is read from its
+    overviews when it has them, and an up-to-date preview is not rewritten.
 
     Parameters:
         file_path (str): The path to the original file.
-        output_folder (str): The base output folder.
+        output_folder (str): The path of the downscaled file.
         scale_factor (float): Scaling factor (e.g., 0.25 for 25%).
+        check (str): "mtime" or "hash", how an existing preview is found to be up to date.
 
     Returns:
         str: Path to the saved downscaled file.
     """
-    print(f"\n⚙️ Processing: {os.path.basename(file_path)} at {int(scale_factor * 100)}% resolution")
-
     try:
-        with rasterio.open(file_path) as src:
-            # Compute new dimensions
-            new_width = int(src.width * scale_factor)
-            new_height = int(src.height * scale_factor)
-            print(f"   - Original size: {src.width} x {src.height}")
-            print(f"   - New size: {new_width} x {new_height}")
-
-            # Read and resample image
-            resampled_array = src.read(
-                out_shape=(src.count, new_height, new_width),
-                resampling=Resampling.bilinear
-            )
-
-            # Update metadata
-            profile = src.profile
-            profile.update(
-                width=new_width,
-                height=new_height,
-                transform=src.transform * src.transform.scale(
-                    (src.width / new_width), (src.height / new_height)
-                )
-            )
-
-
-            # Save downscaled image
-            print(f"   - Saving downscaled file: {output_folder}")
-            with rasterio.open(output_folder, "w", **profile) as dst:
-                dst.write(resampled_array)
-
-            print(f"✅ Successfully downscaled: {os.path.basename(file_path)}")
-            return output_folder
-
+        return write_thumbnails(file_path, {scale_factor: output_folder}, check=check)[scale_factor]
     except Exception as e:
         print(f"❌ ERROR processing {file_path}: {str(e)}")
         return None
     
 
 ## Timing Decorator
-# A decorator (wrapper function) that logs the time taken for any function it wraps.
-# To measure execution time of a function
-
-def timing_decorator(func):
-    """Decorator to measure execution time of a function."""
-    def wrapper(*args, **kwargs):
-        start_time = time.time()  # Start time
-        result = func(*args, **kwargs)
-        end_time = time.time()  # End time
-        elapsed_time = end_time - start_time
-        print(f"⏳ Execution time of {func.__name__}: {elapsed_time:.4f} seconds")
-        return result
-    return wrapper
-
-## Using time.perf_counter() (More Precise)
-# This is more precise than time.time() because perf_counter() accounts for system sleep time.
-
-def precise_timing_decorator(func):
-    """Decorator for high-precision execution timing."""
-    def wrapper(*args, **kwargs):
-        start_time = time.perf_counter()
-        result = func(*args, **kwargs)
-        end_time = time.perf_counter()
-        print(f"⏳ Execution time of {func.__name__}: {end_time - start_time:.6f} seconds")
-        return result
-    return wrapper
+# The execution time of the wrapped functions is recorded as a tracing span (see tracing.py) instead of
+# being printed on every call; while tracing is disabled the decorators only check a flag.
+# Both names are kept for the existing call sites.
 
-@precise_timing_decorator
-def calculate_band_statistics(band_array, geom, transform):
-    """Computes multiple statistics for raster values within a given geometry."""
-    STATISTICS_LIST = [
-                    "count", "sum", "mean", "median", "std", "min", "max", "range", "minority",
-                    "majority", "variety", "variance", "cv", "skewness", "kurtosis", "top_10", 
-                    "top_15", "top_20", "top_25", "top_35", "top_50", "q25", "q75", "iqr"
-                    ]
+timing_decorator = traced
+precise_timing_decorator = traced
+
+# Top fractions (percent of the valid pixels with the highest values) summarised by their mean, median and std,
+# as the top_<N>_mean / top_<N>_median / top_<N>_std fields of the ZonalStat model
+TOP_FRACTIONS = (5, 10, 15, 25, 35, 50)
+
+# Statistics computed for every band, in the column order of the output CSVs
+STATISTICS_LIST = [
+                "count", "sum", "mean", "median", "std", "min", "max", "range", "minority",
+                "majority", "variety", "variance", "cv", "skewness", "kurtosis", "top_10", 
+                "top_15", "top_20", "top_25", "top_35", "top_50", "q25", "q75", "iqr",
+                *[f"top_{fraction}_{stat}" for fraction in TOP_FRACTIONS for stat in ("mean", "median", "std")]
+                ]
+
+# Statistics of a plot without pixels in a band
+EMPTY_PLOT_STATISTICS = {stat: np.nan for stat in STATISTICS_LIST}
+
+def _sample_skew_kurtosis(n, m2, m3, m4):
+    """
+    Bias-corrected skewness and excess kurtosis from summed central moments,
+    using the same formulas as pandas.Series.skew() and pandas.Series.kurtosis().
+    """
+    n = np.asarray(n, dtype=float)
+    # Zero out floating point error the same way pandas does
+    m2 = np.where(np.abs(m2) < 1e-14, 0.0, m2)
+    m3 = np.where(np.abs(m3) < 1e-14, 0.0, m3)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        skewness = (n * (n - 1) ** 0.5 / (n - 2)) * (m3 / m2 ** 1.5)
+        skewness = np.where(m2 == 0, 0.0, skewness)
+        skewness = np.where(n < 3, np.nan, skewness)
+
+        numerator = n * (n + 1) * (n - 1) * m4
+        denominator = (n - 2) * (n - 3) * m2 ** 2
+        adj = 3 * (n - 1) ** 2 / ((n - 2) * (n - 3))
+        denominator = np.where(np.abs(denominator) < 1e-14, 0.0, denominator)
+        kurtosis = np.where(denominator == 0, 0.0, numerator / denominator - adj)
+        kurtosis = np.where(n < 4, np.nan, kurtosis)
+
+    return skewness, kurtosis
 
+
+def _top_fraction_count(n_valid, fraction):
+    """Number of pixels in the top fraction (percent) of n_valid pixels: at least one, rounded up."""
+    return np.maximum(1, -(-fraction * np.asarray(n_valid) // 100))
+
+
+def _sorted_quantile(sorted_values, q):
+    """Linear-interpolated quantile of an ascending array without NaNs (as np.nanpercentile)."""
+    position = q * (sorted_values.size - 1)
+    lower = math.floor(position)
+    upper = min(lower + 1, sorted_values.size - 1)
+    return sorted_values[lower] + (position - lower) * (sorted_values[upper] - sorted_values[lower])
+
+
+def band_statistics_from_values(values):
+    """
+    Computes the STATISTICS_LIST fields of the pixel values of one plot from a single sort
+    (NaNs count towards "count" and "variety" and are ignored elsewhere, as in calculate_band_statistics()).
+
+    Parameters:
+    - values (array-like): Pixel values inside the plot.
+
+    Returns:
+    - dict: {stat_name: value} in STATISTICS_LIST order.
+    """
+    sorted_values = np.sort(np.asarray(values, dtype=float).ravel())  # NaNs are sorted last
+    count = sorted_values.size
+    if count == 0:
+        return {stat: np.nan for stat in STATISTICS_LIST}
+
+    n_valid = int(np.searchsorted(sorted_values, np.nan))  # Index of the first NaN
+    n_nan = count - n_valid
+    valid = sorted_values[:n_valid]
+
+    # Runs of equal values (NaNs form one run, as in np.unique)
+    if n_valid:
+        run_lengths = np.diff(np.flatnonzero(np.concatenate(([True], valid[1:] != valid[:-1], [True]))))
+        run_values = valid[np.concatenate(([0], np.cumsum(run_lengths)[:-1]))]
+    else:
+        run_lengths, run_values = np.empty(0, dtype=np.int64), valid
+    if n_nan:
+        run_lengths = np.append(run_lengths, n_nan)
+        run_values = np.append(run_values, np.nan)
+
+    if n_valid == 0:
+        stats = {stat: np.nan for stat in STATISTICS_LIST}
+        stats.update(count=count, sum=0.0, variety=run_lengths.size, majority=np.nan, minority=np.nan)
+        return stats
+
+    # Moments in one accumulation over the deviations
+    total = valid.sum()
+    mean = total / n_valid
+    deviation = valid - mean
+    deviation2 = deviation * deviation
+    m2 = deviation2.sum()
+    m3 = np.dot(deviation2, deviation)
+    m4 = np.dot(deviation2, deviation2)
+    variance = m2 / n_valid
+    std = np.sqrt(variance)
+    skewness, kurtosis = _sample_skew_kurtosis(n_valid, m2, m3, m4)
+
+    minimum, maximum = valid[0], valid[-1]
+    median = _sorted_quantile(valid, 0.50)
+    q25 = _sorted_quantile(valid, 0.25)
+    q75 = _sorted_quantile(valid, 0.75)
+
+    # Top fractions: the highest values are the tail of the sorted array
+    top_stats = {}
+    for fraction in TOP_FRACTIONS:
+        top = valid[n_valid - int(_top_fraction_count(n_valid, fraction)):]
+        top_mean = top.mean()
+        top_deviation = top - top_mean
+        top_stats[f"top_{fraction}_mean"] = top_mean
+        top_stats[f"top_{fraction}_median"] = _sorted_quantile(top, 0.50)
+        top_stats[f"top_{fraction}_std"] = np.sqrt(np.dot(top_deviation, top_deviation) / top.size)
+
+    return {
+        "count": count,
+        "sum": total,
+        "mean": mean,
+        "median": median,
+        "std": std,
+        "min": minimum,
+        "max": maximum,
+        "range": maximum - minimum,
+        "minority": run_values[np.argmin(run_lengths)],
+        "majority": run_values[np.argmax(run_lengths)],
+        "variety": run_lengths.size,
+        # Variance – Measures how spread out the values are.
+        "variance": variance,
+        # Coefficient of Variation (CV) – Standard deviation divided by the mean (useful for comparing variability).
+        "cv": std / mean if mean != 0 else np.nan,
+        # Skewness – Measures asymmetry of the distribution (negative = left-skewed, positive = right-skewed).
+        "skewness": float(skewness),
+        # Kurtosis – Measures how peaked or flat the distribution is compared to a normal distribution.
+        "kurtosis": float(kurtosis),
+        "top_10": _sorted_quantile(valid, 0.90), # Top 10% of values
+        "top_15": _sorted_quantile(valid, 0.85), # Top 15% of values
+        "top_20": _sorted_quantile(valid, 0.80), # Top 20% of values
+        "top_25": q75, # Top 25% of values
+        "top_35": _sorted_quantile(valid, 0.65), # Top 35% of values
+        "top_50": median, # Top 50% of values
+        # 25th Percentile (Q1) – First quartile, representing the lower 25% of values.
+        "q25": q25,
+        # 75th Percentile (Q3) – Third quartile, representing the upper 25% of values.
+        "q75": q75,
+        # Interquartile Range (IQR) – Difference between Q3 and Q1, showing spread without extreme values.
+        "iqr": q75 - q25,
+        # Mean, median and standard deviation of the top 5%, 10%, ... of values
+        **top_stats
+    }
+
+
+@precise_timing_decorator
+def calculate_band_statistics(band_array, geom, transform, valid=None):
+    """
+    Computes multiple statistics for raster values within a given geometry.
+    Pixels where the optional valid mask (see window_validity()) is False are left out.
+    """
     # Ensure band_array is 2D
     if band_array.ndim != 2:
         raise ValueError("band_array must be a 2D array (height × width).")
     
     # Create a mask for the geometry
     mask = geometry_mask([geom], transform=transform, invert=True, out_shape=band_array.shape)
+    if valid is not None:
+        mask &= valid
 
-    if np.sum(mask) == 0:  # Check if any pixels were selected
+    if not mask.any():  # Check if any pixels were selected
         print(f"Warning: No valid pixels found for geometry {geom}")
-        print(f"Mask unique values: {np.unique(mask)}")  # Should contain both True & False
         return {stat: np.nan for stat in STATISTICS_LIST}  # Return NaNs
 
-    masked_values = band_array[mask]
+    return band_statistics_from_values(band_array[mask])
+
+
+def _weighted_sorted_quantiles(sorted_values, sorted_weights, qs):
+    """
+    Weighted quantiles of sorted values. Value i sits at position (W_i - w_i) / (W - w_n) of the
+    cumulative weight, and positions in between are interpolated linearly, so equal weights give
+    exactly np.percentile(..., method="linear").
+    """
+    if sorted_values.size == 1:
+        return np.full(len(qs), sorted_values[0])
+    cumulative = np.cumsum(sorted_weights)
+    positions = (cumulative - sorted_weights) / (cumulative[-1] - sorted_weights[-1])
+    return np.interp(qs, positions, sorted_values)
 
-    if masked_values.size == 0:
-        print(f"Warning: All pixels are masked for geometry {geom}")
-        print(f"Masked pixel values: {masked_values}")
+
+def weighted_band_statistics_from_values(values, weights):
+    """
+    Coverage-weighted version of band_statistics_from_values(): every pixel counts with the fraction of it
+    covered by the plot. "count" is the covered area in pixels and "sum" the weighted sum; with equal weights
+    the other statistics equal band_statistics_from_values().
+
+    Parameters:
+    - values (array-like): Pixel values of the plot window.
+    - weights (array-like): Coverage fractions in [0, 1], same shape as values.
+
+    Returns:
+    - dict: {stat_name: value} in STATISTICS_LIST order.
+    """
+    values = np.asarray(values, dtype=float).ravel()
+    weights = np.asarray(weights, dtype=float).ravel()
+    covered = weights > 0
+    values, weights = values[covered], weights[covered]
+    if values.size == 0:
         return {stat: np.nan for stat in STATISTICS_LIST}
 
-    if masked_values.size == 0:
-        return {stat: np.nan for stat in [
-            "count", "sum", "mean", "median", "std", "min", "max", "range", "minority",
-            "majority", "variety", "variance", "cv", "skewness", "kurtosis", "top_10", 
-            "top_15", "top_20", "top_25", "top_35", "top_50", "q25", "q75", "iqr"
-        ]}
-    
-    # Compute statistics    
-    unique_vals, counts = np.unique(masked_values, return_counts=True)
-    majority = unique_vals[np.argmax(counts)] if unique_vals.size > 0 else np.nan
-    minority = unique_vals[np.argmin(counts)] if unique_vals.size > 0 else np.nan
+    order = np.argsort(values, kind="stable")  # NaNs are sorted last
+    sorted_values, sorted_weights = values[order], weights[order]
+    count = sorted_weights.sum()
+
+    n_valid = int(np.searchsorted(sorted_values, np.nan))  # Index of the first NaN
+    valid, valid_weights = sorted_values[:n_valid], sorted_weights[:n_valid]
+
+    # Runs of equal values and their total weights (NaNs form one run, as in band_statistics_from_values())
+    if n_valid:
+        run_starts = np.flatnonzero(np.concatenate(([True], valid[1:] != valid[:-1])))
+        run_values, run_weights = valid[run_starts], np.add.reduceat(valid_weights, run_starts)
+    else:
+        run_values, run_weights = valid, valid_weights
+    if n_valid < values.size:
+        run_values = np.append(run_values, np.nan)
+        run_weights = np.append(run_weights, sorted_weights[n_valid:].sum())
+
+    if n_valid == 0:
+        stats = {stat: np.nan for stat in STATISTICS_LIST}
+        stats.update(count=count, sum=0.0, variety=run_values.size, majority=np.nan, minority=np.nan)
+        return stats
+
+    # Weighted moments, scaled to the effective number of pixels
+    valid_weight = valid_weights.sum()
+    total = np.dot(valid_weights, valid)
+    mean = total / valid_weight
+    deviation = valid - mean
+    weighted_deviation2 = valid_weights * deviation * deviation
+    variance = weighted_deviation2.sum() / valid_weight
+    std = np.sqrt(variance)
+    n_effective = round(valid_weight**2 / np.dot(valid_weights, valid_weights), 9)  # Exact pixel count for equal weights
+    scale = n_effective / valid_weight
+    skewness, kurtosis = _sample_skew_kurtosis(
+        n_effective,
+        weighted_deviation2.sum() * scale,
+        np.dot(weighted_deviation2, deviation) * scale,
+        np.dot(weighted_deviation2, deviation * deviation) * scale
+    )
+
+    q25, median, q65, q75, q80, q85, q90 = _weighted_sorted_quantiles(
+        valid, valid_weights, [0.25, 0.50, 0.65, 0.75, 0.80, 0.85, 0.90]
+    )
+    minimum, maximum = valid[0], valid[-1]
+
+    # Top fractions: the highest values up to the fraction of the total weight (the crossing pixel included)
+    top_stats = {}
+    weight_from_top = np.cumsum(valid_weights[::-1])
+    for fraction in TOP_FRACTIONS:
+        k = min(int(np.searchsorted(weight_from_top, fraction / 100 * valid_weight * (1 - 1e-9))) + 1, n_valid)
+        top, top_weights = valid[n_valid - k:], valid_weights[n_valid - k:]
+        top_mean = np.dot(top_weights, top) / top_weights.sum()
+        top_deviation = top - top_mean
+        top_stats[f"top_{fraction}_mean"] = top_mean
+        top_stats[f"top_{fraction}_median"] = _weighted_sorted_quantiles(top, top_weights, [0.50])[0]
+        top_stats[f"top_{fraction}_std"] = np.sqrt(np.dot(top_weights * top_deviation, top_deviation) / top_weights.sum())
 
     return {
-        "count": masked_values.size,
-        "sum": np.nansum(masked_values),
-        "mean": np.nanmean(masked_values),
-        "median": np.nanmedian(masked_values),
-        "std": np.nanstd(masked_values),
-        "min": np.nanmin(masked_values),
-        "max": np.nanmax(masked_values),
-        "range": np.nanmax(masked_values) - np.nanmin(masked_values),
-        "minority": minority,
-        "majority": majority,
-        "variety": len(unique_vals),
-        # Variance – Measures how spread out the values are.
-        "variance": np.nanvar(masked_values),
-        # Coefficient of Variation (CV) – Standard deviation divided by the mean (useful for comparing variability).
-        "cv": np.nanstd(masked_values) / np.nanmean(masked_values) if np.nanmean(masked_values) != 0 else np.nan,
-        # Skewness – Measures asymmetry of the distribution (negative = left-skewed, positive = right-skewed).
-        "skewness": pd.Series(masked_values).skew(),
-        # Kurtosis – Measures how peaked or flat the distribution is compared to a normal distribution.
-        "kurtosis": pd.Series(masked_values).kurtosis(),
-        "top_10": np.nanpercentile(masked_values, 90), # Top 10% of values
-        "top_15": np.nanpercentile(masked_values, 85), # Top 15% of values
-        "top_20": np.nanpercentile(masked_values, 80), # Top 20% of values
-        # If you want high reflectance areas (e.g., bright areas), you'd analyze top 25% values
-        "top_25": np.nanpercentile(masked_values, 75), # Top 25% of values
-        "top_35": np.nanpercentile(masked_values, 65), # Top 35% of values
-        "top_50": np.nanpercentile(masked_values, 50), # Top 50% of values
-        # 25th Percentile (Q1) – First quartile, representing the lower 25% of values.
-        # If you're looking for areas with low vegetation index (NDVI), you might analyze Q1 values.
-        "q25": np.nanpercentile(masked_values, 25),
-        # 75th Percentile (Q3) – Third quartile, representing the upper 25% of values.
-        "q75": np.nanpercentile(masked_values, 75),
-         # Interquartile Range (IQR) – Difference between Q3 and Q1, showing spread without extreme values.
-        "iqr": np.nanpercentile(masked_values, 75) - np.nanpercentile(masked_values, 25)
+        "count": count,
+        "sum": total,
+        "mean": mean,
+        "median": median,
+        "std": std,
+        "min": minimum,
+        "max": maximum,
+        "range": maximum - minimum,
+        "minority": run_values[np.argmin(run_weights)],
+        "majority": run_values[np.argmax(run_weights)],
+        "variety": run_values.size,
+        "variance": variance,
+        "cv": std / mean if mean != 0 else np.nan,
+        "skewness": float(skewness),
+        "kurtosis": float(kurtosis),
+        "top_10": q90,
+        "top_15": q85,
+        "top_20": q80,
+        "top_25": q75,
+        "top_35": q65,
+        "top_50": median,
+        "q25": q25,
+        "q75": q75,
+        "iqr": q75 - q25,
+        **top_stats
     }
 
 def ensure_crs_alignment(shapefile, raster_crs):
@@ -282,6 +468,19 @@ def plot_with_highlighted_shp_geometry(shapefile, highlight_id, status, processe
     # Display the plot
     plt.show()
 
+def read_display_array(src):
+    """
+    Returns the array rasterio.plot.show() draws for a dataset (masked; the RGB bands in colour order,
+    or the first band), read through the block cache so redrawing the same mosaic does not decode it again.
+    """
+    if src.count > 1:
+        band_of = dict(zip(src.colorinterp, src.indexes))
+        rgb_bands = [band_of.get(colour) for colour in (ColorInterp.red, ColorInterp.green, ColorInterp.blue)]
+        if None not in rgb_bands:
+            return read_cached(src, rgb_bands, masked=True)
+    return read_cached(src, 1, masked=True)
+
+
 @precise_timing_decorator
 def plot_with_highlighted_ortho_geometry(
     shapefile, highlight_id, status, processed_ids, 
@@ -329,7 +528,7 @@ def plot_with_highlighted_ortho_geometry(
     # Plot the orthomosaic if provided
     if ortho_path:
         with rasterio.open(ortho_path) as src:
-            show(src, ax=ax, title= f"Raster processing status for {project_name}", adjust='box')
+            show(read_display_array(src), transform=src.transform, ax=ax, title= f"Raster processing status for {project_name}", adjust='box')
 
             # Reproject the shapefile to match the orthomosaic CRS if necessary
             if shapefile.crs != src.crs:
@@ -420,8 +619,18 @@ def plot_with_highlighted_ortho_geometry(
 @precise_timing_decorator
 def process_rasters(shp, project_name, flight, green_raster_path, nir_raster_path, red_raster_path, \
                     rededge_raster_path, blue_raster_path, rgb_raster_thumb_path, \
-                    stats_df, plot_geom = "none"):
-    """Processes all geometries in the shapefile and calculates raster statistics."""
+                    stats_df, plot_geom = "none", transparency_mask_path=None, checkpoint=None):
+    """
+    Processes all geometries in the shapefile and calculates raster statistics.
+    Nodata pixels and pixels outside the transparent mosaic (transparency_mask_path) are left out.
+    If a checkpoint store is given, every finished plot is committed to it and plots already stored
+    for this flight are not recomputed.
+    Only the window covering each plot (see plot_window()) is read, in float32, through the block cache
+    (see block_cache.py), so blocks shared by neighbouring plots are only decoded once.
+
+    plot_geom selects the progress display: "none", "ortho" or "shp" (redraws the full figure for every plot),
+    or "preview" (a ProgressPreview window over rgb_raster_thumb_path, drawn by a separate process).
+    """
     # Open the blue raster separately if the path exists
     if blue_raster_path:
         blue = rasterio.open(blue_raster_path)
@@ -436,14 +645,47 @@ def process_rasters(shp, project_name, flight, green_raster_path, nir_raster_pat
         # Ensure shapefile matches raster CRS
         shp_crs = ensure_crs_alignment(shp, red.crs)
 
+        # Valid pixels of every band grid, computed once
+        datasets = [band_ for band_ in [red, green, nir, rededge, blue] if band_]
+        transparency = open_transparency_mask(transparency_mask_path)
+        grid_valid = {}
+        for band_ in datasets:
+            grid_key = band_grid_key(band_)
+            if grid_key not in grid_valid:
+                grid_valid[grid_key] = window_validity([d for d in datasets if band_grid_key(d) == grid_key], transparency=transparency)
+        if transparency:
+            transparency.close()
+
+        # Plots outside every band are skipped before any band is read
+        coverage_report = classify_plot_coverage(shp_crs, {band_.name: band_.bounds for band_ in datasets})
+        outside_all = coverage_report["outside_all"].to_numpy()
+
         # Track processed polygons by ID
         processed_ids = []
+        preview = ProgressPreview(shp_crs, ortho_path=rgb_raster_thumb_path, title=f"{project_name} {flight}") if plot_geom == "preview" else None
+
+        # Plots finished by an earlier, interrupted run
+        checkpointed = load_checkpoint(checkpoint, flight) if checkpoint is not None else {}
+        expected_bands = {"NDVI", "red", "green", "nir", "rededge", *(["blue"] if blue else [])}
 
         for i, geom in enumerate(shp_crs.geometry):
 
             start_time = time.time()  # Start timing before the loop
 
+            plot_id = shp_crs['id'][i]
+            if expected_bands.issubset(checkpointed.get(str(plot_id), {})):
+                for band_name, band_stats in checkpointed[str(plot_id)].items():
+                    stats_df.loc[plot_id, [f"{band_name}_{stat}" for stat in band_stats.keys()]] = list(band_stats.values())
+                processed_ids.append(plot_id)
+                continue
+
             print(f"Processing geometry {i + 1}/{len(shp_crs)} (ID: {shp_crs['id'][i]})")
+
+            if outside_all[i]:
+                print(f"Geometry {shp_crs['id'][i]} is empty or does not intersect the raster extent. Skipping.")
+                if preview:
+                    preview.skipped(i)
+                continue
             
             highlight_status = 'processing'
             
@@ -453,106 +695,1328 @@ def process_rasters(shp, project_name, flight, green_raster_path, nir_raster_pat
             elif plot_geom == "shp":
                 # Plot the field plots and highlight the current geometry being processed
                 plot_with_highlighted_shp_geometry(shp_crs, shp_crs.iloc[i]['id'], highlight_status, processed_ids, highlight_color='red', edgewidth=3, default_color='lightblue')
+            elif preview:
+                preview.processing(i)
+
+            # Read the plot window of every band as float32, through the block cache
+            windows = {band_: plot_window(geom, band_.transform, band_.width, band_.height) for band_ in datasets}
+            band_arrays = {band_: read_cached(band_, 1, window=windows[band_], out_dtype=np.float32)
+                           for band_ in datasets if windows[band_] is not None}
+
+            # # Compute NDVI
+            # start_time_ndvi = time.time()  # Start timing before the loop
+            # ndvi = np.where((nir_band + red_band) != 0, (nir_band - red_band) / (nir_band + red_band), np.nan)
+            # end_time_ndvi = time.time()  # Stop timing after the loop
+            # print(f"⏳ NDVI Compute execution time: {end_time_ndvi - start_time_ndvi:.4f} seconds")
+            
+            # Compute NDVI (Numba optimized below) This is faster than the one above
+            # (from the nir pixels of the red window, as the bands share the red grid)
+            if windows[red] is not None:
+                ndvi = compute_ndvi_numba(read_cached(nir, 1, window=windows[red], out_dtype=np.float32), band_arrays[red])
+
+            # Calculate statistics (once per band; keys and values come from the same call)
+            band_names = [("NDVI", red), ("red", red), ("green", green), ("nir", nir), ("rededge", rededge)]
+            if blue:
+                band_names.append(("blue", blue))
+
+            plot_stats = {}
+            for band_name, band_ in band_names:
+                window = windows[band_]
+                if window is None:
+                    band_stats = EMPTY_PLOT_STATISTICS
+                else:
+                    valid = grid_valid[band_grid_key(band_)]
+                    band_stats = calculate_band_statistics(ndvi if band_name == "NDVI" else band_arrays[band_], geom, band_.window_transform(window),
+                                                           valid[window.toslices()] if valid is not None else None)
+                stats_df.loc[shp_crs['id'][i], [f"{band_name}_{stat}" for stat in band_stats.keys()]] = list(band_stats.values())
+                plot_stats[band_name] = band_stats
+
+            if checkpoint is not None:
+                save_plot_checkpoint(checkpoint, flight, plot_id, plot_stats)
+
+            # Update the status of the geometry to 'processed'
+            processed_ids.append(shp_crs.iloc[i]['id'])
+            if preview:
+                preview.processed(i)
+
+            end_time = time.time()  # Stop timing after the loop
+            print(f"⏳ Loop execution time: {end_time - start_time:.4f} seconds")
+
+        highlight_status = 'Processing Complete'
+        if plot_geom == "ortho":
+            # Highlight the current ortho geometry being processed
+            plot_with_highlighted_ortho_geometry(shp_crs, shp_crs.iloc[i]['id'], highlight_status, processed_ids, ortho_path=rgb_raster_thumb_path, project_name=project_name, flight=flight)
+        elif plot_geom == "shp":
+            plot_with_highlighted_shp_geometry(shp_crs, shp_crs.iloc[i]['id'], highlight_status, processed_ids, highlight_color='red', edgewidth=3, default_color='lightblue')
+        elif preview:
+            preview.close()
+
+    gc.collect()  # Force garbage collection
+
+
+def plot_window(geom, transform, width, height):
+    """
+    Computes the pixel window covering the bounding box of a geometry, clipped to the raster extent.
+
+    Every pixel whose centre can fall inside the geometry lies within this window, so masking
+    the window gives exactly the same pixels as masking the full raster.
+
+    Parameters:
+    - geom (shapely.geometry): Plot geometry in the raster CRS.
+    - transform (Affine): Affine transform of the raster.
+    - width (int): Raster width in pixels.
+    - height (int): Raster height in pixels.
+
+    Returns:
+    - Window or None: The clipped window, or None if the geometry lies outside the raster.
+    """
+    minx, miny, maxx, maxy = geom.bounds
+
+    # Pixel indices of the four bounding box corners (handles any axis orientation)
+    rows, cols = rowcol(transform, [minx, maxx, minx, maxx], [miny, miny, maxy, maxy], op=math.floor)
+
+    row_start, row_stop = max(min(rows), 0), min(max(rows) + 1, height)
+    col_start, col_stop = max(min(cols), 0), min(max(cols) + 1, width)
+
+    if row_stop <= row_start or col_stop <= col_start:
+        return None
+
+    return Window(col_start, row_start, col_stop - col_start, row_stop - row_start)
+
+
+### Raster coverage prefilter
+# Every plot is classified against the footprint (bounds) of every raster in one vectorized pass before the
+# extraction starts. Bounding boxes settle the plots fully inside or outside a raster; only the plots
+# crossing a raster edge are intersected with its footprint. Plots outside every raster are skipped.
+
+# Location of a plot relative to a raster footprint
+PLOT_INSIDE, PLOT_PARTIAL, PLOT_OUTSIDE = "inside", "partial", "outside"
+
+
+def _footprint_coverage(geometries, plot_bounds, areas, footprint_bounds):
+    """Fraction of the area of every plot inside a rectangular footprint (0 for empty or missing geometries)."""
+    left, bottom, right, top = footprint_bounds
+    coverage = np.zeros(len(geometries))
+    if not (left < right and bottom < top):
+        return coverage
+
+    with np.errstate(invalid="ignore"):
+        has_area = areas > 0
+        inside = has_area & (plot_bounds[:, 0] >= left) & (plot_bounds[:, 1] >= bottom) & (plot_bounds[:, 2] <= right) & (plot_bounds[:, 3] <= top)
+        overlaps = has_area & (plot_bounds[:, 0] < right) & (plot_bounds[:, 2] > left) & (plot_bounds[:, 1] < top) & (plot_bounds[:, 3] > bottom)
+    coverage[inside] = 1.0
+
+    crossing = overlaps & ~inside
+    if crossing.any():
+        footprint = shapely.box(left, bottom, right, top)
+        coverage[crossing] = np.minimum(shapely.area(shapely.intersection(geometries[crossing], footprint)) / areas[crossing], 1.0)
+    return coverage
+
+
+def _coverage_location(coverage):
+    return np.select([coverage >= 1.0, coverage > 0], [PLOT_INSIDE, PLOT_PARTIAL], PLOT_OUTSIDE)
+
+
+def classify_plot_coverage(shp_crs, raster_bounds):
+    """
+    Classifies every plot as inside, partially inside or outside each raster, and the rasters together.
+
+    Parameters:
+    - shp_crs (GeoDataFrame): Plot polygons with an 'id' column, in the raster CRS.
+    - raster_bounds (dict): {raster name: (left, bottom, right, top)}, e.g. {"red": red.bounds}.
+
+    Returns:
+    - DataFrame: Indexed by plot ID, with per raster "<name>_coverage" (fraction of the plot area inside
+      the raster footprint) and "<name>_location" (PLOT_INSIDE, PLOT_PARTIAL or PLOT_OUTSIDE), "coverage" and
+      "location" for the footprint shared by all rasters, and "outside_all" (True if outside every raster).
+    """
+    geometries = np.asarray(shp_crs.geometry.array, dtype=object)
+    plot_bounds = shapely.bounds(geometries)
+    areas = shapely.area(geometries)
+
+    report = pd.DataFrame(index=shp_crs['id'])
+    outside_all = np.ones(len(geometries), dtype=bool)
+    for name, bounds_ in raster_bounds.items():
+        coverage = _footprint_coverage(geometries, plot_bounds, areas, tuple(bounds_))
+        report[f"{name}_coverage"] = coverage
+        report[f"{name}_location"] = _coverage_location(coverage)
+        outside_all &= coverage == 0
+
+    all_bounds = np.array([tuple(bounds_) for bounds_ in raster_bounds.values()], dtype=float)
+    shared_footprint = (*all_bounds[:, :2].max(axis=0), *all_bounds[:, 2:].min(axis=0))
+    report["coverage"] = _footprint_coverage(geometries, plot_bounds, areas, shared_footprint)
+    report["location"] = _coverage_location(report["coverage"].to_numpy())
+    report["outside_all"] = outside_all
+    return report
+
+
+def print_coverage_summary(report):
+    """Prints how many plots lie inside, partially inside and outside the rasters."""
+    counts = report["location"].value_counts()
+    print(f"🗺️ Plot coverage: {counts.get(PLOT_INSIDE, 0)} inside, {counts.get(PLOT_PARTIAL, 0)} partially inside, "
+          f"{counts.get(PLOT_OUTSIDE, 0)} outside the shared raster footprint; {int(report['outside_all'].sum())} outside every raster (skipped)")
+
+
+### Pixel validity
+# Nodata pixels, internal masks and alpha of the bands, and the transparent background of the
+# "_transparent_mosaic_group1.tif" mosaic, are left out of the plot statistics. The validity of a window
+# is computed once for all bands sharing its grid and passed to the statistics kernels.
+
+def band_grid_key(dataset):
+    """Returns a key identifying the pixel grid of a dataset."""
+    return (tuple(dataset.transform), dataset.width, dataset.height)
+
+
+def band_has_mask(dataset):
+    """Returns True if the first band of a dataset has a nodata value, an internal mask or an alpha band."""
+    return MaskFlags.all_valid not in dataset.mask_flag_enums[0]
+
+
+def open_transparency_mask(transparency_mask_path):
+    """
+    Opens the transparent mosaic whose alpha (or nodata) marks the flown area.
+
+    Returns:
+    - DatasetReader or None: The open dataset, or None if no path is given or the mosaic has no mask.
+    """
+    if not transparency_mask_path:
+        return None
+    transparency = rasterio.open(transparency_mask_path)
+    if not band_has_mask(transparency):
+        transparency.close()
+        return None
+    return transparency
+
+
+def transparency_window_mask(transparency, transform, window):
+    """
+    Returns the opaque pixels of the transparent mosaic on a window of a band grid
+    (nearest-neighbour resampled if the mosaic is on another grid; outside the mosaic is transparent).
+    """
+    if tuple(transparency.transform) == tuple(transform):
+        source_window = window
+    else:
+        source_window = rasterio.windows.from_bounds(*rasterio.windows.bounds(window, transform), transform=transparency.transform)
+    return transparency.dataset_mask(window=source_window, out_shape=(window.height, window.width), boundless=True) != 0
+
+
+def window_validity(datasets, window=None, transparency=None):
+    """
+    Computes the valid pixels of a window shared by bands on one grid: valid in every band's mask
+    (nodata, internal mask, alpha) and opaque in the transparent mosaic.
+
+    Parameters:
+    - datasets (list): Open band datasets on the same grid.
+    - window (Window, optional): Window of the grid; default: the full grid.
+    - transparency (DatasetReader, optional): Transparent mosaic from open_transparency_mask().
+
+    Returns:
+    - np.ndarray or None: Boolean mask of the window, or None if every pixel is valid.
+    """
+    if window is None:
+        window = Window(0, 0, datasets[0].width, datasets[0].height)
+
+    valid = None
+    for dataset in datasets:
+        if band_has_mask(dataset):
+            band_valid = read_masks_cached(dataset, 1, window=window) != 0
+            valid = band_valid if valid is None else valid & band_valid
+    if transparency is not None:
+        opaque = transparency_window_mask(transparency, datasets[0].transform, window)
+        valid = opaque if valid is None else valid & opaque
+    return valid
+
+
+def grid_validity(raster_paths, grid_key, transparency=None):
+    """
+    Computes window_validity() over the full grid for the bands of raster_paths lying on the grid grid_key
+    (see band_grid_key()).
+    """
+    datasets = [rasterio.open(path) for path in raster_paths if path]
+    try:
+        return window_validity([dataset for dataset in datasets if band_grid_key(dataset) == grid_key], transparency=transparency)
+    finally:
+        for dataset in datasets:
+            dataset.close()
+
+
+# Plot-mask cache (see plot_mask_cache.py); set PLOT_MASK_CACHE_FOLDER to None to disable it
+PLOT_MASK_CACHE_FOLDER = DEFAULT_CACHE_FOLDER
+PLOT_MASK_CACHE_MAX_GB = DEFAULT_MAX_CACHE_GB
+
+
+def plot_masks_for_grid(shp_crs, transform, width, height):
+    """
+    Returns the read window and pixel mask of every plot on a band grid, as plot_window() and
+    geometry_mask() give them. The result is taken from the plot-mask cache when the same plots
+    were used on the same grid before, and stored in it otherwise.
+
+    Parameters:
+    - shp_crs (GeoDataFrame): Plot polygons in the raster CRS.
+    - transform (Affine): Affine transform of the band grid.
+    - width, height (int): Size of the band grid.
+
+    Returns:
+    - list: One (Window, boolean mask of the window) per plot, or (None, None) for empty
+      geometries and plots outside the raster.
+    """
+    key = plot_mask_key(shp_crs.geometry, shp_crs.crs, transform, (height, width))
+    cached = load_cached_plot_masks(key, PLOT_MASK_CACHE_FOLDER)
+    if cached is not None:
+        return [(Window(*window), mask) if window else (None, None) for window, mask in cached]
+
+    plot_masks = []
+    for geom in shp_crs.geometry:
+        window = None if geom is None or geom.is_empty else plot_window(geom, transform, width, height)
+        if window is None:
+            plot_masks.append((None, None))
+            continue
+        window_transform = rasterio.windows.transform(window, transform)
+        mask = geometry_mask([geom], transform=window_transform, invert=True, out_shape=(window.height, window.width))
+        plot_masks.append((window, mask))
+
+    save_cached_plot_masks(
+        key,
+        [((window.col_off, window.row_off, window.width, window.height), mask) if window else (None, None) for window, mask in plot_masks],
+        PLOT_MASK_CACHE_FOLDER, PLOT_MASK_CACHE_MAX_GB
+    )
+    return plot_masks
+
+
+def masked_band_statistics(band_array, mask, valid=None):
+    """
+    Computes the calculate_band_statistics() outputs for a precomputed plot mask (see plot_masks_for_grid()),
+    leaving out the pixels where the optional valid mask (see window_validity()) is False.
+    """
+    if mask is not None and valid is not None:
+        mask = mask & valid
+    if mask is None or not mask.any():
+        print("Warning: No valid pixels found in the plot mask")
+        return {stat: np.nan for stat in STATISTICS_LIST}
+
+    return band_statistics_from_values(band_array[mask])
+
+
+def plot_coverage(geom, window, transform):
+    """
+    Computes the exact fraction of every pixel of a window covered by a geometry.
+
+    Pixels not crossed by the geometry boundary are fully inside or fully outside, and are taken from
+    the centre-of-pixel mask. Only the pixels the boundary passes through are intersected with the
+    geometry, as one vectorized shapely operation on their pixel boxes.
+
+    Parameters:
+    - geom (shapely.geometry): Plot geometry in the raster CRS.
+    - window (Window): Window of the band grid covering the geometry (see plot_window()).
+    - transform (Affine): Affine transform of the band grid.
+
+    Returns:
+    - np.ndarray: float32 (window.height, window.width) array of coverage fractions in [0, 1].
+    """
+    shape = (window.height, window.width)
+    window_transform = rasterio.windows.transform(window, transform)
+
+    coverage = geometry_mask([geom], transform=window_transform, invert=True, out_shape=shape).astype(np.float32)
+    boundary = rasterize([geom.boundary], out_shape=shape, transform=window_transform, all_touched=True, fill=0, dtype="uint8")
+    rows, cols = np.nonzero(boundary)
+    if rows.size == 0:
+        return coverage
+
+    # Pixel corners (handles any axis orientation)
+    a, b, c, d, e, f = window_transform[:6]
+    x0, y0 = c + a * cols + b * rows, f + d * cols + e * rows
+    x1, y1 = c + a * (cols + 1) + b * (rows + 1), f + d * (cols + 1) + e * (rows + 1)
+    pixel_boxes = shapely.box(np.minimum(x0, x1), np.minimum(y0, y1), np.maximum(x0, x1), np.maximum(y0, y1))
+
+    pixel_area = abs(a * e - b * d)
+    coverage[rows, cols] = np.clip(shapely.area(shapely.intersection(pixel_boxes, geom)) / pixel_area, 0, 1)
+    return coverage
+
+
+def plot_coverage_for_grid(shp_crs, transform, width, height):
+    """
+    Returns the read window and pixel coverage fractions of every plot on a band grid, from the
+    plot-mask cache when the same plots were used on the same grid before (stored in it otherwise).
+
+    Parameters:
+    - shp_crs (GeoDataFrame): Plot polygons in the raster CRS.
+    - transform (Affine): Affine transform of the band grid.
+    - width, height (int): Size of the band grid.
+
+    Returns:
+    - list: One (Window, float32 coverage array of the window) per plot, or (None, None) for empty
+      geometries and plots outside the raster.
+    """
+    key = plot_mask_key(shp_crs.geometry, shp_crs.crs, transform, (height, width), kind="coverage")
+    cached = load_cached_plot_coverage(key, PLOT_MASK_CACHE_FOLDER)
+    if cached is not None:
+        return [(Window(*window), coverage) if window else (None, None) for window, coverage in cached]
+
+    plot_coverages = []
+    for geom in shp_crs.geometry:
+        window = None if geom is None or geom.is_empty else plot_window(geom, transform, width, height)
+        if window is None:
+            plot_coverages.append((None, None))
+            continue
+        plot_coverages.append((window, plot_coverage(geom, window, transform)))
+
+    save_cached_plot_coverage(
+        key,
+        [((window.col_off, window.row_off, window.width, window.height), coverage) if window else (None, None) for window, coverage in plot_coverages],
+        PLOT_MASK_CACHE_FOLDER, PLOT_MASK_CACHE_MAX_GB
+    )
+    return plot_coverages
+
+
+def coverage_weighted_band_statistics(band_array, coverage, valid=None):
+    """
+    Computes the coverage-weighted statistics of a plot window (see plot_coverage_for_grid()),
+    giving zero weight to the pixels where the optional valid mask (see window_validity()) is False.
+    """
+    if coverage is not None and valid is not None:
+        coverage = np.where(valid, coverage, 0)
+    if coverage is None or not (coverage > 0).any():
+        print("Warning: No valid pixels found in the plot coverage")
+        return {stat: np.nan for stat in STATISTICS_LIST}
+
+    return weighted_band_statistics_from_values(band_array, coverage)
+
+
+def allocate_stats_block(stats_df):
+    """
+    Preallocates a float block with the contents of stats_df, so the extraction engines write each
+    plot's statistics into numpy rows instead of assigning stats_df rows one at a time with .loc.
+
+    Parameters:
+    - stats_df (DataFrame): Output DataFrame indexed by plot ID.
+
+    Returns:
+    - tuple: (block, row_positions, column_positions), where row_positions maps each plot ID to its
+      row indices and column_positions maps each column name to its column index.
+    """
+    block = stats_df.astype(float).to_numpy(copy=True)
+
+    row_positions = {}
+    for row, plot_id in enumerate(stats_df.index):
+        row_positions.setdefault(plot_id, []).append(row)
+
+    column_positions = {column: i for i, column in enumerate(stats_df.columns)}
+    return block, row_positions, column_positions
+
+
+def write_plot_stats_to_block(block, row_positions, column_positions, plot_id, plot_stats):
+    """
+    Writes the statistics of one plot into the block from allocate_stats_block().
+
+    Parameters:
+    - plot_id: Plot ID (an index value of stats_df).
+    - plot_stats (dict): {band: {stat_name: value}}.
+    """
+    rows = row_positions[plot_id]
+    for band_name, band_stats in plot_stats.items():
+        columns = [column_positions[f"{band_name}_{stat}"] for stat in band_stats.keys()]
+        block[np.ix_(rows, columns)] = list(band_stats.values())
+
+
+def flush_stats_block(stats_df, block):
+    """Copies the block back into stats_df in one assignment, leaving every column float64."""
+    stats_df[list(stats_df.columns)] = block
+
+
+@precise_timing_decorator
+def process_rasters_windowed(shp, project_name, flight, green_raster_path, nir_raster_path, red_raster_path, \
+                             rededge_raster_path, blue_raster_path, rgb_raster_thumb_path, \
+                             stats_df, plot_geom = "none", checkpoint=None, indices=("NDVI",), coverage_weights=False, \
+                             transparency_mask_path=None):
+    """
+    Windowed version of process_rasters(): only the window covering each plot is read, in the native dtype,
+    through the block cache (see block_cache.py). Nodata pixels and pixels outside the transparent mosaic are left out.
+
+    Parameters (the others as process_rasters()):
+    - checkpoint (sqlite3.Connection, optional): Checkpoint store (see extraction_checkpoint.open_checkpoint_store());
+      finished plots are committed to it and plots already stored for this flight are not recomputed.
+    - indices (list or dict): Vegetation indices, see vegetation_indices.resolve_indices().
+    - coverage_weights (bool): Weight every pixel by the fraction of it covered by the plot
+      (see plot_coverage_for_grid()) instead of counting it in or out by its centre.
+    - transparency_mask_path (str, optional): Transparent mosaic whose background is left out.
+    - plot_geom (str): "none", "ortho", "shp" or "preview" (see progress_preview.ProgressPreview).
+    """
+    band_paths = {"red": red_raster_path, "green": green_raster_path, "nir": nir_raster_path, "rededge": rededge_raster_path, "blue": blue_raster_path}
+
+    with BandStack(band_paths, reference="red", cached=True) as stack:
+        red = stack.datasets["red"]
+
+        # Ensure shapefile matches raster CRS
+        shp_crs = ensure_crs_alignment(shp, red.crs)
+
+        bands = stack.datasets
+
+        compiled_indices = resolve_indices(indices)
+        index_bands = required_bands(compiled_indices)
+        missing_bands = [band_name for band_name in index_bands if band_name not in bands]
+        if missing_bands:
+            raise ValueError(f"The requested indices need missing bands: {', '.join(missing_bands)}")
+
+        # Bands read together on the red window: all bands on the red grid, and the index bands resampled to it
+        stacked_bands = [band_name for band_name in bands if stack.on_grid[band_name] or band_name in index_bands]
+        off_grid_index_bands = [band_name for band_name in index_bands if not stack.on_grid[band_name]]
+
+        # Plots finished by an earlier, interrupted run
+        checkpointed = load_checkpoint(checkpoint, flight) if checkpoint is not None else {}
+        expected_bands = {*compiled_indices, *bands}
+
+        # Track processed polygons by ID
+        processed_ids = []
+        preview = ProgressPreview(shp_crs, ortho_path=rgb_raster_thumb_path, title=f"{project_name} {flight}") if plot_geom == "preview" else None
+
+        block, row_positions, column_positions = allocate_stats_block(stats_df)
+
+        # Bands on each grid, and the transparent mosaic masking the background
+        grid_bands = {}
+        for band_ in bands.values():
+            grid_bands.setdefault(band_grid_key(band_), []).append(band_)
+        transparency = open_transparency_mask(transparency_mask_path)
+
+        # Plot windows and masks (or coverage fractions) per band grid (normally all bands share the red grid)
+        grid_masks = {}
+        if coverage_weights:
+            masks_for_grid, plot_statistics = plot_coverage_for_grid, coverage_weighted_band_statistics
+        else:
+            masks_for_grid, plot_statistics = plot_masks_for_grid, masked_band_statistics
+
+        def masks_for(band_):
+            grid_key = band_grid_key(band_)
+            if grid_key not in grid_masks:
+                grid_masks[grid_key] = masks_for_grid(shp_crs, band_.transform, band_.width, band_.height)
+            return grid_masks[grid_key]
+
+        # Valid pixels of the current plot window, per band grid
+        plot_validity = {}
+
+        def validity_for(band_, window):
+            grid_key = band_grid_key(band_)
+            if grid_key not in plot_validity:
+                plot_validity[grid_key] = window_validity(grid_bands[grid_key], window, transparency)
+            return plot_validity[grid_key]
+
+        for i, geom in enumerate(shp_crs.geometry):
+            start_time = time.time()
+
+            plot_id = shp_crs['id'].iloc[i]
+
+            if expected_bands.issubset(checkpointed.get(str(plot_id), {})):
+                write_plot_stats_to_block(block, row_positions, column_positions, plot_id, checkpointed[str(plot_id)])
+                processed_ids.append(plot_id)
+                if preview:
+                    preview.processed(i)
+                continue
+
+            print(f"Processing geometry {i + 1}/{len(shp_crs)} (ID: {plot_id})")
+
+            if plot_geom == "ortho":
+                plot_with_highlighted_ortho_geometry(shp_crs, plot_id, 'processing', processed_ids, ortho_path=rgb_raster_thumb_path, project_name=project_name, flight=flight)
+            elif plot_geom == "shp":
+                plot_with_highlighted_shp_geometry(shp_crs, plot_id, 'processing', processed_ids, highlight_color='red', edgewidth=3, default_color='lightblue')
+            elif preview:
+                preview.processing(i)
+
+            if geom is None or geom.is_empty or geom.area == 0:
+                print(f"Geometry {plot_id} is empty or invalid. Skipping.")
+                if preview:
+                    preview.skipped(i)
+                continue
+
+            # The indices are computed on the red grid, as NDVI in process_rasters()
+            red_window, red_mask = masks_for(red)[i]
+            if red_window is None:
+                print(f"Geometry {plot_id} does not intersect the raster extent.")
+                if checkpoint is not None:
+                    save_plot_checkpoint(checkpoint, flight, plot_id, {band_name: EMPTY_PLOT_STATISTICS for band_name in expected_bands})
+                if preview:
+                    preview.skipped(i)
+                continue
+
+            plot_validity.clear()
+            on_red_grid = dict(zip(stacked_bands, stack.read(red_window, bands=stacked_bands)))
+            red_valid = validity_for(red, red_window)
+
+            index_valid = red_valid
+            if off_grid_index_bands:
+                off_grid_valid = stack.read_masks(red_window, bands=off_grid_index_bands)
+                if off_grid_valid is not None:
+                    index_valid = off_grid_valid if red_valid is None else red_valid & off_grid_valid
+
+            plot_stats = {
+                index_name: plot_statistics(evaluate_index(index, on_red_grid), red_mask, index_valid)
+                for index_name, index in compiled_indices.items()
+            }
+
+            for band_name, band_ in bands.items():
+                if stack.on_grid[band_name]:
+                    band_array, mask, valid = on_red_grid[band_name], red_mask, red_valid
+                else:
+                    window, mask = masks_for(band_)[i]
+                    if window is None:
+                        print(f"Geometry {plot_id} does not intersect the {band_name} raster extent.")
+                        plot_stats[band_name] = EMPTY_PLOT_STATISTICS
+                        continue
+                    band_array = read_cached(band_, 1, window=window)
+                    valid = validity_for(band_, window)
+
+                plot_stats[band_name] = plot_statistics(band_array, mask, valid)
+
+            write_plot_stats_to_block(block, row_positions, column_positions, plot_id, plot_stats)
+
+            if checkpoint is not None:
+                save_plot_checkpoint(checkpoint, flight, plot_id, plot_stats)
+
+            # Update the status of the geometry to 'processed'
+            processed_ids.append(plot_id)
+            if preview:
+                preview.processed(i)
+
+            end_time = time.time()
+            print(f"⏳ Loop execution time: {end_time - start_time:.4f} seconds")
+
+        flush_stats_block(stats_df, block)
+
+        if plot_geom == "ortho":
+            plot_with_highlighted_ortho_geometry(shp_crs, plot_id, 'Processing Complete', processed_ids, ortho_path=rgb_raster_thumb_path, project_name=project_name, flight=flight)
+        elif plot_geom == "shp":
+            plot_with_highlighted_shp_geometry(shp_crs, plot_id, 'Processing Complete', processed_ids, highlight_color='red', edgewidth=3, default_color='lightblue')
+        elif preview:
+            preview.close()
+
+        if transparency:
+            transparency.close()
+
+    gc.collect()  # Force garbage collection
+
+
+def rasterize_plot_labels(geometries, transform, out_shape):
+    """
+    Burns all plot geometries into a single integer label raster aligned with a band grid.
+
+    Pixel values are 1..n for the n geometries (in the given order) and 0 for background.
+    Pixels are assigned by centre-of-pixel inclusion, exactly as geometry_mask() does.
+    Where plots overlap, the pixel is assigned to the later plot.
+
+    Parameters:
+    - geometries (iterable): Plot geometries in the raster CRS.
+    - transform (Affine): Affine transform of the band grid.
+    - out_shape (tuple): (height, width) of the band grid.
+
+    Returns:
+    - np.ndarray: int32 label raster of shape out_shape.
+    """
+    shapes = [
+        (geom, label) for label, geom in enumerate(geometries, start=1)
+        if geom is not None and not geom.is_empty
+    ]
+    if not shapes:
+        return np.zeros(out_shape, dtype=np.int32)
+
+    return rasterize(shapes, out_shape=out_shape, transform=transform, fill=0, dtype="int32")
+
+
+def labels_from_plot_masks(plot_masks, out_shape):
+    """
+    Builds the label raster of rasterize_plot_labels() from the plot windows and masks of plot_masks_for_grid().
+
+    Parameters:
+    - plot_masks (list): Output of plot_masks_for_grid(), in plot order.
+    - out_shape (tuple): (height, width) of the band grid.
+
+    Returns:
+    - np.ndarray: int32 label raster of shape out_shape (1..n for the plots, 0 for background;
+      overlapping pixels go to the later plot).
+    """
+    labels = np.zeros(out_shape, dtype=np.int32)
+    for label, (window, mask) in enumerate(plot_masks, start=1):
+        if window is None:
+            continue
+        labels[window.row_off:window.row_off + window.height, window.col_off:window.col_off + window.width][mask] = label
+    return labels
+
+
+@precise_timing_decorator
+def grouped_band_statistics(band_array, labels, n_labels):
+    """
+    Computes all calculate_band_statistics() outputs for every plot of a label raster in one pass,
+    from a single sort of the in-plot pixels by (plot, value).
+
+    Parameters:
+    - band_array (np.ndarray): 2D band (or index) array, or a vector of pixel values.
+    - labels (np.ndarray): Label raster from rasterize_plot_labels() (or the labels of the pixel vector), same shape as band_array.
+    - n_labels (int): Number of plots (highest label).
+
+    Returns:
+    - dict: {stat_name: np.ndarray of length n_labels}, in STATISTICS_LIST order.
+            Entry k holds the statistics of label k + 1. Plots without pixels are all NaN.
+    """
+    if band_array.shape != labels.shape:
+        raise ValueError("band_array and labels must have the same shape.")
+
+    flat_labels = labels.ravel()
+    in_plot = flat_labels > 0
+    group = flat_labels[in_plot].astype(np.int64) - 1
+    values = band_array.ravel()[in_plot].astype(float)
+
+    # Sort once by plot, then by value (NaNs go last within each plot)
+    order = np.lexsort((values, group))
+    group = group[order]
+    values = values[order]
+    valid = ~np.isnan(values)
+
+    count = np.bincount(group, minlength=n_labels)
+    starts = np.concatenate(([0], np.cumsum(count)[:-1]))
+    # Moments (population variance, as np.nanvar)
+    n_valid, total, m2, m3, m4 = grouped_moments(values, starts, count)
+    has_pixels = count > 0
+    has_valid = n_valid > 0
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = np.where(has_valid, total / n_valid, np.nan)
+        variance = np.where(has_valid, m2 / n_valid, np.nan)
+        std = np.sqrt(variance)
+        cv = np.where(mean != 0, std / mean, np.nan)
+    skewness, kurtosis = _sample_skew_kurtosis(n_valid, m2, m3, m4)
+
+    def quantile(q):
+        """Linear-interpolated quantile of the valid values of every plot (as np.nanpercentile)."""
+        position = q * np.maximum(n_valid - 1, 0)
+        lower = np.floor(position).astype(np.int64)
+        upper = np.minimum(lower + 1, np.maximum(n_valid - 1, 0))
+        fraction = position - lower
+        if values.size == 0:
+            return np.full(n_labels, np.nan)
+        lower_values = values[np.minimum(starts + lower, values.size - 1)]
+        upper_values = values[np.minimum(starts + upper, values.size - 1)]
+        return np.where(has_valid, lower_values + fraction * (upper_values - lower_values), np.nan)
+
+    # Runs of identical values within each plot (NaNs form a single run, as in np.unique)
+    if values.size:
+        same_as_previous = (values[1:] == values[:-1]) | (~valid[1:] & ~valid[:-1])
+        run_start = np.flatnonzero(np.concatenate(([True], (group[1:] != group[:-1]) | ~same_as_previous)))
+        run_length = np.diff(np.append(run_start, values.size))
+        run_group = group[run_start]
+        run_value = values[run_start]
+
+        def first_run_per_group(order):
+            ordered_groups = run_group[order]
+            first = np.concatenate(([True], ordered_groups[1:] != ordered_groups[:-1]))
+            result = np.full(n_labels, np.nan)
+            result[ordered_groups[first]] = run_value[order][first]
+            return result
+
+        # Longest run first (ties: smallest value), as np.argmax over np.unique counts
+        majority = first_run_per_group(np.lexsort((run_start, -run_length, run_group)))
+        # Shortest run first (ties: smallest value), as np.argmin over np.unique counts
+        minority = first_run_per_group(np.lexsort((run_start, run_length, run_group)))
+        variety = np.bincount(run_group, minlength=n_labels).astype(float)
+    else:
+        majority = minority = variety = np.full(n_labels, np.nan)
+
+    minimum = quantile(0.0)
+    maximum = quantile(1.0)
+    q25 = quantile(0.25)
+    q75 = quantile(0.75)
+
+    # Top fractions: pixels ranked from the top of their plot's sorted valid values
+    top_stats = {}
+    valid_group = group[valid]
+    valid_values = values[valid]
+    rank_from_top = (starts + n_valid)[valid_group] - 1 - np.flatnonzero(valid)
+    for fraction in TOP_FRACTIONS:
+        k = _top_fraction_count(n_valid, fraction)
+        in_top = rank_from_top < k[valid_group]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            top_mean = np.bincount(valid_group[in_top], weights=valid_values[in_top], minlength=n_labels) / k
+            top_deviation = valid_values[in_top] - top_mean[valid_group[in_top]]
+            top_variance = np.bincount(valid_group[in_top], weights=top_deviation ** 2, minlength=n_labels) / k
+
+        # Median of the top k values of each plot, at positions (k - 1) / 2 of its tail
+        position = (k - 1) / 2
+        lower = np.floor(position).astype(np.int64)
+        tail_start = starts + n_valid - k
+        if values.size:
+            lower_values = values[np.clip(tail_start + lower, 0, values.size - 1)]
+            upper_values = values[np.clip(tail_start + np.minimum(lower + 1, k - 1), 0, values.size - 1)]
+            top_median = lower_values + (position - lower) * (upper_values - lower_values)
+        else:
+            top_median = np.full(n_labels, np.nan)
+
+        top_stats[f"top_{fraction}_mean"] = np.where(has_valid, top_mean, np.nan)
+        top_stats[f"top_{fraction}_median"] = np.where(has_valid, top_median, np.nan)
+        top_stats[f"top_{fraction}_std"] = np.where(has_valid, np.sqrt(top_variance), np.nan)
+
+    stats = {
+        "count": count.astype(float),
+        "sum": total,
+        "mean": mean,
+        "median": quantile(0.5),
+        "std": std,
+        "min": minimum,
+        "max": maximum,
+        "range": maximum - minimum,
+        "minority": minority,
+        "majority": majority,
+        "variety": variety,
+        "variance": variance,
+        "cv": cv,
+        "skewness": skewness,
+        "kurtosis": kurtosis,
+        "top_10": quantile(0.90),
+        "top_15": quantile(0.85),
+        "top_20": quantile(0.80),
+        "top_25": q75,
+        "top_35": quantile(0.65),
+        "top_50": quantile(0.50),
+        "q25": q25,
+        "q75": q75,
+        "iqr": q75 - q25,
+        **top_stats,
+    }
+
+    # Plots that received no pixels at all get NaN for every statistic
+    return {stat: np.where(has_pixels, stats[stat], np.nan) for stat in STATISTICS_LIST}
+
+
+@precise_timing_decorator
+def process_rasters_labelled(shp, project_name, flight, green_raster_path, nir_raster_path, red_raster_path, \
+                             rededge_raster_path, blue_raster_path, rgb_raster_thumb_path, \
+                             stats_df, plot_geom = "none", checkpoint=None, indices=("NDVI",), transparency_mask_path=None):
+    """
+    Label-raster version of process_rasters(): the plots are burnt once into a label raster and every band is
+    read once, with the statistics of all plots computed by grouped_band_statistics(). Overlapping plots are
+    not supported (the shared pixels go to one plot only).
+
+    Parameters: as process_rasters_windowed(). With a checkpoint store, every finished band is committed
+    for all plots, and bands already stored for this flight are not recomputed.
+    """
+    raster_paths = {"red": red_raster_path, "green": green_raster_path, "nir": nir_raster_path, "rededge": rededge_raster_path}
+    if blue_raster_path:
+        raster_paths["blue"] = blue_raster_path
+
+    with rasterio.open(red_raster_path) as red:
+        shp_crs = ensure_crs_alignment(shp, red.crs)
+
+    plot_ids = shp_crs['id'].to_numpy()
+    n_plots = len(shp_crs)
+
+    # Label rasters, one per distinct band grid (normally all bands share the red grid)
+    label_rasters = {}
+
+    def labels_for(dataset):
+        grid_key = band_grid_key(dataset)
+        if grid_key not in label_rasters:
+            print(f"Labelling {n_plots} plots on a {dataset.width} x {dataset.height} grid")
+            plot_masks = plot_masks_for_grid(shp_crs, dataset.transform, dataset.width, dataset.height)
+            labels = labels_from_plot_masks(plot_masks, dataset.shape)
+            transparency = open_transparency_mask(transparency_mask_path)
+            valid = grid_validity(raster_paths.values(), grid_key, transparency)
+            if transparency:
+                transparency.close()
+            if valid is not None:
+                labels[~valid] = 0
+            label_rasters[grid_key] = labels
+        return label_rasters[grid_key]
+
+    def write_stats(prefix, stats):
+        columns = [f"{prefix}_{stat}" for stat in stats.keys()]
+        stats_df.loc[plot_ids, columns] = np.column_stack(list(stats.values()))
+
+    # Bands finished by an earlier, interrupted run
+    checkpointed = load_checkpoint(checkpoint, flight) if checkpoint is not None else {}
+
+    def band_checkpointed(band_name):
+        return checkpoint is not None and all(band_name in checkpointed.get(str(plot_id), {}) for plot_id in plot_ids)
+
+    def restore_band(band_name):
+        print(f"📌 {band_name} statistics restored from checkpoint.")
+        write_stats(band_name, {
+            stat: np.array([checkpointed[str(plot_id)][band_name][stat] for plot_id in plot_ids], dtype=float)
+            for stat in STATISTICS_LIST
+        })
+
+    def finish_band(band_name, stats):
+        write_stats(band_name, stats)
+        if checkpoint is not None:
+            save_band_checkpoint(checkpoint, flight, band_name, plot_ids, stats)
+
+    compiled_indices = resolve_indices(indices)
+    pending_indices = {name: index for name, index in compiled_indices.items() if not band_checkpointed(name)}
+    index_bands = required_bands(pending_indices)
+    missing_bands = [band_name for band_name in index_bands if band_name not in raster_paths]
+    if missing_bands:
+        raise ValueError(f"The requested indices need missing bands: {', '.join(missing_bands)}")
+
+    with rasterio.open(red_raster_path) as red:
+        red_labels = labels_for(red)
+    in_plot = red_labels.ravel() > 0
+
+    # Pixel values inside the plots of the bands used by the indices
+    index_band_values = {}
+
+    for band_name, path in raster_paths.items():
+        if band_checkpointed(band_name) and band_name not in index_bands:
+            restore_band(band_name)
+            continue
+
+        with rasterio.open(path) as band_:
+            band_array = band_.read(1)
+            if band_name in index_bands:
+                if band_array.shape != red_labels.shape:
+                    raise ValueError(f"The {band_name} band is not on the red band grid; indices need aligned bands.")
+                index_band_values[band_name] = band_array.ravel()[in_plot].astype(np.float32)
+
+            if band_checkpointed(band_name):
+                restore_band(band_name)
+            else:
+                finish_band(band_name, grouped_band_statistics(band_array, labels_for(band_), n_plots))
+        del band_array
+
+    plot_labels = red_labels.ravel()[in_plot]
+    for index_name, index in compiled_indices.items():
+        if index_name not in pending_indices:
+            restore_band(index_name)
+            continue
+        finish_band(index_name, grouped_band_statistics(evaluate_index(index, index_band_values), plot_labels, n_plots))
+    del index_band_values
+
+    if plot_geom == "ortho":
+        plot_with_highlighted_ortho_geometry(shp_crs, plot_ids[-1], 'Processing Complete', list(plot_ids), ortho_path=rgb_raster_thumb_path, project_name=project_name, flight=flight)
+    elif plot_geom == "shp":
+        plot_with_highlighted_shp_geometry(shp_crs, plot_ids[-1], 'Processing Complete', list(plot_ids), highlight_color='red', edgewidth=3, default_color='lightblue')
+
+    gc.collect()  # Force garbage collection
+
+
+### Block-streaming extraction
+# Mosaics too large to hold in memory are read once, in the native blocks of the red band. The pixels of
+# every block are added to per-plot streaming accumulators (stat_kernels.PlotHistogramAccumulator), so
+# memory depends on the block size, the number of plots and the histogram bins, never on the mosaic size.
+
+# Histogram bins per plot and band of the streaming mode
+STREAM_HISTOGRAM_BINS = HISTOGRAM_BINS
+
+# Minimum rows per read: the native blocks of striped files (often one row high) are read together
+STREAM_MIN_BLOCK_ROWS = 256
+
+# Quantiles of STATISTICS_LIST read from the histograms
+STREAM_QUANTILES = (0.25, 0.5, 0.65, 0.75, 0.8, 0.85, 0.9)
+
+
+def streamed_band_statistics(accumulator, rows):
+    """
+    Derives the STATISTICS_LIST fields of some plots from a PlotHistogramAccumulator.
+    The moments, count, min and max are exact; the quantile and top-fraction statistics are within one
+    bin width of the exact values, and majority, minority and variety describe the binned values.
+
+    Parameters:
+    - accumulator (PlotHistogramAccumulator): Accumulated pixels of one band or index.
+    - rows (np.ndarray): Plot indices.
+
+    Returns:
+    - dict: {stat_name: np.ndarray of length len(rows)}, in STATISTICS_LIST order. Plots without pixels are all NaN.
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    count = accumulator.count[rows].astype(float)
+    n_valid = accumulator.n_valid[rows]
+    m2, m3, m4 = accumulator.m2[rows], accumulator.m3[rows], accumulator.m4[rows]
+    has_pixels = count > 0
+    has_valid = n_valid > 0
+
+    top_counts = np.column_stack([_top_fraction_count(n_valid, fraction) for fraction in TOP_FRACTIONS])
+    summary = accumulator.summary(rows, STREAM_QUANTILES, top_counts)
+    quantile = dict(zip(STREAM_QUANTILES, summary["quantiles"].T))
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = np.where(has_valid, accumulator.mean[rows], np.nan)
+        variance = np.where(has_valid, m2 / n_valid, np.nan)
+        std = np.sqrt(variance)
+        cv = np.where(mean != 0, std / mean, np.nan)
+    skewness, kurtosis = _sample_skew_kurtosis(n_valid, m2, m3, m4)
+    minimum = np.where(has_valid, accumulator.minimum[rows], np.nan)
+    maximum = np.where(has_valid, accumulator.maximum[rows], np.nan)
+
+    # NaNs are one more value: the majority (or minority) when more (or fewer) pixels are NaN than in any bin
+    n_nan = count - n_valid
+    majority = np.where(n_nan > summary["majority_count"], np.nan, summary["majority"])
+    minority = np.where((n_nan > 0) & (n_nan < summary["minority_count"]), np.nan, summary["minority"])
+
+    top_stats = {}
+    for k, fraction in enumerate(TOP_FRACTIONS):
+        top_stats[f"top_{fraction}_mean"] = summary["top_mean"][:, k]
+        top_stats[f"top_{fraction}_median"] = summary["top_median"][:, k]
+        top_stats[f"top_{fraction}_std"] = summary["top_std"][:, k]
+
+    stats = {
+        "count": count,
+        "sum": np.where(has_valid, accumulator.mean[rows] * n_valid, 0.0),
+        "mean": mean,
+        "median": quantile[0.5],
+        "std": std,
+        "min": minimum,
+        "max": maximum,
+        "range": maximum - minimum,
+        "minority": minority,
+        "majority": majority,
+        "variety": summary["occupied"] + (count > n_valid),
+        "variance": variance,
+        "cv": cv,
+        "skewness": skewness,
+        "kurtosis": kurtosis,
+        "top_10": quantile[0.9],
+        "top_15": quantile[0.85],
+        "top_20": quantile[0.8],
+        "top_25": quantile[0.75],
+        "top_35": quantile[0.65],
+        "top_50": quantile[0.5],
+        "q25": quantile[0.25],
+        "q75": quantile[0.75],
+        "iqr": quantile[0.75] - quantile[0.25],
+        **top_stats,
+    }
+    return {stat: np.where(has_pixels, stats[stat], np.nan) for stat in STATISTICS_LIST}
+
+
+@precise_timing_decorator
+def process_rasters_streaming(shp, project_name, flight, green_raster_path, nir_raster_path, red_raster_path, \
+                              rededge_raster_path, blue_raster_path, rgb_raster_thumb_path, \
+                              stats_df, plot_geom = "none", checkpoint=None, indices=("NDVI",), transparency_mask_path=None, \
+                              n_bins=STREAM_HISTOGRAM_BINS):
+    """
+    Block-streaming version of process_rasters() for mosaics that do not fit in memory: the blocks crossing
+    plots are read once and their in-plot pixels added to per-plot moments and histograms (see
+    streamed_band_statistics()). Overlapping plots keep all their pixels.
+
+    Parameters: as process_rasters_windowed(), and
+    - n_bins (int): Histogram bins per plot and band.
+    """
+    band_paths = {"red": red_raster_path, "green": green_raster_path, "nir": nir_raster_path, "rededge": rededge_raster_path, "blue": blue_raster_path}
+
+    with BandStack(band_paths, reference="red") as stack:
+        red = stack.datasets["red"]
+        shp_crs = ensure_crs_alignment(shp, red.crs)
+        plot_ids = shp_crs['id'].to_numpy()
+        n_plots = len(plot_ids)
+        bands = stack.band_names
+
+        compiled_indices = resolve_indices(indices)
+        index_bands = required_bands(compiled_indices)
+        missing_bands = [band_name for band_name in index_bands if band_name not in bands]
+        if missing_bands:
+            raise ValueError(f"The requested indices need missing bands: {', '.join(missing_bands)}")
+
+        # One accumulator per band and index; integer bands start with unit bins
+        accumulators = {
+            band_name: PlotHistogramAccumulator(n_plots, n_bins, integer=np.issubdtype(stack.datasets[band_name].dtypes[0], np.integer))
+            for band_name in bands
+        }
+        accumulators.update((index_name, PlotHistogramAccumulator(n_plots, n_bins)) for index_name in compiled_indices)
+
+        def write_stats(rows, name, stats):
+            columns = [f"{name}_{stat}" for stat in stats.keys()]
+            stats_df.loc[plot_ids[rows], columns] = np.column_stack(list(stats.values()))
+
+        preview = ProgressPreview(shp_crs, ortho_path=rgb_raster_thumb_path, title=f"{project_name} {flight}") if plot_geom == "preview" else None
+
+        # Plots finished by an earlier, interrupted run
+        checkpointed = load_checkpoint(checkpoint, flight) if checkpoint is not None else {}
+        summarised = np.array([set(accumulators).issubset(checkpointed.get(str(plot_id), {})) for plot_id in plot_ids], dtype=bool)
+        if summarised.any():
+            rows = np.flatnonzero(summarised)
+            print(f"📌 {len(rows)} plots restored from checkpoint.")
+            for name in accumulators:
+                write_stats(rows, name, {
+                    stat: np.array([checkpointed[str(plot_ids[i])][name][stat] for i in rows], dtype=float)
+                    for stat in STATISTICS_LIST
+                })
+
+        def summarise(rows):
+            for name, accumulator in accumulators.items():
+                stats = streamed_band_statistics(accumulator, rows)
+                write_stats(rows, name, stats)
+                if checkpoint is not None:
+                    save_band_checkpoint(checkpoint, flight, name, plot_ids[rows], stats)
+            summarised[rows] = True
+            if preview:
+                for i in rows:
+                    preview.processed(i)
+
+        plot_masks = plot_masks_for_grid(shp_crs, red.transform, red.width, red.height)
+        pending = np.array([i for i, (window, _) in enumerate(plot_masks) if window is not None and not summarised[i]], dtype=np.int64)
+        if preview:
+            for i in np.flatnonzero(summarised):
+                preview.processed(i)
+
+        # Plots without pixels on the grid are summarised (as NaN) right away
+        empty = np.array([i for i, (window, _) in enumerate(plot_masks) if window is None and not summarised[i]], dtype=np.int64)
+        if len(empty):
+            summarise(empty)
+
+        # Valid pixels: the masks of the bands on the red grid and of the resampled ones, and the transparent mosaic
+        on_grid_datasets = [stack.datasets[band_name] for band_name in bands if stack.on_grid[band_name]]
+        off_grid_bands = [band_name for band_name in bands if not stack.on_grid[band_name]]
+        transparency = open_transparency_mask(transparency_mask_path)
+
+        try:
+            if len(pending):
+                first_row = np.array([plot_masks[i][0].row_off for i in pending])
+                stop_row = np.array([plot_masks[i][0].row_off + plot_masks[i][0].height for i in pending])
+                first_col = np.array([plot_masks[i][0].col_off for i in pending])
+                stop_col = np.array([plot_masks[i][0].col_off + plot_masks[i][0].width for i in pending])
+
+                block_height, block_width = red.block_shapes[0]
+                rows_per_read = block_height * math.ceil(STREAM_MIN_BLOCK_ROWS / block_height)
+                last_row = int(stop_row.max())
+                print(f"Streaming {len(pending)} plots in blocks of {rows_per_read} x {block_width} pixels ({red.width} x {red.height} grid)")
+
+                for row_start in range(int(first_row.min()) // rows_per_read * rows_per_read, last_row, rows_per_read):
+                    row_stop = min(row_start + rows_per_read, red.height)
+                    in_rows = (first_row < row_stop) & (stop_row > row_start)
+                    if in_rows.any():
+                        col_end = int(stop_col[in_rows].max())
+                        for col_start in range(int(first_col[in_rows].min()) // block_width * block_width, col_end, block_width):
+                            col_stop = min(col_start + block_width, red.width)
+                            crossing = pending[in_rows & (first_col < col_stop) & (stop_col > col_start)]
+                            if len(crossing) == 0:
+                                continue
+
+                            window = Window(col_start, row_start, col_stop - col_start, row_stop - row_start)
+                            block_values = stack.read(window, bands=bands)
+                            valid = window_validity(on_grid_datasets, window, transparency) if on_grid_datasets else None
+                            if off_grid_bands:
+                                off_grid_valid = stack.read_masks(window, bands=off_grid_bands)
+                                if off_grid_valid is not None:
+                                    valid = off_grid_valid if valid is None else valid & off_grid_valid
+
+                            # In-plot pixels of the block, per plot
+                            value_chunks, group_chunks = [], []
+                            for i in crossing:
+                                plot_window, mask = plot_masks[i]
+                                top, bottom = max(row_start, plot_window.row_off), min(row_stop, plot_window.row_off + plot_window.height)
+                                left, right = max(col_start, plot_window.col_off), min(col_stop, plot_window.col_off + plot_window.width)
+                                rows = slice(top - row_start, bottom - row_start)
+                                cols = slice(left - col_start, right - col_start)
+                                plot_mask = mask[top - plot_window.row_off:bottom - plot_window.row_off, left - plot_window.col_off:right - plot_window.col_off]
+                                if valid is not None:
+                                    plot_mask = plot_mask & valid[rows, cols]
+                                plot_values = block_values[:, rows, cols][:, plot_mask]
+                                value_chunks.append(plot_values)
+                                group_chunks.append(np.full(plot_values.shape[1], i, dtype=np.int64))
+                            del block_values, valid
+
+                            groups = np.concatenate(group_chunks)
+                            band_values = dict(zip(bands, np.concatenate(value_chunks, axis=1)))
+                            for band_name, values in band_values.items():
+                                accumulators[band_name].add(values, groups)
+                            index_inputs = {band_name: band_values[band_name].astype(np.float32) for band_name in index_bands}
+                            for index_name, index in compiled_indices.items():
+                                accumulators[index_name].add(evaluate_index(index, index_inputs), groups)
+
+                    finished = pending[(stop_row <= row_stop) & ~summarised[pending]]
+                    if len(finished):
+                        summarise(finished)
+        finally:
+            if transparency:
+                transparency.close()
+
+        if plot_geom == "ortho":
+            plot_with_highlighted_ortho_geometry(shp_crs, plot_ids[-1], 'Processing Complete', list(plot_ids), ortho_path=rgb_raster_thumb_path, project_name=project_name, flight=flight)
+        elif plot_geom == "shp":
+            plot_with_highlighted_shp_geometry(shp_crs, plot_ids[-1], 'Processing Complete', list(plot_ids), highlight_color='red', edgewidth=3, default_color='lightblue')
+        elif preview:
+            preview.close()
+
+    gc.collect()  # Force garbage collection
 
-            # Read bands as float
-            red_band = red.read(1).astype(float)
-            green_band = green.read(1).astype(float)
-            nir_band = nir.read(1).astype(float)
-            rededge_band = rededge.read(1).astype(float)
-            if blue:
-                blue_band = blue.read(1).astype(float) if blue_raster_path else None
 
-            # # Compute NDVI
-            # start_time_ndvi = time.time()  # Start timing before the loop
-            # ndvi = np.where((nir_band + red_band) != 0, (nir_band - red_band) / (nir_band + red_band), np.nan)
-            # end_time_ndvi = time.time()  # Stop timing after the loop
-            # print(f"⏳ NDVI Compute execution time: {end_time_ndvi - start_time_ndvi:.4f} seconds")
-            
-            # Compute NDVI (Numba optimized below) This is faster than the one above
-            ndvi = compute_ndvi_numba(nir_band, red_band)
+### Plant height (3D flights)
+# The canopy height model (CHM = DSM - DTM) is computed block by block on the DSM grid, with the DTM aligned
+# to that grid on the fly, and only the heights of the pixels inside plots are kept. No CHM raster is written,
+# and the plot statistics go through grouped_band_statistics() like the labelled engine.
 
+# Column prefix of the plant-height statistics
+HEIGHT_BAND = "height"
 
+# DSM rows read per block, and in-plot pixels buffered before the plots already read in full are summarised
+CHM_BLOCK_ROWS = 512
+CHM_FLUSH_PIXELS = 16_000_000
 
-            
-            """Check if a geometry is valid and intersects raster bounds."""
-            # Debugging: print geometry and bounds types
-            print(f"Validating geometry ID: {i + 1}")  # Print geometry ID (unique ID for the geometry object)
-            
-            if geom.is_empty or geom.area == 0:
-                return False, "Empty or invalid geometry."
-            # Confirming intersection between the shape file element and the raster
-            # Convert geometry bounds (tuple) to a shapely box
-            geom_box = box(*geom.bounds)
-            for band_ in [red, green, nir, rededge]:
-                # Convert raster bounds (BoundingBox) to a shapely box
-                raster_box = box(*band_.bounds)
-                
-                if not geom_box.intersects(raster_box):
-                    print(f"Geometry {i} does not intersect the raster extent.")
-                    continue
-    
-            # Calculate statistics
-            stats_df.loc[shp_crs['id'][i], [f"NDVI_{stat}" for stat in calculate_band_statistics(ndvi, geom, red.transform).keys()]] = \
-                list(calculate_band_statistics(ndvi, geom, red.transform).values())
+# Nodata given to the aligned DTM when the DTM has none (fits every DTM dtype, far below any terrain)
+DTM_FILL_NODATA = -32768
 
-            stats_df.loc[shp_crs['id'][i], [f"red_{stat}" for stat in calculate_band_statistics(red_band, geom, red.transform).keys()]] = \
-                list(calculate_band_statistics(red_band, geom, red.transform).values())
 
-            stats_df.loc[shp_crs['id'][i], [f"green_{stat}" for stat in calculate_band_statistics(green_band, geom, green.transform).keys()]] = \
-                list(calculate_band_statistics(green_band, geom, green.transform).values())
+def canopy_height_columns():
+    """Returns the output columns of process_canopy_height()."""
+    return [f"{HEIGHT_BAND}_{stat}" for stat in STATISTICS_LIST] + ["canopy_volume"]
 
-            stats_df.loc[shp_crs['id'][i], [f"nir_{stat}" for stat in calculate_band_statistics(nir_band, geom, nir.transform).keys()]] = \
-                list(calculate_band_statistics(nir_band, geom, nir.transform).values())
 
-            stats_df.loc[shp_crs['id'][i], [f"rededge_{stat}" for stat in calculate_band_statistics(rededge_band, geom, rededge.transform).keys()]] = \
-                list(calculate_band_statistics(rededge_band, geom, rededge.transform).values())
+def canopy_height_window(dsm, dtm, window):
+    """
+    Computes the canopy height of a window of the DSM grid.
 
-            if blue:
-                stats_df.loc[shp_crs['id'][i], [f"blue_{stat}" for stat in calculate_band_statistics(blue_band, geom, blue.transform).keys()]] = \
-                    list(calculate_band_statistics(blue_band, geom, blue.transform).values())
+    Parameters:
+    - dsm (DatasetReader): Open DSM.
+    - dtm (WarpedVRT): DTM aligned to the DSM grid.
+    - window (Window): Window of the DSM grid.
 
-            # Update the status of the geometry to 'processed'
-            processed_ids.append(shp_crs.iloc[i]['id'])
+    Returns:
+    - tuple: (float32 heights above the terrain, with heights below it set to 0,
+      boolean mask of the pixels valid in both models or None if every pixel is valid).
+    """
+    surface = dsm.read(1, window=window, out_dtype=np.float32)
+    terrain = dtm.read(1, window=window, out_dtype=np.float32)
+    heights = np.maximum(surface - terrain, 0, dtype=np.float32)
+    return heights, window_validity([dsm, dtm], window)
 
-            end_time = time.time()  # Stop timing after the loop
-            print(f"⏳ Loop execution time: {end_time - start_time:.4f} seconds")
 
-        highlight_status = 'Processing Complete'
-        if plot_geom == "ortho":
-            # Highlight the current ortho geometry being processed
-            plot_with_highlighted_ortho_geometry(shp_crs, shp_crs.iloc[i]['id'], highlight_status, processed_ids, ortho_path=rgb_raster_thumb_path, project_name=project_name, flight=flight)
-        elif plot_geom == "shp":
-            plot_with_highlighted_shp_geometry(shp_crs, shp_crs.iloc[i]['id'], highlight_status, processed_ids, highlight_color='red', edgewidth=3, default_color='lightblue')
+@precise_timing_decorator
+def process_canopy_height(shp, dsm_raster_path, dtm_raster_path, stats_df, flight=None, checkpoint=None, block_rows=CHM_BLOCK_ROWS):
+    """
+    Plant-height extraction for 3D flights: the canopy height (DSM - DTM, with the DTM resampled to the DSM
+    grid and heights below the terrain set to 0) is read in blocks, and only the in-plot heights are kept.
+    Writes the "height_<stat>" columns and "canopy_volume" (sum of the heights times the pixel area) into stats_df.
 
-    gc.collect()  # Force garbage collection
+    Parameters:
+    - shp (GeoDataFrame): Plot polygons with an 'id' column.
+    - dsm_raster_path (str): Path to the "_dsm.tif" surface model.
+    - dtm_raster_path (str): Path to the "_dtm.tif" terrain model.
+    - stats_df (DataFrame): Output DataFrame indexed by plot ID with the canopy_height_columns(), filled in place.
+    - flight (str, optional): Flight name, used as the checkpoint key.
+    - checkpoint (sqlite3.Connection, optional): Checkpoint store; summarised plots are committed to it
+      and plots already stored for this flight are not read again.
+    - block_rows (int): DSM rows per block.
+    """
+    with rasterio.open(dsm_raster_path) as dsm, rasterio.open(dtm_raster_path) as dtm_source:
+        shp_crs = ensure_crs_alignment(shp, dsm.crs)
+        plot_ids = shp_crs['id'].to_numpy()
+        n_plots = len(plot_ids)
+        pixel_area = abs(dsm.transform.determinant)
+
+        def write_stats(rows, stats):
+            columns = [f"{HEIGHT_BAND}_{stat}" for stat in stats.keys()]
+            stats_df.loc[plot_ids[rows], columns] = np.column_stack([values[rows] for values in stats.values()])
+            stats_df.loc[plot_ids[rows], "canopy_volume"] = stats["sum"][rows] * pixel_area
+
+        # Plots finished by an earlier, interrupted run
+        checkpointed = load_checkpoint(checkpoint, flight) if checkpoint is not None else {}
+        summarised = np.array([HEIGHT_BAND in checkpointed.get(str(plot_id), {}) for plot_id in plot_ids], dtype=bool)
+        if summarised.any():
+            rows = np.flatnonzero(summarised)
+            print(f"📌 {len(rows)} plots restored from checkpoint.")
+            stats = {stat: np.full(n_plots, np.nan) for stat in STATISTICS_LIST}
+            for stat, values in stats.items():
+                values[rows] = np.array([checkpointed[str(plot_ids[i])][HEIGHT_BAND][stat] for i in rows], dtype=float)
+            write_stats(rows, stats)
+
+        plot_masks = plot_masks_for_grid(shp_crs, dsm.transform, dsm.width, dsm.height)
+        pending = np.array([i for i, (window, _) in enumerate(plot_masks) if window is not None and not summarised[i]], dtype=np.int64)
+
+        # Plots without pixels on the DSM grid are checkpointed (as NaN) right away
+        empty = np.array([i for i, (window, _) in enumerate(plot_masks) if window is None and not summarised[i]], dtype=np.int64)
+        if len(empty) and checkpoint is not None:
+            save_band_checkpoint(checkpoint, flight, HEIGHT_BAND, plot_ids[empty], {stat: np.full(len(empty), np.nan) for stat in STATISTICS_LIST})
+        summarised[empty] = True
+        if len(pending) == 0:
+            return
+
+        first_row = np.array([plot_masks[i][0].row_off for i in pending])
+        stop_row = np.array([plot_masks[i][0].row_off + plot_masks[i][0].height for i in pending])
+        read_in_full = np.zeros(n_plots, dtype=bool)
+        label_chunks, height_chunks = [], []
+        buffered = 0
+
+        def summarise_read_plots():
+            """Summarises the buffered plots whose rows have all been read and keeps the others buffered."""
+            labels = np.concatenate(label_chunks)
+            heights = np.concatenate(height_chunks)
+            ready = read_in_full[labels - 1]
+            stats = grouped_band_statistics(heights[ready], labels[ready], n_plots)
+            rows = np.flatnonzero(read_in_full & ~summarised)
+            write_stats(rows, stats)
+            if checkpoint is not None:
+                save_band_checkpoint(checkpoint, flight, HEIGHT_BAND, plot_ids[rows], {stat: values[rows] for stat, values in stats.items()})
+            summarised[rows] = True
+            label_chunks[:] = [labels[~ready]]
+            height_chunks[:] = [heights[~ready]]
+            return int((~ready).sum())
+
+        # A DTM without nodata gets one, so the pixels outside it are masked
+        dtm_nodata = {} if band_has_mask(dtm_source) else {"nodata": DTM_FILL_NODATA}
+        with WarpedVRT(dtm_source, crs=dsm.crs, transform=dsm.transform, width=dsm.width, height=dsm.height,
+                       resampling=Resampling.bilinear, **dtm_nodata) as dtm:
+            last_row = int(stop_row.max())
+            print(f"Streaming canopy height of {len(pending)} plots in blocks of {block_rows} rows ({dsm.width} x {dsm.height} DSM)")
+            for block_start in range(int(first_row.min()), last_row, block_rows):
+                block_stop = min(block_start + block_rows, last_row)
+                crossing = pending[(first_row < block_stop) & (stop_row > block_start)]
+                if len(crossing):
+                    col_start = min(plot_masks[i][0].col_off for i in crossing)
+                    col_stop = max(plot_masks[i][0].col_off + plot_masks[i][0].width for i in crossing)
+                    heights, valid = canopy_height_window(dsm, dtm, Window(col_start, block_start, col_stop - col_start, block_stop - block_start))
+
+                    for i in crossing:
+                        window, mask = plot_masks[i]
+                        top, bottom = max(block_start, window.row_off), min(block_stop, window.row_off + window.height)
+                        rows = slice(top - block_start, bottom - block_start)
+                        cols = slice(window.col_off - col_start, window.col_off - col_start + window.width)
+                        plot_mask = mask[top - window.row_off:bottom - window.row_off]
+                        if valid is not None:
+                            plot_mask = plot_mask & valid[rows, cols]
+                        plot_heights = heights[rows, cols][plot_mask]
+                        label_chunks.append(np.full(len(plot_heights), i + 1, dtype=np.int32))
+                        height_chunks.append(plot_heights)
+                        buffered += len(plot_heights)
+                    del heights, valid
+
+                read_in_full[pending[stop_row <= block_stop]] = True
+                if block_stop == last_row or buffered >= CHM_FLUSH_PIXELS:
+                    buffered = summarise_read_plots()
 
+    gc.collect()  # Force garbage collection
 
 
 # @precise_timing_decorator
-def process_single_geometry(geom, raster_paths, transform):
+def process_single_geometry(geom, raster_paths, transform, transparency_mask_path=None):
     start_time = time.time()  # Start timing before the loop
     try:
-        """Processes a single geometry and returns statistics."""
+        """Processes a single geometry (shapely geometry or WKT string) and returns statistics, without nodata or transparent pixels."""
+        if isinstance(geom, str):
+            geom = shapely.wkt.loads(geom)
+
         with rasterio.open(raster_paths["red"]) as red, \
              rasterio.open(raster_paths["green"]) as green, \
              rasterio.open(raster_paths["nir"]) as nir, \
              rasterio.open(raster_paths["rededge"]) as rededge:
     
-            red_band = red.read(1).astype(float)
-            green_band = green.read(1).astype(float)
-            nir_band = nir.read(1).astype(float)
-            rededge_band = rededge.read(1).astype(float)
+            # Only the plot window is read (the bands share the red grid)
+            window = plot_window(geom, transform, red.width, red.height)
+            if window is None:
+                return {band_name: EMPTY_PLOT_STATISTICS for band_name in ("NDVI", "red", "green", "nir", "rededge")}
+            window_transform = rasterio.windows.transform(window, transform)
+
+            red_band = read_cached(red, 1, window=window, out_dtype=np.float32)
+            green_band = read_cached(green, 1, window=window, out_dtype=np.float32)
+            nir_band = read_cached(nir, 1, window=window, out_dtype=np.float32)
+            rededge_band = read_cached(rededge, 1, window=window, out_dtype=np.float32)
+            transparency = open_transparency_mask(transparency_mask_path)
+            valid = window_validity([red, green, nir, rededge], window, transparency)
+            if transparency:
+                transparency.close()
     
             # Compute NDVI (Numba optimized below)
             ndvi = compute_ndvi_numba(nir_band, red_band)
     
             # Calculate statistics
             stats = {
-                "NDVI": calculate_band_statistics(ndvi, geom, transform),
-                "red": calculate_band_statistics(red_band, geom, transform),
-                "green": calculate_band_statistics(green_band, geom, transform),
-                "nir": calculate_band_statistics(nir_band, geom, transform),
-                "rededge": calculate_band_statistics(rededge_band, geom, transform)
+                "NDVI": calculate_band_statistics(ndvi, geom, window_transform, valid),
+                "red": calculate_band_statistics(red_band, geom, window_transform, valid),
+                "green": calculate_band_statistics(green_band, geom, window_transform, valid),
+                "nir": calculate_band_statistics(nir_band, geom, window_transform, valid),
+                "rededge": calculate_band_statistics(rededge_band, geom, window_transform, valid)
             }
         end_time = time.time()  # Stop timing after the loop
         print(f"⏳ process_single_geometry execution time: {end_time - start_time:.4f} seconds")
@@ -565,17 +2029,17 @@ def process_single_geometry(geom, raster_paths, transform):
     
 
 # @precise_timing_decorator
-def process_rasters_parallel(shp, raster_paths, stats_df):
+def process_rasters_parallel_threaded(shp, raster_paths, stats_df, transparency_mask_path=None):
     start_time = time.time()  # Start timing before the loop
 
-    """Parallelized raster processing for efficiency."""
+    """Parallelized raster processing for efficiency (thread pool variant)."""
     
     # Use multiprocessing
     # with concurrent.futures.ProcessPoolExecutor(max_workers=2) as executor:
     with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
         with rasterio.open(raster_paths["red"]) as red:
             futures = {
-                executor.submit(process_single_geometry, geom, raster_paths, red.transform): geom_id
+                executor.submit(process_single_geometry, geom, raster_paths, red.transform, transparency_mask_path): geom_id
                 for geom_id, geom in zip(shp['id'], shp.geometry)
             }
     
@@ -590,23 +2054,23 @@ def process_rasters_parallel(shp, raster_paths, stats_df):
                     print(f"Error processing geometry {geom_id}: {e}")
 
     end_time = time.time()  # Stop timing after the loop
-    print(f"⏳ process_rasters_parallel execution time: {end_time - start_time:.4f} seconds")
+    print(f"⏳ process_rasters_parallel_threaded execution time: {end_time - start_time:.4f} seconds")
 
     gc.collect()  # Clean up memory after processing
 
 
-def process_rasters_parallel(shp, raster_paths, stats_df):
+def process_rasters_parallel(shp, raster_paths, stats_df, transparency_mask_path=None):
     start_time = time.time()  # Start timing before the loop
     """Parallelized raster processing for efficiency."""
     # Convert GeoDataFrame geometries to WKT (Well-Known Text) format for pickling
     shp['geometry_wkt'] = shp['geometry'].apply(lambda geom: geom.wkt)
 
-    with concurrent.futures.ProcessPoolExecutor() as executor:
+    with concurrent.futures.ProcessPoolExecutor(mp_context=kernel_pool_context(), initializer=warmup_kernels) as executor:
         with rasterio.open(raster_paths["red"]) as red:
 
             futures = {
                 executor.submit(
-                    process_single_geometry, wkt_geom, raster_paths, red.transform
+                    process_single_geometry, wkt_geom, raster_paths, red.transform, transparency_mask_path
                 ): geom_id
                 for geom_id, wkt_geom in zip(shp['id'], shp['geometry_wkt'])
             }
@@ -626,13 +2090,258 @@ def process_rasters_parallel(shp, raster_paths, stats_df):
     gc.collect()  # Clean up memory after processing
 
 
+### Shared-memory band cache for the parallel workers
+# The parent reads every band once into shared memory; the workers attach to it once
+# (pool initializer) and only receive plot IDs, geometries and windows per task.
+
+# Bands used by the shared-memory workers, with the raster_paths keys they may be stored under
+SHARED_BAND_KEYS = {"red": ("red",), "green": ("green",), "nir": ("nir",), "rededge": ("rededge", "red_edge"), "blue": ("blue",)}
+
+# Per-worker view of the shared bands, the band grid of each band, the index bands resampled to the red grid
+# and the compiled vegetation indices, set by _attach_shared_bands()
+_SHARED_BANDS = {}
+_SHARED_BAND_GRIDS = {}
+_SHARED_RESAMPLED = {}
+_SHARED_INDICES = {}
+
+
+def load_bands_to_shared_memory(raster_paths):
+    """
+    Reads each band once, in its native dtype, into a shared memory block.
+
+    Parameters:
+    - raster_paths (dict): Band name -> raster path ("rededge" may also be given as "red_edge").
+
+    Returns:
+    - tuple: (handles, blocks)
+        - handles (dict): {band: {"name", "shape", "dtype", "transform"}} to pass to the workers.
+        - blocks (list): SharedMemory objects; close() and unlink() them when done.
+    """
+    handles, blocks = {}, []
+    for band_name, keys in SHARED_BAND_KEYS.items():
+        path = next((raster_paths[key] for key in keys if raster_paths.get(key)), None)
+        if not path:
+            continue
+        with rasterio.open(path) as src:
+            dtype = np.dtype(src.dtypes[0])
+            block = shared_memory.SharedMemory(create=True, size=src.width * src.height * dtype.itemsize)
+            blocks.append(block)
+            band_array = np.ndarray((src.height, src.width), dtype=dtype, buffer=block.buf)
+            src.read(1, out=band_array)
+            handles[band_name] = {"name": block.name, "shape": band_array.shape, "dtype": dtype.str, "transform": src.transform}
+        print(f"📦 Loaded {band_name} band into shared memory ({block.size / 1024**2:.0f} MB)")
+    return handles, blocks
+
+
+def _shared_band_path(raster_paths, band_name):
+    """Path of a band in raster_paths, under any of its SHARED_BAND_KEYS."""
+    return next((raster_paths[key] for key in SHARED_BAND_KEYS[band_name] if raster_paths.get(key)), None)
+
+
+def _array_to_shared_memory(array, transform):
+    """Copies an array into a new shared memory block; returns (block, handle)."""
+    block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[:] = array
+    return block, {"name": block.name, "shape": array.shape, "dtype": array.dtype.str, "transform": transform}
+
+
+def _attach_handles(handles, target):
+    target.clear()
+    for band_name, handle in handles.items():
+        block = shared_memory.SharedMemory(name=handle["name"])
+        band_array = np.ndarray(handle["shape"], dtype=np.dtype(handle["dtype"]), buffer=block.buf)
+        target[band_name] = (block, band_array, handle["transform"])
+
+
+def _attach_shared_bands(handles, band_grids, indices=("NDVI",), resampled_handles=None):
+    """Pool initializer: attaches the worker to the shared band blocks once and compiles the indices and kernels."""
+    warmup_kernels()
+    _SHARED_INDICES.clear()
+    _SHARED_INDICES.update(resolve_indices(indices))
+    _SHARED_BAND_GRIDS.clear()
+    _SHARED_BAND_GRIDS.update(band_grids)
+    _attach_handles(handles, _SHARED_BANDS)
+    _attach_handles(resampled_handles or {}, _SHARED_RESAMPLED)
+
+
+def _process_plot_chunk_shared(plots):
+    """
+    Worker task: computes the statistics of a chunk of plots from the shared bands.
+
+    Parameters:
+    - plots (list): (plot_id, [((col_off, row_off, width, height), bit-packed mask) or None per band grid]) tuples.
+      If index bands were resampled to the red grid, a last entry holds the red window and mask of the indices.
+
+    Returns:
+    - list: (plot_id, {band: stats_dict}) tuples.
+    """
+    results = []
+    for plot_id, grid_masks in plots:
+        masks = []
+        for grid_mask in grid_masks:
+            if grid_mask is None:
+                masks.append(None)
+                continue
+            (col_off, row_off, width, height), bits = grid_mask
+            masks.append(((col_off, row_off, width, height), np.unpackbits(bits, count=width * height).reshape(height, width).astype(bool)))
+
+        def window_values(band_name, window, bands=_SHARED_BANDS):
+            col_off, row_off, width, height = window
+            return bands[band_name][1][row_off:row_off + height, col_off:col_off + width]
+
+        stats = {}
+
+        # Index inputs (bands on another grid were resampled to the red grid by the parent)
+        red_mask = masks[-1] if _SHARED_RESAMPLED else masks[_SHARED_BAND_GRIDS["red"]]
+        if red_mask:
+            red_window, mask = red_mask
+            on_red_grid = {
+                band_name: window_values(band_name, red_window, _SHARED_RESAMPLED if band_name in _SHARED_RESAMPLED else _SHARED_BANDS)
+                for band_name in required_bands(_SHARED_INDICES)
+            }
+            for index_name, index in _SHARED_INDICES.items():
+                stats[index_name] = masked_band_statistics(evaluate_index(index, on_red_grid), mask)
+
+        for band_name in _SHARED_BANDS:
+            band_mask = masks[_SHARED_BAND_GRIDS[band_name]]
+            if band_mask:
+                window, mask = band_mask
+                stats[band_name] = masked_band_statistics(window_values(band_name, window), mask)
+
+        results.append((plot_id, stats))
+    return results
+
+
+@precise_timing_decorator
+def process_rasters_shared_memory(shp, raster_paths, stats_df, max_workers=None, plots_per_task=25, flight=None, checkpoint=None, indices=("NDVI",), \
+                                  transparency_mask_path=None):
+    """
+    Parallel raster processing using a shared-memory band cache: the parent reads every band once into
+    shared memory, and the workers receive only plot IDs with their windows and bit-packed masks.
+
+    Parameters:
+    - shp (GeoDataFrame): Plot polygons with an 'id' column.
+    - raster_paths (dict): Band name -> raster path (red, green, nir, rededge/red_edge, optional blue).
+    - stats_df (DataFrame): Output DataFrame indexed by plot ID, filled in place.
+    - max_workers (int, optional): Number of worker processes (default: number of CPUs).
+    - plots_per_task (int): Number of plots sent to a worker per task.
+    - flight (str, optional): Flight name, used as the checkpoint key.
+    - checkpoint (sqlite3.Connection, optional): Checkpoint store; finished plots are committed to it
+      and plots already stored for this flight are not sent to the workers.
+    - indices (list or dict): Vegetation indices, see vegetation_indices.resolve_indices().
+    - transparency_mask_path (str, optional): Transparent mosaic whose background is left out.
+    """
+    compiled_indices = resolve_indices(indices)
+    missing_bands = [
+        band_name for band_name in required_bands(compiled_indices)
+        if not any(raster_paths.get(key) for key in SHARED_BAND_KEYS[band_name])
+    ]
+    if missing_bands:
+        raise ValueError(f"The requested indices need missing bands: {', '.join(missing_bands)}")
+
+    checkpointed = load_checkpoint(checkpoint, flight) if checkpoint is not None else {}
+    expected_bands = {*compiled_indices, *[band for band, keys in SHARED_BAND_KEYS.items() if any(raster_paths.get(key) for key in keys)]}
+
+    handles, blocks = load_bands_to_shared_memory(raster_paths)
+    try:
+        with rasterio.open(raster_paths["red"]) as red:
+            shp_crs = ensure_crs_alignment(shp, red.crs)
+
+        block, row_positions, column_positions = allocate_stats_block(stats_df)
+
+        # Plot windows and masks are taken once in the parent for every band grid (normally all bands share one grid)
+        grid_keys, band_grids = [], {}
+        for band_name, handle in handles.items():
+            grid_key = (handle["transform"], handle["shape"])
+            if grid_key not in grid_keys:
+                grid_keys.append(grid_key)
+            band_grids[band_name] = grid_keys.index(grid_key)
+        grid_plot_masks = [
+            plot_masks_for_grid(shp_crs, transform, shape[1], shape[0]) for transform, shape in grid_keys
+        ]
+        transparency = open_transparency_mask(transparency_mask_path)
+        grid_valid = [
+            grid_validity(raster_paths.values(), (tuple(transform), shape[1], shape[0]), transparency) for transform, shape in grid_keys
+        ]
+        if transparency:
+            transparency.close()
+
+        # Index bands on another grid are resampled to the red grid; the index masks leave out their invalid pixels
+        red_grid = band_grids["red"]
+        off_grid_index_bands = [band_name for band_name in required_bands(compiled_indices) if band_grids[band_name] != red_grid]
+        resampled_handles, index_valid = {}, None
+        if off_grid_index_bands:
+            index_paths = {"red": _shared_band_path(raster_paths, "red"), **{band_name: _shared_band_path(raster_paths, band_name) for band_name in off_grid_index_bands}}
+            with BandStack(index_paths, reference="red") as stack:
+                for band_name, band_array in zip(off_grid_index_bands, stack.read(bands=off_grid_index_bands)):
+                    shared_block, resampled_handles[band_name] = _array_to_shared_memory(band_array, stack.transform)
+                    blocks.append(shared_block)
+                    print(f"📦 Resampled {band_name} band to the red grid in shared memory ({shared_block.size / 1024**2:.0f} MB)")
+                index_valid = stack.read_masks(bands=off_grid_index_bands)
+            red_valid = grid_valid[red_grid]
+            if red_valid is not None:
+                index_valid = red_valid if index_valid is None else index_valid & red_valid
+
+        plots = []
+        for i, (plot_id, geom) in enumerate(zip(shp_crs['id'], shp_crs.geometry)):
+            if geom is None or geom.is_empty:
+                continue
+            if expected_bands.issubset(checkpointed.get(str(plot_id), {})):
+                write_plot_stats_to_block(block, row_positions, column_positions, plot_id, checkpointed[str(plot_id)])
+                continue
+            grid_masks = []
+            for plot_masks, valid in zip(grid_plot_masks, grid_valid):
+                window, mask = plot_masks[i]
+                if window is not None and valid is not None:
+                    mask = mask & valid[window.toslices()]
+                grid_masks.append(((window.col_off, window.row_off, window.width, window.height), np.packbits(mask.ravel())) if window else None)
+            if off_grid_index_bands:
+                window, mask = grid_plot_masks[red_grid][i]
+                if window is not None and index_valid is not None:
+                    mask = mask & index_valid[window.toslices()]
+                grid_masks.append(((window.col_off, window.row_off, window.width, window.height), np.packbits(mask.ravel())) if window else None)
+            plots.append((plot_id, grid_masks))
+
+        del grid_valid, index_valid
+        chunks = [plots[i:i + plots_per_task] for i in range(0, len(plots), plots_per_task)]
+
+        # Failed chunks (e.g. all remaining ones after a worker is killed) are not checkpointed; the flight fails
+        # once the pool is closed, so it is not finalized and the next run resumes from the checkpoint
+        failed_plots, errors = [], []
+        with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers, mp_context=kernel_pool_context(), initializer=_attach_shared_bands,
+                                                    initargs=(handles, band_grids, indices, resampled_handles)) as executor:
+            futures = {executor.submit(_process_plot_chunk_shared, chunk): chunk for chunk in chunks}
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    results = future.result()
+                except Exception as e:
+                    failed_plots.extend(plot_id for plot_id, _ in futures[future])
+                    errors.append(f"{type(e).__name__}: {e}")
+                    continue
+                for plot_id, stats in results:
+                    stats = {band_name: stats.get(band_name, EMPTY_PLOT_STATISTICS) for band_name in expected_bands}
+                    write_plot_stats_to_block(block, row_positions, column_positions, plot_id, stats)
+                    if checkpoint is not None:
+                        save_plot_checkpoint(checkpoint, flight, plot_id, stats)
+
+        if failed_plots:
+            raise RuntimeError(f"{len(failed_plots)} plots failed in {len(errors)} chunks of {flight or 'the flight'}: {errors[0]}")
+
+        flush_stats_block(stats_df, block)
+    finally:
+        for shared_block in blocks:
+            shared_block.close()
+            shared_block.unlink()
+
+    gc.collect()  # Clean up memory after processing
+
+
 ### Optimize NDVI Computation Using Numba
 
 @precise_timing_decorator
-@njit
-def compute_ndvi_numba(nir, red):
-    """Fast NDVI computation using Numba."""
-    return np.where((nir + red) == 0, np.nan, (nir - red) / (nir + red))
+def compute_ndvi_numba(nir, red, valid=None):
+    """Fast float32 NDVI computation using the cached Numba kernel of stat_kernels (NaN where not valid)."""
+    return masked_ndvi(nir, red, valid)
 
 
 
@@ -892,138 +2601,782 @@ def check_memory_usage(threshold=80):
         return True
     return False
 
-@precise_timing_decorator
-def prepare_and_run_raster_processing(project_name, output_root_folder, ortho_dict, geojson_file_folder):
+
+### Flights covering several trials
+# The polygon sets of all trials under one flight are merged into one plot set with combined IDs
+# "<trial>:<id>", so the engine reads every raster block once for all trials (plot IDs may repeat across
+# trials). The statistics are split back per trial, under the original plot IDs, when they are written.
+
+# Separator of the trial name and the plot ID in the combined plot IDs
+TRIAL_ID_SEPARATOR = ":"
+
+
+def combine_trial_plots(trial_shps):
     """
-    Matches orthomosaics to the correct geojson file and prepares necessary data before running process_rasters().
+    Merges the plot polygons of several trials into one plot set with unique IDs.
+
+    Parameters:
+    - trial_shps (dict): {trial name: GeoDataFrame with an 'id' column}, all in the same CRS.
+
+    Returns:
+    - GeoDataFrame: All plots in trial order, with the combined ID "<trial>:<id>" in 'id',
+      the trial name in 'trial' and the plot ID within the trial in 'trial_id'.
+    """
+    parts = []
+    for trial, trial_shp in trial_shps.items():
+        part = trial_shp.copy()
+        part["trial"] = trial
+        part["trial_id"] = part["id"]
+        part["id"] = [f"{trial}{TRIAL_ID_SEPARATOR}{plot_id}" for plot_id in part["id"]]
+        parts.append(part)
+    return gpd.GeoDataFrame(pd.concat(parts, ignore_index=True), geometry="geometry", crs=parts[0].crs)
+
+
+def split_trial_results(results, trial_plots):
+    """
+    Splits a table indexed by combined plot IDs back into one table per trial.
+
+    Parameters:
+    - results (DataFrame): Indexed by the combined plot IDs of combine_trial_plots().
+    - trial_plots (DataFrame): The 'id', 'trial' and 'trial_id' columns of combine_trial_plots().
+
+    Returns:
+    - dict: {trial name: DataFrame indexed by the plot IDs within the trial}, in trial order.
+    """
+    split = {}
+    for trial, plots in trial_plots.groupby("trial", sort=False):
+        part = results.loc[plots["id"].to_numpy()]
+        part.index = pd.Index(plots["trial_id"].to_numpy(), name=results.index.name)
+        split[trial] = part
+    return split
+
+
+def trials_overlap(shp_crs):
+    """Returns True if plots of different trials of combine_trial_plots() share area."""
+    geometries = np.asarray(shp_crs.geometry.array, dtype=object)
+    first, second = shp_crs.sindex.query(geometries, predicate="intersects")
+    trials = shp_crs["trial"].to_numpy()
+    pairs = (first < second) & (trials[first] != trials[second])
+    if not pairs.any():
+        return False
+    return bool((shapely.area(shapely.intersection(geometries[first[pairs]], geometries[second[pairs]])) > 0).any())
+
+
+### Diff-aware re-extraction
+# Every output is written with a plot manifest ("<output>_plot_manifest.json") holding the digest of the
+# GeoJSON and a hash of every plot geometry. When the polygons are regenerated, an incremental run diffs the
+# new GeoJSON against the manifest: plots with an unchanged geometry keep their stored results (under a new
+# ID too, when plots were renumbered), only added and changed plots are extracted, and removed plots are dropped.
+
+
+def file_sha256(file_path):
+    """Returns the SHA-256 hex digest of a file's content."""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def plot_geometry_hashes(geometries):
+    """
+    Hashes plot geometries independently of their vertex order and ring start.
+
+    Parameters:
+    - geometries (iterable): Plot geometries in the raster CRS.
+
+    Returns:
+    - list of str: SHA-256 hex digest of the normalized WKB of every geometry ("" for missing geometries).
+    """
+    wkbs = shapely.to_wkb(shapely.normalize(np.asarray(list(geometries), dtype=object)))
+    return [hashlib.sha256(wkb).hexdigest() if wkb is not None else "" for wkb in wkbs]
+
+
+def plot_manifest_path(output_csv_path):
+    """Returns the path of the plot manifest of an output ("<output>_plot_manifest.json")."""
+    return f"{os.path.splitext(output_csv_path)[0]}_plot_manifest.json"
+
+
+def write_plot_manifest(manifest_path, geojson_path, plot_ids, geometry_hashes):
+    """
+    Writes the plot manifest of an output, through a temporary file.
+
+    Parameters:
+    - manifest_path (str): Path from plot_manifest_path().
+    - geojson_path (str): GeoJSON file the output was extracted from.
+    - plot_ids (iterable): Plot IDs of the output, in output order.
+    - geometry_hashes (iterable): plot_geometry_hashes() of the plots.
+    """
+    manifest = {
+        "geojson_path": os.path.abspath(geojson_path),
+        "geojson_sha256": file_sha256(geojson_path),
+        "written": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "plots": {str(plot_id): geometry_hash for plot_id, geometry_hash in zip(plot_ids, geometry_hashes)},
+    }
+    partial_path = f"{manifest_path}.{os.getpid()}.partial"
+    with open(partial_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f)
+    os.replace(partial_path, manifest_path)
+
+
+def load_plot_manifest(manifest_path):
+    """Loads a plot manifest, or returns None if it is missing or unreadable."""
+    try:
+        with open(manifest_path, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def load_stored_results(output_csv_path, output_parquet_path, output_format):
+    """
+    Loads the statistics written by an earlier run, from the CSV if there is one (full precision),
+    else from the float32 Parquet file.
+
+    Returns:
+    - DataFrame or None: Statistics indexed by plot ID (as str), or None if no output exists.
+    """
+    if output_format in ("csv", "both") and os.path.exists(output_csv_path):
+        stored = pd.read_csv(output_csv_path, index_col="id", float_precision="round_trip")
+    elif output_format in ("parquet", "both") and output_parquet_path and os.path.exists(output_parquet_path):
+        stored = pd.read_parquet(output_parquet_path).set_index("id").drop(columns="flight")
+    else:
+        return None
+    stored.index = stored.index.astype(str)
+    return stored
+
+
+def diff_plot_manifest(manifest, plot_ids, geometry_hashes):
+    """
+    Compares the plots of a new GeoJSON with the plot manifest of the stored results.
+
+    A plot is reused if a stored plot has the same geometry: under the same ID, or under another ID
+    (renumbered or swapped plots). Plots whose geometry is new are "changed" if their ID is stored, else "added".
+
+    Parameters:
+    - manifest (dict): Output of load_plot_manifest().
+    - plot_ids (iterable): Plot IDs of the new GeoJSON.
+    - geometry_hashes (iterable): plot_geometry_hashes() of the new plots.
+
+    Returns:
+    - dict: {"reused": {plot ID: stored plot ID}, "changed": [plot IDs], "added": [plot IDs],
+      "removed": [stored plot IDs no longer present]}, with the IDs as str.
+    """
+    stored = manifest["plots"]
+    stored_by_hash = {}
+    for plot_id, geometry_hash in stored.items():
+        stored_by_hash.setdefault(geometry_hash, plot_id)
+
+    diff = {"reused": {}, "changed": [], "added": [], "removed": []}
+    for plot_id, geometry_hash in zip(map(str, plot_ids), geometry_hashes):
+        if stored.get(plot_id) == geometry_hash:
+            diff["reused"][plot_id] = plot_id
+        elif geometry_hash in stored_by_hash:
+            diff["reused"][plot_id] = stored_by_hash[geometry_hash]
+        elif plot_id in stored:
+            diff["changed"].append(plot_id)
+        else:
+            diff["added"].append(plot_id)
+    new_ids = set(map(str, plot_ids))
+    diff["removed"] = [plot_id for plot_id in stored if plot_id not in new_ids]
+    return diff
+
+
+def outputs_up_to_date(output_files, geojson_paths):
+    """
+    Returns True if every output has a plot manifest written from the current content of its GeoJSON.
+
+    Parameters:
+    - output_files (dict): {trial or None: (output CSV path, output Parquet path)}.
+    - geojson_paths (dict): {trial or None: GeoJSON path}.
+    """
+    for trial, (csv_path, _) in output_files.items():
+        manifest = load_plot_manifest(plot_manifest_path(csv_path))
+        if manifest is None or manifest.get("geojson_sha256") != file_sha256(geojson_paths[trial]):
+            return False
+    return True
+
+
+# Output formats of the plot statistics
+OUTPUT_FORMATS = ("csv", "parquet", "both")
+
+
+def collect_flight_jobs(project_name, output_root_folder, ortho_dict, geojson_file_folder, flight_type="MS", output_format="csv", incremental=False, trials=None):
+    """
+    Matches each flight of a project to its geojson file and output paths, skipping flights
+    without a geojson file or whose outputs already exist.
+
+    Without trials, the flight is matched to one geojson file: the one named after the project, or else the
+    first file whose name contains the project name (a warning lists the other matches). With several trials
+    (geojson file names covered by the flights), the flight is extracted for all of them in one pass:
+    "geojson_path" is then {trial: path} and "trial_outputs" holds the output CSV ("<name>_statistics_<trial>.csv")
+    and Parquet file (partition project=<trial>) of every trial.
+
+    With incremental=True, flights whose outputs exist are only skipped if their plot manifests were written
+    from the current geojson files; the other flights are re-extracted for their added and changed plots only
+    (see diff_plot_manifest()).
 
     Parameters:
     - project_name (str): Name of the field project
     - output_root_folder (str): Root path to store output CSV files.
-    - ortho_dict (dict): Dictionary mapping flight folders to lists of raster file paths.
+    - ortho_dict (dict): Dictionary mapping flight folders to lists of raster file paths
+      (the DSM/DTM files for 3D flights).
     - geojson_file_folder (str): Path to the folder containing geojsonfiles.
+    - flight_type (str): Flight type ('MS' or '3D'), used as a partition of the Parquet results dataset.
+      3D flights are written to "<name>_height_statistics.csv".
+    - output_format (str): "csv", "parquet" (partitioned dataset in output_root_folder/results_dataset) or "both".
+    - incremental (bool): Re-extract flights whose geojson files changed since their outputs were written.
+    - trials (list of str, optional): Geojson file names (without extension) of the trials covered by the flights
+      of the project, extracted together.
 
     Returns:
-    - None
+    - list of dict: One entry per flight to process, with the keyword arguments of process_flight().
     """
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown output_format: {output_format}")
+
     geojson_file_dict = list_geojson_files(geojson_file_folder)
+    jobs = []
+
+    # Find the corresponding geojsonfiles (one per listed trial, or the project's own file)
+    if trials:
+        missing_trials = [trial for trial in trials if trial not in geojson_file_dict]
+        if missing_trials:
+            print(f"⚠️ No geojson file found for the trials: {', '.join(missing_trials)}")
+        matched_geojson_files = {trial: geojson_file_dict[trial] for trial in trials if trial in geojson_file_dict}
+    else:
+        candidates = sorted(name for name in geojson_file_dict if project_name in name)
+        matched_geojson_files = {}
+        if candidates:
+            shp_file_name = project_name if project_name in geojson_file_dict else candidates[0]
+            matched_geojson_files[shp_file_name] = geojson_file_dict[shp_file_name]
+            if len(candidates) > 1:
+                print(f"⚠️ Several geojson files match {project_name}: {', '.join(candidates)}. Using {shp_file_name}; "
+                      "pass trials to extract several trials together.")
 
     for flight, paths in ortho_dict.items():
         print(f"\n🚀 Preparing raster processing for flight: {flight}")
 
-        # Find the corresponding geojsonfile
-        matched_geojson_file = next(
-            (shp for shp_file_name, shp in geojson_file_dict.items() if project_name in shp_file_name), None
-        )
-
-        if not matched_geojson_file:
+        if not matched_geojson_files:
             print(f"⚠️ No matching geojson file found for {flight}. Skipping...")
             continue
 
-        print(f"✅ Matched geojson file: {matched_geojson_file}")
+        print(f"✅ Matched geojson file: {', '.join(matched_geojson_files.values())}")
 
-        
         # Define output file name based on the common prefix of input files
-        output_csv_name = f"{extract_common_prefix(paths)}statistics.csv"
+        prefix = extract_common_prefix(paths)
+        if flight_type == "3D":
+            # "<name>_dsm.tif" and "<name>_dtm.tif" share the prefix "<name>_d"
+            prefix = f"{prefix[:prefix.rfind('_') + 1]}height_"
+        output_csv_name = f"{prefix}statistics.csv"
         output_csv_path = os.path.join(output_root_folder, project_name, output_csv_name)
         
         # Ensure the the output directory exists
         os.makedirs(os.path.dirname(output_csv_path), exist_ok=True)
         
-        # **Check if CSV file for the flight being processed already exists**
-        if os.path.exists(output_csv_path):
-            print(f"📌 Output CSV already exists: {output_csv_path}. Skipping processing.")
-            continue  # Skip this flight
-        
-        # **Monitor memory before loading large files**
-        check_memory_usage()
+        def parquet_path(name):
+            if output_format not in ("parquet", "both"):
+                return None
+            return results_partition_path(os.path.join(output_root_folder, RESULTS_DATASET_FOLDER), name, flight_type, flight)
+
+        output_parquet_path = parquet_path(project_name)
+
+        # Flights covering several trials write one CSV and Parquet file per trial
+        trial_outputs = None
+        if len(matched_geojson_files) > 1:
+            trial_outputs = {
+                trial: (add_suffix_to_file_name(output_csv_path, f"_{trial}"), parquet_path(trial))
+                for trial in matched_geojson_files
+            }
 
-        # Load the GeoJSON file
-        try:
-            shp = gpd.read_file(matched_geojson_file)
-            shp.columns = shp.columns.str.lower() # convert all column names in the GeoDataFrame to lowercase
-        except Exception as e:
-            print(f"❌ Error loading shapefile {matched_geojson_file}: {e}")
-            continue
+        # **Check if the output files for the flight being processed already exist**
+        expected_outputs = [
+            path for csv_path, parquet_path_ in (trial_outputs.values() if trial_outputs else [(output_csv_path, output_parquet_path)])
+            for path in [csv_path if output_format != "parquet" else None, parquet_path_] if path
+        ]
+        if all(os.path.exists(path) for path in expected_outputs):
+            if not incremental:
+                print(f"📌 Output already exists: {', '.join(expected_outputs)}. Skipping processing.")
+                continue  # Skip this flight
+            output_files = trial_outputs or {None: (output_csv_path, output_parquet_path)}
+            geojson_paths = matched_geojson_files if trial_outputs else {None: next(iter(matched_geojson_files.values()))}
+            if outputs_up_to_date(output_files, geojson_paths):
+                print(f"📌 Output is up to date with the geojson files: {', '.join(expected_outputs)}. Skipping processing.")
+                continue  # Skip this flight
+
+        job = {
+            "project_name": project_name,
+            "flight": flight,
+            "paths": paths,
+            "geojson_path": matched_geojson_files if trial_outputs else next(iter(matched_geojson_files.values())),
+            "output_csv_path": output_csv_path,
+            "output_format": output_format,
+            "output_parquet_path": output_parquet_path,
+            "incremental": incremental,
+        }
+        if trial_outputs:
+            job["trial_outputs"] = trial_outputs
+        jobs.append(job)
 
-        # Identify raster paths dynamically
-        rgb_raster_path = next((tif for tif in paths if "_transparent_mosaic_group1.tif" in tif), None)
-        green_raster_path = next((tif for tif in paths if "green_green" in tif), None)
-        nir_raster_path = next((tif for tif in paths if "nir_nir" in tif), None)
-        red_raster_path = next((tif for tif in paths if "red_red" in tif), None)
-        rededge_raster_path = next((tif for tif in paths if "red_edge_red_edge" in tif), None)
-        blue_raster_path = next((tif for tif in paths if "blue_blue" in tif), None)  # Optional
-               
-        # Ensure all required raster files exist
-        if not all([red_raster_path, green_raster_path, nir_raster_path, rededge_raster_path]):
-            print(f"❌ Missing required raster files for {flight}. Skipping...")
-            continue
+    return jobs
 
-        # Downscale the RGB raster for preview during processing
-        if rgb_raster_path:
-            rgb_raster_thumb_path = add_suffix_to_file_name(rgb_raster_path, "_thumb")
-            downscale_image(rgb_raster_path, rgb_raster_thumb_path, 0.05)
 
+# Name of the per-project checkpoint store written next to the output CSV files
+CHECKPOINT_FILE_NAME = "extraction_checkpoints.sqlite"
 
 
-        raster_paths = {
-            "red": next((tif for tif in paths if "red_red" in tif), None),
-            "blue": next((tif for tif in paths if "blue_blue" in tif), None),
-            "green": next((tif for tif in paths if "green_green" in tif), None),
-            "nir": next((tif for tif in paths if "nir_nir" in tif), None),
-            "red_edge": next((tif for tif in paths if "red_edge_red_edge" in tif), None)
-        }
+def process_flight(project_name, flight, paths, geojson_path, output_csv_path, extraction_mode="windowed", output_format="csv", output_parquet_path=None, indices=("NDVI",), plot_geom="none", trial_outputs=None, incremental=False, max_workers=None):
+    """
+    Runs the raster extraction for a single flight and saves the statistics CSV and/or Parquet file.
 
+    Kept free of decorators so it can be submitted to a process pool.
+
+    Parameters:
+    - project_name (str): Name of the field project
+    - flight (str): Flight folder name.
+    - paths (list of str): Raster file paths of the flight.
+    - geojson_path (str or dict): Path to the geojson file with the plot polygons, or {trial: path} for a flight
+      covering several trials (see trial_outputs).
+    - output_csv_path (str): Path of the output CSV file. Its folder also holds the checkpoint store, and
+      "<output>_plot_coverage.csv" reports the coverage of every plot (see classify_plot_coverage()).
+    - extraction_mode (str): Extraction engine, see prepare_and_run_raster_processing().
+      Flights with a DSM and DTM but no multispectral bands (3D flights) always use "height".
+    - output_format (str): "csv", "parquet" or "both", see collect_flight_jobs().
+    - output_parquet_path (str, optional): Path of the flight's file in the Parquet results dataset
+      (required for "parquet" and "both").
+    - indices (list or dict): Vegetation indices to compute, see vegetation_indices.resolve_indices().
+      The "full" extraction mode only computes NDVI.
+    - plot_geom (str): Progress display of the per-plot engines ("full", "windowed", "weighted", "stream"):
+      "none", "ortho", "shp" or "preview" (see progress_preview.ProgressPreview).
+    - trial_outputs (dict, optional): {trial: (output CSV path, output Parquet path or None)} of a flight
+      covering several trials, see collect_flight_jobs(). The plots of all trials are extracted in one pass
+      (see combine_trial_plots()) and every trial gets its own outputs and coverage report under its own plot IDs.
+      Trials with overlapping plots are extracted in the "stream" mode instead of "label", whose label
+      raster holds one plot per pixel.
+    - incremental (bool): Diff the plots against the plot manifest of the stored outputs (see diff_plot_manifest()):
+      plots with an unchanged geometry keep their stored statistics, only added and changed plots are extracted,
+      and removed plots are dropped. Outputs without a manifest, or with other columns, are extracted in full.
+      Every output is written with its plot manifest ("<output>_plot_manifest.json").
+    - max_workers (int, optional): Number of plot worker processes of the "shared" extraction mode
+      (default: number of CPUs).
+
+    Returns:
+    - str, dict or None: Path of the saved CSV (or Parquet file), {trial: path} for several trials,
+      or None if the flight was skipped.
+    """
+    compiled_indices = resolve_indices(indices)
+    if extraction_mode == "full" and list(compiled_indices) != ["NDVI"]:
+        raise ValueError("The 'full' extraction mode only computes NDVI; use another extraction_mode for other indices.")
+
+    # **Monitor memory before loading large files**
+    check_memory_usage()
+
+    # Identify raster paths dynamically
+    rgb_raster_path = next((tif for tif in paths if "_transparent_mosaic_group1.tif" in tif), None)
+    band_paths = find_band_paths(paths)
+    green_raster_path = band_paths.get("green")
+    nir_raster_path = band_paths.get("nir")
+    red_raster_path = band_paths.get("red")
+    rededge_raster_path = band_paths.get("rededge")
+    blue_raster_path = band_paths.get("blue")  # Optional
+    dsm_raster_path = next((tif for tif in paths if tif.endswith("_dsm.tif")), None)
+    dtm_raster_path = next((tif for tif in paths if tif.endswith("_dtm.tif")), None)
+
+    # 3D flights only have the elevation models
+    if dsm_raster_path and dtm_raster_path and not red_raster_path:
+        extraction_mode = "height"
+
+    # Ensure all required raster files exist
+    if extraction_mode == "height":
+        if not (dsm_raster_path and dtm_raster_path):
+            print(f"❌ Missing DSM or DTM for {flight}. Skipping...")
+            return None
+    elif not all([red_raster_path, green_raster_path, nir_raster_path, rededge_raster_path]):
+        print(f"❌ Missing required raster files for {flight}. Skipping...")
+        return None
+
+    # Load the GeoJSON file, reprojected to the raster CRS (cached across flights, see plot_mask_cache.py)
+    try:
+        with rasterio.open(dsm_raster_path if extraction_mode == "height" else red_raster_path) as reference:
+            raster_crs = reference.crs
+        if trial_outputs:
+            shp = combine_trial_plots({
+                trial: load_plot_geometries(geojson_path[trial], raster_crs, PLOT_MASK_CACHE_FOLDER, PLOT_MASK_CACHE_MAX_GB)
+                for trial in trial_outputs
+            })
+        else:
+            shp = load_plot_geometries(geojson_path, raster_crs, PLOT_MASK_CACHE_FOLDER, PLOT_MASK_CACHE_MAX_GB)
+    except Exception as e:
+        print(f"❌ Error loading shapefile {geojson_path}: {e}")
+        return None
+
+    # Downscale the RGB raster for preview during processing
+    rgb_raster_thumb_path = None
+    if rgb_raster_path:
+        rgb_raster_thumb_path = add_suffix_to_file_name(rgb_raster_path, "_thumb")
+        downscale_image(rgb_raster_path, rgb_raster_thumb_path, 0.05)
+
+    # **Check memory usage after loading**
+    check_memory_usage()
         
-        # **Check memory usage after loading**
-        check_memory_usage()
-            
-        # Example mock geometry and transform for column preparation
-        mock_geom = box(0, 0, 3, 2)  # A simple bounding box geometry
-        mock_transform = from_origin(0, 3, 1, 1)  # Example affine transform
-
-        # Prepare an empty DataFrame dynamically
-        # Dynamically generate column names based on the statistics function
-        stats_columns = [
-            f"{band}_{stat}" for band in ["NDVI", "green", "nir", "red", "rededge"]
-            for stat in calculate_band_statistics(np.array([[1, 2, 3], [4, 5, 6]]), mock_geom, mock_transform).keys()
-        ]
-        
-        # If blue_raster_path exists, add blue statistics columns
-        if blue_raster_path:
-            stats_columns.extend([
-                f"blue_{stat}" for stat in calculate_band_statistics(np.array([[1, 2, 3], [4, 5, 6]]), mock_geom, mock_transform).keys()
-            ])
+    # Example mock geometry and transform for column preparation
+    mock_geom = box(0, 0, 3, 2)  # A simple bounding box geometry
+    mock_transform = from_origin(0, 3, 1, 1)  # Example affine transform
+
+    # Prepare an empty DataFrame dynamically
+    # Dynamically generate column names based on the statistics function
+    stats_columns = [
+        f"{band}_{stat}" for band in [*compiled_indices, "green", "nir", "red", "rededge"]
+        for stat in calculate_band_statistics(np.array([[1, 2, 3], [4, 5, 6]]), mock_geom, mock_transform).keys()
+    ]
+    
+    # If blue_raster_path exists, add blue statistics columns
+    if blue_raster_path:
+        stats_columns.extend([
+            f"blue_{stat}" for stat in calculate_band_statistics(np.array([[1, 2, 3], [4, 5, 6]]), mock_geom, mock_transform).keys()
+        ])
+
+    # Plant-height statistics replace the band statistics
+    if extraction_mode == "height":
+        stats_columns = canopy_height_columns()
+
+    # Initialize the output DataFrame using the ID column from the GeoJSON (typed float, filled with NaN)
+    stats_df = pd.DataFrame(np.nan, index=shp["id"], columns=stats_columns)
+
+    # Plot coverage of the rasters, saved next to the output; plots outside every raster keep NaN rows
+    # and are left out of the extraction
+    raster_bounds = {}
+    for name, path in ({"dsm": dsm_raster_path, "dtm": dtm_raster_path} if extraction_mode == "height" else band_paths).items():
+        with rasterio.open(path) as src:
+            raster_bounds[name] = src.bounds
+    coverage_report = classify_plot_coverage(shp, raster_bounds)
+    print_coverage_summary(coverage_report)
+
+    # Output files of the flight, or of every trial it covers
+    output_files = trial_outputs or {None: (output_csv_path, output_parquet_path)}
+    if trial_outputs:
+        trial_plots = pd.DataFrame(shp[["id", "trial", "trial_id"]])
+        coverage_reports = split_trial_results(coverage_report, trial_plots)
+    else:
+        coverage_reports = {None: coverage_report}
+
+    for trial, (csv_path, _) in output_files.items():
+        os.makedirs(os.path.dirname(csv_path) or ".", exist_ok=True)
+        write_csv_atomically(coverage_reports[trial], f"{os.path.splitext(csv_path)[0]}_plot_coverage.csv", index_label="id")
 
-        # Initialize the output DataFrame using the ID column from the GeoJSON
-        stats_df = pd.DataFrame(index=shp["id"], columns=stats_columns)
+    # Plots and geometry hashes of every output, for its plot manifest
+    geometry_hashes = np.array(plot_geometry_hashes(shp.geometry), dtype=object)
+    if trial_outputs:
+        output_rows = {trial: (shp["trial"] == trial).to_numpy() for trial in output_files}
+    else:
+        output_rows = {None: np.ones(len(shp), dtype=bool)}
+    output_ids = {trial: (shp["trial_id"] if trial_outputs else shp["id"]).to_numpy()[rows] for trial, rows in output_rows.items()}
+
+    # Incremental runs restore the plots whose geometry is unchanged from the stored outputs
+    reused = np.zeros(len(shp), dtype=bool)
+    if incremental:
+        for trial, (csv_path, parquet_path) in output_files.items():
+            manifest = load_plot_manifest(plot_manifest_path(csv_path))
+            stored = load_stored_results(csv_path, parquet_path, output_format)
+            if manifest is None or stored is None or list(stored.columns) != stats_columns:
+                print(f"📌 No reusable results for {trial or flight}; extracting all its plots.")
+                continue
+
+            rows = np.flatnonzero(output_rows[trial])
+            diff = diff_plot_manifest(manifest, output_ids[trial], geometry_hashes[rows])
+            stored_ids = {plot_id: stored_id for plot_id, stored_id in diff["reused"].items() if stored_id in stored.index}
+            keep = np.array([str(plot_id) in stored_ids for plot_id in output_ids[trial]], dtype=bool)
+            stats_df.loc[shp["id"].to_numpy()[rows[keep]]] = stored.loc[
+                [stored_ids[str(plot_id)] for plot_id in output_ids[trial][keep]], stats_columns
+            ].to_numpy(dtype=float)
+            reused[rows[keep]] = True
+
+            renumbered = sum(plot_id != stored_id for plot_id, stored_id in stored_ids.items())
+            print(f"🔁 {trial or flight}: {len(stored_ids)} plots reused ({renumbered} renumbered), {len(diff['changed'])} changed, "
+                  f"{len(diff['added'])} added, {len(diff['removed'])} removed.")
+            count("plots_reused", len(stored_ids), mode=extraction_mode)
+
+    # Plots outside every raster are not extracted, and are left out of the plot manifests so they are tried again
+    extracted = ~coverage_report["outside_all"].to_numpy() & ~reused
+    shp = shp[extracted].reset_index(drop=True)
+
+    if trial_outputs and extraction_mode == "label" and trials_overlap(shp):
+        print(f"⚠️ Plots of different trials overlap in {flight}; using the 'stream' extraction mode so every plot keeps its pixels.")
+        extraction_mode = "stream"
+
+    # Finished plots are checkpointed next to the output CSV, so an interrupted flight resumes where it stopped
+    checkpoint = open_checkpoint_store(os.path.join(os.path.dirname(output_csv_path), CHECKPOINT_FILE_NAME))
+
+    # Plots checkpointed with other geometries, another extraction mode or other index formulas are not restored
+    signature = run_signature(
+        extraction_mode=extraction_mode,
+        indices={name: index["formula"] for name, index in compiled_indices.items()},
+        plots=dict(zip(map(str, stats_df.index), geometry_hashes)),
+    )
+    discarded = start_flight_run(checkpoint, flight, signature)
+    if discarded:
+        print(f"🗑️ Discarded {discarded} checkpointed results of {flight} written with other plots or settings.")
 
+    try:
         # # **Run raster processing**
-        process_rasters(shp, project_name, flight, green_raster_path, nir_raster_path, red_raster_path, rededge_raster_path, blue_raster_path, rgb_raster_thumb_path, stats_df, plot_geom = "none")
-        # process_rasters_parallel(shp, raster_paths, stats_df)
-        
+        with span("extract_flight", mode=extraction_mode):
+            if shp.empty:
+                print(f"⚠️ No plot of {flight} left to extract." if reused.any() else f"⚠️ No plot of {flight} intersects the rasters.")
+            elif extraction_mode == "windowed":
+                process_rasters_windowed(shp, project_name, flight, green_raster_path, nir_raster_path, red_raster_path, rededge_raster_path, blue_raster_path, rgb_raster_thumb_path, stats_df, plot_geom = plot_geom, checkpoint=checkpoint, indices=indices, transparency_mask_path=rgb_raster_path)
+            elif extraction_mode == "weighted":
+                process_rasters_windowed(shp, project_name, flight, green_raster_path, nir_raster_path, red_raster_path, rededge_raster_path, blue_raster_path, rgb_raster_thumb_path, stats_df, plot_geom = plot_geom, checkpoint=checkpoint, indices=indices, coverage_weights=True, transparency_mask_path=rgb_raster_path)
+            elif extraction_mode == "label":
+                process_rasters_labelled(shp, project_name, flight, green_raster_path, nir_raster_path, red_raster_path, rededge_raster_path, blue_raster_path, rgb_raster_thumb_path, stats_df, plot_geom = plot_geom, checkpoint=checkpoint, indices=indices, transparency_mask_path=rgb_raster_path)
+            elif extraction_mode == "stream":
+                process_rasters_streaming(shp, project_name, flight, green_raster_path, nir_raster_path, red_raster_path, rededge_raster_path, blue_raster_path, rgb_raster_thumb_path, stats_df, plot_geom = plot_geom, checkpoint=checkpoint, indices=indices, transparency_mask_path=rgb_raster_path)
+            elif extraction_mode == "shared":
+                raster_paths = {"red": red_raster_path, "green": green_raster_path, "nir": nir_raster_path, "rededge": rededge_raster_path, "blue": blue_raster_path}
+                process_rasters_shared_memory(shp, raster_paths, stats_df, max_workers=max_workers, flight=flight, checkpoint=checkpoint, indices=indices,
+                                              transparency_mask_path=rgb_raster_path)
+            elif extraction_mode == "height":
+                process_canopy_height(shp, dsm_raster_path, dtm_raster_path, stats_df, flight=flight, checkpoint=checkpoint)
+            elif extraction_mode == "full":
+                process_rasters(shp, project_name, flight, green_raster_path, nir_raster_path, red_raster_path, rededge_raster_path, blue_raster_path, rgb_raster_thumb_path, stats_df, plot_geom = plot_geom, transparency_mask_path=rgb_raster_path, checkpoint=checkpoint)
+            else:
+                raise ValueError(f"Unknown extraction_mode: {extraction_mode}")
+        # Every extracted plot must have been checkpointed or have results before the flight is finalized
+        extracted_ids = shp["id"].to_numpy()
+        done_ids = checkpointed_plot_ids(checkpoint, flight)
+        without_results = stats_df.loc[extracted_ids].isna().all(axis=1).to_numpy()
+        missing_ids = [plot_id for plot_id, empty in zip(extracted_ids, without_results) if empty and str(plot_id) not in done_ids]
+        if missing_ids:
+            raise RuntimeError(f"{len(missing_ids)} plots of {flight} have no results (e.g. {missing_ids[0]}); the flight is not finalized.")
+        count("plots_extracted", len(stats_df) - int(reused.sum()), mode=extraction_mode)
+        cache_stats = block_cache_stats()
+        if cache_stats["hits"] + cache_stats["misses"]:
+            print(f"🧱 Block cache: {cache_stats['hit_rate']:.1%} hit rate ({cache_stats['hits']} hits, "
+                  f"{cache_stats['misses']} blocks decoded, {cache_stats['bypassed']} direct reads)")
+
         # plot_geom = "ortho"
         # plot_geom = "shp"
         # plot_geom = "none"
-        
-        # **Clear raster data from memory**
-        gc.collect()  # Force garbage collection
-        print(f"🧹 Cleared raster data from memory.")
 
         # **Clear shapefile from memory**
         del shp
         gc.collect()  # Force garbage collection
-        print(f"🧹 Cleared shapefile data from memory.")
-        
-        # Save results
-        stats_df.to_csv(output_csv_path, index_label="id")
-        print(f"📁 Saved results to {output_csv_path}")
-        
-        # **Final memory check**
-        check_memory_usage()
+        print(f"🧹 Cleared raster and shapefile data from memory.")
+
+        # Save results; the flight only counts as done once the complete outputs are in place
+        trial_stats = split_trial_results(stats_df, trial_plots) if trial_outputs else {None: stats_df}
+        output_paths = {}
+        with span("write_results", format=output_format):
+            for trial, (csv_path, parquet_path) in output_files.items():
+                output_paths[trial] = None
+                if output_format in ("csv", "both"):
+                    write_csv_atomically(trial_stats[trial], csv_path, index_label="id")
+                    output_paths[trial] = csv_path
+                    print(f"📁 Saved results to {csv_path}")
+                if output_format in ("parquet", "both"):
+                    write_results_parquet(trial_stats[trial], parquet_path, flight)
+                    output_paths[trial] = output_paths[trial] or parquet_path
+                    print(f"📁 Saved results to {parquet_path}")
+        output_path = output_paths if trial_outputs else output_paths[None]
+        for trial, (csv_path, _) in output_files.items():
+            recorded = (extracted | reused)[output_rows[trial]]
+            write_plot_manifest(plot_manifest_path(csv_path), geojson_path[trial] if trial_outputs else geojson_path,
+                                output_ids[trial][recorded], geometry_hashes[output_rows[trial]][recorded])
+        mark_flight_complete(checkpoint, flight, ", ".join(output_paths.values()))
+        count("flights_processed", mode=extraction_mode)
+    finally:
+        checkpoint.close()
+    
+    # **Final memory check**
+    check_memory_usage()
+
+    return output_path
+
+
+@precise_timing_decorator
+def prepare_and_run_raster_processing(project_name, output_root_folder, ortho_dict, geojson_file_folder, extraction_mode="windowed", flight_type="MS", output_format="csv", indices=("NDVI",), plot_geom="none", incremental=False, trials=None):
+    """
+    Matches orthomosaics to the correct geojson file and prepares necessary data before running process_rasters().
+    Flights covering several trials are extracted once for all trials, see collect_flight_jobs().
+
+    Parameters:
+    - project_name (str): Name of the field project
+    - output_root_folder (str): Root path to store output CSV files.
+    - ortho_dict (dict): Dictionary mapping flight folders to lists of raster file paths
+      (the DSM/DTM files for 3D flights).
+    - geojson_file_folder (str): Path to the folder containing geojsonfiles.
+    - extraction_mode (str): Extraction engine to use. Options:
+        - "windowed": Reads only the window around each plot (default).
+        - "weighted": Windowed extraction weighting every pixel by the fraction of it covered by the plot.
+        - "full": Reads the window around each plot in float32, masking it with the full-grid validity (original process_rasters()).
+        - "label": Rasterizes all plots once and computes every plot in one pass per band.
+        - "shared": Windowed extraction in a process pool reading the bands from shared memory.
+        - "stream": Reads every band once, block by block, into per-plot moments and histograms
+          (bounded memory for very large mosaics; quantiles within one histogram bin, see process_rasters_streaming()).
+        - "height": Plant height (DSM - DTM) percentiles and canopy volume, streamed block by block
+          (always used for 3D flights, see process_canopy_height()).
+    - flight_type (str): Flight type ('MS' or '3D'), used as a partition of the Parquet results dataset.
+    - output_format (str): "csv", "parquet" or "both", see collect_flight_jobs().
+    - indices (list or dict): Vegetation indices to compute, e.g. ["NDVI", "NDRE", "GNDVI", "OSAVI"]
+      or {"NDVI": None, "CIre": "nir / rededge - 1"} (see vegetation_indices.resolve_indices()).
+    - plot_geom (str): Progress display, see process_flight(); "preview" keeps the extraction loop free of drawing.
+    - incremental (bool): Only re-extract the added and changed plots of flights whose geojson files changed,
+      see collect_flight_jobs() and process_flight().
+    - trials (list of str, optional): Geojson file names of the trials covered by the flights, see collect_flight_jobs().
+
+    Returns:
+    - None
+    """
+    for job in collect_flight_jobs(project_name, output_root_folder, ortho_dict, geojson_file_folder, flight_type=flight_type, output_format=output_format, incremental=incremental, trials=trials):
+        process_flight(**job, extraction_mode=extraction_mode, indices=indices, plot_geom=plot_geom)
+
 
+# Bytes per band-grid pixel alive at the peak of each extraction mode
+# (e.g. "label" holds the int32 labels, one native band, the float32 index inputs and the float64 sort buffers
+# of the in-plot pixels; "full" holds the full-grid validity mask).
+# The other modes hold the masks of every plot on the grid (float32 coverage fractions for "weighted"), and
+# "shared" also a full-grid validity mask, next to the bands it holds in shared memory in their native dtype.
+PEAK_BYTES_PER_PIXEL = {"full": 1, "label": 40, "shared": 2, "windowed": 1, "weighted": 4, "height": 1, "stream": 1}
 
-def process_multiple_projects(project_names, src_folder, flight_type, geojson_file_folder, output_root_folder):
+# Bytes per band pixel of the blocks read at once by the block-streaming modes (the float32 values and the
+# validity mask), and the in-plot heights buffered by "height" (int32 labels, float32 heights, float64 sort buffers)
+PEAK_BYTES_PER_BLOCK_PIXEL = {"stream": 8, "height": 8}
+CHM_BUFFER_BYTES = CHM_FLUSH_PIXELS * 16
+
+# Extraction modes reading through the block cache (see block_cache.py)
+BLOCK_CACHED_MODES = ("full", "windowed", "weighted")
+
+# Memory of each plot worker process of "shared" (interpreter and the geopandas, rasterio and numba imports)
+SHARED_WORKER_OVERHEAD_GB = 0.3
+
+def estimate_flight_memory(paths, extraction_mode="windowed", overhead_gb=0.5, workers=None):
+    """
+    Estimates the peak memory of process_flight() from the raster dimensions and dtypes,
+    without reading any pixels. The modes in BLOCK_CACHED_MODES add the block cache, up to the size of the bands.
+    3D flights (DSM and DTM only) are estimated in the "height" mode, as process_flight() runs them.
+
+    Parameters:
+    - paths (list of str): Raster file paths of the flight.
+    - extraction_mode (str): Extraction engine that will be used.
+    - overhead_gb (float): Fixed per-process overhead (interpreter, geopandas, GDAL cache).
+    - workers (int, optional): Number of plot worker processes of "shared" (default: number of CPUs).
+
+    Returns:
+    - int: Estimated peak memory in bytes.
+    """
+    band_paths = [
+        path for path in paths
+        if "_index_" in os.path.basename(path) or path.endswith(("_dsm.tif", "_dtm.tif"))
+    ]
+    if band_paths and not any("_index_" in os.path.basename(path) for path in band_paths):
+        extraction_mode = "height"
+
+    largest_pixels = 0  # Pixels of the largest band
+    total_native = 0  # Bytes of all bands in their own dtype
+    block_pixels = 0  # Pixels of one block of every band in the block-streaming modes
+    block_rows = CHM_BLOCK_ROWS if extraction_mode == "height" else STREAM_MIN_BLOCK_ROWS
+    for path in band_paths:
+        with rasterio.open(path) as src:
+            pixels = src.width * src.height
+            largest_pixels = max(largest_pixels, pixels)
+            total_native += pixels * np.dtype(src.dtypes[0]).itemsize
+            native_rows = src.block_shapes[0][0]
+            block_pixels += min(src.height, native_rows * math.ceil(block_rows / native_rows)) * src.width
+
+    bytes_per_pixel = PEAK_BYTES_PER_PIXEL.get(extraction_mode, max(PEAK_BYTES_PER_PIXEL.values()))
+    estimate = overhead_gb * 1024**3 + bytes_per_pixel * largest_pixels
+    estimate += PEAK_BYTES_PER_BLOCK_PIXEL.get(extraction_mode, 0) * block_pixels
+    if extraction_mode == "height":
+        estimate += min(CHM_BUFFER_BYTES, 16 * largest_pixels)
+    if extraction_mode == "shared":
+        estimate += total_native + (workers or os.cpu_count()) * SHARED_WORKER_OVERHEAD_GB * 1024**3
+    if extraction_mode in BLOCK_CACHED_MODES:
+        estimate += min(block_cache().max_bytes, total_native)
+    return int(estimate)
+
+
+def _process_flight_task(job, extraction_mode, indices, inner_workers):
+    """
+    Process pool task: runs process_flight() and returns its result with the worker's tracing aggregates
+    for this flight, which the parent merges into the run's metrics.
+    """
+    reset_tracing()
+    return process_flight(**job, extraction_mode=extraction_mode, indices=indices, max_workers=inner_workers), tracing_snapshot() if tracing_enabled() else None
+
+
+def run_flights_with_memory_budget(jobs, extraction_mode="windowed", memory_budget_gb=None, max_workers=None, indices=("NDVI",)):
+    """
+    Runs process_flight() for many flights concurrently in a process pool, admitting a flight only
+    while the sum of the estimated peak memory of the running flights fits under the budget.
+
+    Flights are admitted largest first. A flight larger than the whole budget is run on its own.
+    No new flight is admitted while check_memory_usage() reports high system memory use.
+
+    Parameters:
+    - jobs (list of dict): Flights to process, as returned by collect_flight_jobs().
+    - extraction_mode (str): Extraction engine, see prepare_and_run_raster_processing().
+    - memory_budget_gb (float, optional): Memory budget in GB. Defaults to 80% of the available memory.
+    - max_workers (int, optional): Maximum number of concurrent flights. Defaults to the number of CPUs.
+      With "shared", every flight runs about cpu_count // max_workers plot workers.
+    - indices (list or dict): Vegetation indices to compute, see prepare_and_run_raster_processing().
+
+    Returns:
+    - dict: {output_csv_path: saved path or None} for every job.
+    """
+    if memory_budget_gb:
+        budget = memory_budget_gb * 1024**3
+    else:
+        budget = psutil.virtual_memory().available * 0.8
+    max_workers = max_workers or os.cpu_count()
+    # "shared" runs its own plot workers in every flight: split the CPUs between the flights
+    inner_workers = max(1, os.cpu_count() // max_workers)
+
+    pending = [(job, estimate_flight_memory(job["paths"], extraction_mode, workers=inner_workers)) for job in jobs]
+    pending.sort(key=lambda item: item[1], reverse=True)
+    print(f"🗓️ Scheduling {len(pending)} flights on up to {max_workers} workers with a {budget / 1024**3:.1f} GB memory budget")
+
+    results = {}
+    running = {}  # future -> (job, estimated bytes)
+    in_use = 0
+
+    # Every worker loads the compiled kernels once and shares the CPUs with the other flights
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers, mp_context=kernel_pool_context(), initializer=warmup_kernels,
+                                                initargs=(pool_threads(max_workers),)) as executor:
+        while pending or running:
+            # Admit flights while their projected memory fits under the budget
+            while pending and len(running) < max_workers:
+                if running and check_memory_usage():
+                    break  # Let running flights finish before adding more load
+
+                admitted = next((item for item in pending if in_use + item[1] <= budget), None)
+                if admitted is None:
+                    if running:
+                        break  # Wait for memory to be released
+                    admitted = pending[0]
+                    print(f"⚠️ {admitted[0]['flight']} needs ~{admitted[1] / 1024**3:.1f} GB, more than the budget. Running it alone.")
+
+                pending.remove(admitted)
+                job, estimate = admitted
+                future = executor.submit(_process_flight_task, job, extraction_mode, indices, inner_workers)
+                running[future] = admitted
+                in_use += estimate
+                print(f"▶️ Started {job['flight']} (~{estimate / 1024**3:.1f} GB, {in_use / 1024**3:.1f} GB in use)")
+
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                job, estimate = running.pop(future)
+                in_use -= estimate
+                try:
+                    results[job["output_csv_path"]], worker_metrics = future.result()
+                    merge_tracing(worker_metrics)
+                    print(f"✅ Finished {job['flight']}")
+                except Exception as e:
+                    results[job["output_csv_path"]] = None
+                    print(f"❌ Flight {job['flight']} failed: {e}")
+
+    return results
+
+
+def process_multiple_projects(project_names, src_folder, flight_type, geojson_file_folder, output_root_folder, extraction_mode="windowed", max_workers=1, memory_budget_gb=None, output_format="csv", indices=("NDVI",), incremental=False, trials=None):
     """
     Processes multiple projects by fetching orthomosaic files, validating data, and running raster analysis.
 
@@ -1033,10 +3386,29 @@ def process_multiple_projects(project_names, src_folder, flight_type, geojson_fi
     - flight_type (str): Either 'MS' or '3D' indicating the flight type.
     - geojson_file_folder (str): Path to folder containing GeoJSON shapefiles.
     - output_root_folder (str): Folder where processed CSV files will be saved.
+    - extraction_mode (str): Extraction engine passed on to prepare_and_run_raster_processing().
+    - max_workers (int): Number of flights processed concurrently. 1 processes flights one at a time;
+                         more runs all flights of all projects through run_flights_with_memory_budget().
+    - memory_budget_gb (float, optional): Memory budget for concurrent processing (default: 80% of available memory).
+    - output_format (str): "csv", "parquet" or "both". Parquet results are written to a dataset partitioned by
+                           project, flight type and date in output_root_folder/results_dataset (see results_store.load_results()).
+    - indices (list or dict): Vegetation indices to compute, see prepare_and_run_raster_processing().
+    - incremental (bool): After the extraction polygons were regenerated, update the stored results of every flight of
+                          the season in one run: only the added and changed plots are extracted, removed plots are dropped
+                          and flights whose geojson files did not change are skipped (see process_flight()).
+    - trials (dict, optional): {project name: geojson file names of the trials covered by its flights}; the trials of a
+                               project are extracted together, see collect_flight_jobs().
+
+    When tracing is enabled (see tracing.enable_tracing()), the spans and counters of the run are written to
+    output_root_folder/extraction_<flight_type>_<timestamp>_metrics.json and .prom.
 
     Returns:
     - None
     """
+    jobs = []
+    run_started = datetime.now()
+    reset_tracing()
+
     for project_name in project_names:
         print(f"\n🚀 Processing Project: {project_name} | Flight Type: {flight_type}")
 
@@ -1058,9 +3430,24 @@ def process_multiple_projects(project_names, src_folder, flight_type, geojson_fi
         
         # Drop incomplete flights
         ortho_dict, dsm_dtm_dict = drop_incomplete_flights(ortho_dict, dsm_dtm_dict, missing, output_root_folder)
+
+        # 3D flights are processed from their DSM and DTM
+        flight_dict = dsm_dtm_dict if flight_type == "3D" else ortho_dict
         
         # **Step 4: Run raster processing**
-        prepare_and_run_raster_processing(project_name, output_root_folder, ortho_dict, geojson_file_folder)
+        project_trials = (trials or {}).get(project_name)
+        if max_workers == 1:
+            prepare_and_run_raster_processing(project_name, output_root_folder, flight_dict, geojson_file_folder, extraction_mode=extraction_mode, flight_type=flight_type, output_format=output_format, indices=indices, incremental=incremental, trials=project_trials)
+        else:
+            jobs.extend(collect_flight_jobs(project_name, output_root_folder, flight_dict, geojson_file_folder, flight_type=flight_type, output_format=output_format, incremental=incremental, trials=project_trials))
+
+    if jobs:
+        run_flights_with_memory_budget(jobs, extraction_mode=extraction_mode, memory_budget_gb=memory_budget_gb, max_workers=max_workers, indices=indices)
+
+    if tracing_enabled():
+        print("\n".join(tracing_summary()))
+        metrics_paths = export_run(output_root_folder, f"extraction_{flight_type}_{run_started:%Y%m%d_%H%M%S}")
+        print(f"📊 Saved run metrics to {', '.join(metrics_paths)}")
 
 if __name__ == "__main__":
     # Example usage
@@ -1071,8 +3458,8 @@ if __name__ == "__main__":
     geojson_file_folder = r'D:\PhenoCrop\3_qgis\3_Extraction Polygons\3. FINAL MASKS PYTHON'
     output_root_folder = r'D:\PhenoCrop\3_python'
 
-    # for flight_type in ["MS", "3D"]:  # Process both flight types
-    for flight_type in ["MS"]:  # Process only MS flight types
+    for flight_type in ["MS", "3D"]:  # Process both flight types
+    # for flight_type in ["MS"]:  # Process only MS flight types
         process_multiple_projects(project_names, src_folder, flight_type, geojson_file_folder, output_root_folder)
 
 
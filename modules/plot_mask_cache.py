@@ -0,0 +1,261 @@
+import os
+import pickle
+import hashlib
+import numpy as np
+import geopandas as gpd
+
+# On-disk cache of the geometry work of the raster extraction.
+# Flights over the same field reuse one GeoJSON and, most of the season, one Pix4D grid. The reprojected
+# plot geometries are cached by a hash of the GeoJSON content and the target CRS, and the plot read windows
+# with their pixel masks (or fractional pixel coverage) by a hash of the reprojected geometries, the transform
+# and the shape of the band grid, so repeat flights skip reading, reprojecting and rasterizing the plots.
+# The cache is bounded in size; the least recently used entries are evicted first.
+
+# Default cache location and size
+DEFAULT_CACHE_FOLDER = os.path.join(os.path.expanduser("~"), ".uav_plot_mask_cache")
+DEFAULT_MAX_CACHE_GB = 5
+
+
+def _file_digest(file_path):
+    """Returns the SHA-256 hex digest of a file's content."""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _touch(path):
+    """Marks a cache entry as recently used."""
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+
+def _write_atomically(path, write):
+    """Writes a cache entry through a temporary file, so concurrent flights never read a partial entry."""
+    partial_path = f"{path}.{os.getpid()}.partial"
+    with open(partial_path, "wb") as f:
+        write(f)
+    os.replace(partial_path, path)
+
+
+def evict_least_recently_used(cache_folder, max_cache_gb=DEFAULT_MAX_CACHE_GB):
+    """
+    Deletes the least recently used cache entries until the cache fits in max_cache_gb.
+
+    Parameters:
+    - cache_folder (str): Cache folder.
+    - max_cache_gb (float): Maximum cache size in GB.
+    """
+    entries = []
+    for name in os.listdir(cache_folder):
+        path = os.path.join(cache_folder, name)
+        if name.endswith(".partial") or not os.path.isfile(path):
+            continue
+        stat = os.stat(path)
+        entries.append((stat.st_mtime, stat.st_size, path))
+
+    total = sum(size for _, size, _ in entries)
+    max_bytes = max_cache_gb * 1024**3
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            pass  # Removed by another process or in use
+
+
+def load_plot_geometries(geojson_path, target_crs, cache_folder=DEFAULT_CACHE_FOLDER, max_cache_gb=DEFAULT_MAX_CACHE_GB):
+    """
+    Loads a plot GeoJSON with lowercase column names, reprojected to target_crs, from the cache if possible.
+
+    Parameters:
+    - geojson_path (str): Path to the GeoJSON file.
+    - target_crs: CRS of the rasters (e.g. rasterio's dataset.crs).
+    - cache_folder (str or None): Cache folder; None disables the cache.
+    - max_cache_gb (float): Maximum cache size in GB.
+
+    Returns:
+    - GeoDataFrame: Plot geometries in target_crs.
+    """
+    if cache_folder:
+        key = hashlib.sha256(f"{_file_digest(geojson_path)}|{target_crs}".encode()).hexdigest()
+        cache_path = os.path.join(cache_folder, f"geometries_{key}.pkl")
+        if os.path.exists(cache_path):
+            try:
+                with open(cache_path, "rb") as f:
+                    shp = pickle.load(f)
+                _touch(cache_path)
+                return shp
+            except Exception as e:
+                print(f"⚠️ Ignoring unreadable cache entry {cache_path}: {e}")
+
+    shp = gpd.read_file(geojson_path)
+    shp.columns = shp.columns.str.lower() # convert all column names in the GeoDataFrame to lowercase
+    if shp.crs != target_crs:
+        shp = shp.to_crs(target_crs)
+
+    if cache_folder:
+        os.makedirs(cache_folder, exist_ok=True)
+        _write_atomically(cache_path, lambda f: pickle.dump(shp, f, protocol=pickle.HIGHEST_PROTOCOL))
+        evict_least_recently_used(cache_folder, max_cache_gb)
+
+    return shp
+
+
+def plot_mask_key(geometries, crs, transform, shape, kind="mask"):
+    """
+    Returns the cache key of the plot masks (or coverage fractions) of a set of geometries on a band grid.
+
+    Parameters:
+    - geometries (iterable): Plot geometries in the raster CRS, in plot order.
+    - crs: CRS of the geometries and the raster.
+    - transform (Affine): Affine transform of the band grid.
+    - shape (tuple): (height, width) of the band grid.
+    - kind (str): "mask" for the centre-of-pixel masks, "coverage" for the coverage fractions.
+
+    Returns:
+    - str: Hex digest.
+    """
+    digest = hashlib.sha256(f"{kind}|{crs}|{tuple(transform)}|{tuple(shape)}".encode())
+    for geom in geometries:
+        wkb = b"" if geom is None else geom.wkb
+        digest.update(len(wkb).to_bytes(8, "little"))
+        digest.update(wkb)
+    return digest.hexdigest()
+
+
+def load_cached_plot_masks(key, cache_folder=DEFAULT_CACHE_FOLDER):
+    """
+    Loads the plot windows and masks stored under key.
+
+    Parameters:
+    - key (str): Key from plot_mask_key().
+    - cache_folder (str or None): Cache folder; None disables the cache.
+
+    Returns:
+    - list or None: One (window, mask) per plot as given to save_cached_plot_masks(), or None on a cache miss.
+      window is (col_off, row_off, width, height) or None; mask is a boolean (height, width) array or None.
+    """
+    if not cache_folder:
+        return None
+    cache_path = os.path.join(cache_folder, f"masks_{key}.npz")
+    if not os.path.exists(cache_path):
+        return None
+
+    try:
+        with np.load(cache_path) as data:
+            windows, offsets, bits = data["windows"], data["offsets"], data["bits"]
+    except Exception as e:
+        print(f"⚠️ Ignoring unreadable cache entry {cache_path}: {e}")
+        return None
+    _touch(cache_path)
+
+    plot_masks = []
+    for i, (col_off, row_off, width, height) in enumerate(windows.tolist()):
+        if width < 0:
+            plot_masks.append((None, None))
+            continue
+        mask = np.unpackbits(bits[offsets[i]:offsets[i + 1]], count=width * height).reshape(height, width).astype(bool)
+        plot_masks.append(((col_off, row_off, width, height), mask))
+    return plot_masks
+
+
+def save_cached_plot_masks(key, plot_masks, cache_folder=DEFAULT_CACHE_FOLDER, max_cache_gb=DEFAULT_MAX_CACHE_GB):
+    """
+    Stores plot windows and masks under key as bit-packed masks, then evicts old entries if needed.
+
+    Parameters:
+    - key (str): Key from plot_mask_key().
+    - plot_masks (list): One (window, mask) per plot, see load_cached_plot_masks().
+    - cache_folder (str or None): Cache folder; None disables the cache.
+    - max_cache_gb (float): Maximum cache size in GB.
+    """
+    if not cache_folder:
+        return
+
+    windows = np.full((len(plot_masks), 4), -1, dtype=np.int64)
+    packed = []
+    for i, (window, mask) in enumerate(plot_masks):
+        if window is None:
+            packed.append(np.empty(0, dtype=np.uint8))
+            continue
+        windows[i] = window
+        packed.append(np.packbits(mask.ravel()))
+    offsets = np.concatenate(([0], np.cumsum([len(p) for p in packed]))).astype(np.int64)
+    bits = np.concatenate(packed) if packed else np.empty(0, dtype=np.uint8)
+
+    os.makedirs(cache_folder, exist_ok=True)
+    cache_path = os.path.join(cache_folder, f"masks_{key}.npz")
+    _write_atomically(cache_path, lambda f: np.savez(f, windows=windows, offsets=offsets, bits=bits))
+    evict_least_recently_used(cache_folder, max_cache_gb)
+
+
+def load_cached_plot_coverage(key, cache_folder=DEFAULT_CACHE_FOLDER):
+    """
+    Loads the plot windows and pixel coverage fractions stored under key.
+
+    Parameters:
+    - key (str): Key from plot_mask_key(..., kind="coverage").
+    - cache_folder (str or None): Cache folder; None disables the cache.
+
+    Returns:
+    - list or None: One (window, coverage) per plot as given to save_cached_plot_coverage(), or None on a cache miss.
+      window is (col_off, row_off, width, height) or None; coverage is a float32 (height, width) array or None.
+    """
+    if not cache_folder:
+        return None
+    cache_path = os.path.join(cache_folder, f"coverage_{key}.npz")
+    if not os.path.exists(cache_path):
+        return None
+
+    try:
+        with np.load(cache_path) as data:
+            windows, offsets, values = data["windows"], data["offsets"], data["values"]
+    except Exception as e:
+        print(f"⚠️ Ignoring unreadable cache entry {cache_path}: {e}")
+        return None
+    _touch(cache_path)
+
+    plot_coverage = []
+    for i, (col_off, row_off, width, height) in enumerate(windows.tolist()):
+        if width < 0:
+            plot_coverage.append((None, None))
+            continue
+        plot_coverage.append(((col_off, row_off, width, height), values[offsets[i]:offsets[i + 1]].reshape(height, width)))
+    return plot_coverage
+
+
+def save_cached_plot_coverage(key, plot_coverage, cache_folder=DEFAULT_CACHE_FOLDER, max_cache_gb=DEFAULT_MAX_CACHE_GB):
+    """
+    Stores plot windows and pixel coverage fractions under key (compressed; most fractions are 0 or 1),
+    then evicts old entries if needed.
+
+    Parameters:
+    - key (str): Key from plot_mask_key(..., kind="coverage").
+    - plot_coverage (list): One (window, coverage) per plot, see load_cached_plot_coverage().
+    - cache_folder (str or None): Cache folder; None disables the cache.
+    - max_cache_gb (float): Maximum cache size in GB.
+    """
+    if not cache_folder:
+        return
+
+    windows = np.full((len(plot_coverage), 4), -1, dtype=np.int64)
+    flat = []
+    for i, (window, coverage) in enumerate(plot_coverage):
+        if window is None:
+            flat.append(np.empty(0, dtype=np.float32))
+            continue
+        windows[i] = window
+        flat.append(np.asarray(coverage, dtype=np.float32).ravel())
+    offsets = np.concatenate(([0], np.cumsum([len(f) for f in flat]))).astype(np.int64)
+    values = np.concatenate(flat) if flat else np.empty(0, dtype=np.float32)
+
+    os.makedirs(cache_folder, exist_ok=True)
+    cache_path = os.path.join(cache_folder, f"coverage_{key}.npz")
+    _write_atomically(cache_path, lambda f: np.savez_compressed(f, windows=windows, offsets=offsets, values=values))
+    evict_least_recently_used(cache_folder, max_cache_gb)
@@ -0,0 +1,153 @@
+import os
+import time
+import multiprocessing
+import numpy as np
+
+# Live progress preview of the extraction runs.
+# The preview is drawn by a separate process at a bounded frame rate. The extraction loop only writes the
+# status of a plot into a shared byte array (no locks, no messages, no drawing). The renderer draws the
+# orthomosaic thumbnail and the plot polygons once, as a single polygon collection, and for every frame
+# only recolours that collection from the status array.
+
+# Plot states in the shared status array
+UNPROCESSED, PROCESSING, PROCESSED, SKIPPED = 0, 1, 2, 3
+
+# Face colours of the states
+PREVIEW_COLORS = {
+    UNPROCESSED: "lightslategrey",
+    PROCESSING: "khaki",
+    PROCESSED: "green",
+    SKIPPED: "red",
+}
+
+# Default upper bound of the frames drawn per second
+DEFAULT_MAX_FPS = 2
+
+
+def _render_preview(geometries_wkb, plot_ids, ortho_path, title, max_fps, output_path, status, current, stop):
+    """Renderer process: draws the base image once, then recolours the plots at most max_fps times per second."""
+    import matplotlib
+    if output_path:
+        matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    import shapely
+    from matplotlib.collections import PatchCollection
+    from matplotlib.colors import to_rgba
+    from shapely.plotting import patch_from_polygon
+
+    geometries = shapely.from_wkb(geometries_wkb)
+    fig, ax = plt.subplots(figsize=(6, 6))
+
+    # Base image, drawn once
+    if ortho_path:
+        import rasterio
+        from rasterio.plot import show
+        with rasterio.open(ortho_path) as src:
+            show(src, ax=ax, adjust="box")
+
+    # One patch per plot, so the facecolours of the collection line up with the status array
+    drawable = [geom is not None and not geom.is_empty for geom in geometries]
+    patches = [patch_from_polygon(geom) for geom, ok in zip(geometries, drawable) if ok]
+    drawn = np.flatnonzero(drawable)
+    collection = PatchCollection(patches, edgecolor="black", linewidth=0.25, alpha=0.5)
+    ax.add_collection(collection)
+    minx, miny, maxx, maxy = shapely.total_bounds(geometries)
+    ax.set_xlim(minx, maxx)
+    ax.set_ylim(miny, maxy)
+
+    palette = np.array([to_rgba(PREVIEW_COLORS[state]) for state in sorted(PREVIEW_COLORS)])
+    states = np.frombuffer(status, dtype=np.int8)
+    n_plots = len(states)
+
+    def draw():
+        snapshot = states[drawn].copy()
+        collection.set_facecolor(palette[snapshot])
+        done = int(np.isin(states, (PROCESSED, SKIPPED)).sum())
+        plot_index = current.value
+        plot_text = f"plot {plot_ids[plot_index]}" if 0 <= plot_index < n_plots else "waiting"
+        ax.set_title(f"{title}\n{done}/{n_plots} plots, {plot_text}", fontsize=11)
+        if output_path:
+            partial_path = f"{output_path}.partial.png"
+            fig.savefig(partial_path, dpi=100)
+            os.replace(partial_path, output_path)
+        else:
+            fig.canvas.draw_idle()
+
+    if not output_path:
+        plt.show(block=False)
+
+    frame_interval = 1 / max_fps
+    while not stop.value:
+        started = time.perf_counter()
+        draw()
+        remaining = frame_interval - (time.perf_counter() - started)
+        if output_path:
+            time.sleep(max(remaining, 0))
+        else:
+            plt.pause(max(remaining, 0.001))  # Keeps the window responsive
+
+    draw()  # Final state
+    plt.close(fig)
+
+
+class ProgressPreview:
+    """
+    Live progress preview of a plot loop, rendered by a separate process.
+
+    Usage:
+        with ProgressPreview(shp_crs, ortho_path=thumb_path, title=flight) as preview:
+            for i, geom in enumerate(shp_crs.geometry):
+                preview.processing(i)
+                ...
+                preview.processed(i)
+
+    Parameters:
+    - shapefile (GeoDataFrame): Plot polygons with an 'id' column, in the CRS of ortho_path.
+    - ortho_path (str, optional): Thumbnail drawn under the plots (e.g. the downscaled RGB mosaic).
+    - title (str): Title of the preview.
+    - max_fps (float): Upper bound of the frames drawn per second.
+    - output_path (str, optional): Write the frames to this PNG file (replaced atomically) instead of
+      showing a window; use it on machines without a display or to show the preview elsewhere.
+    """
+
+    def __init__(self, shapefile, ortho_path=None, title="", max_fps=DEFAULT_MAX_FPS, output_path=None):
+        self.n_plots = len(shapefile)
+        context = multiprocessing.get_context("spawn")
+        self._status = context.RawArray("b", self.n_plots)
+        self._current = context.RawValue("i", -1)
+        self._stop = context.RawValue("b", 0)
+        self._process = context.Process(
+            target=_render_preview,
+            args=(shapefile.geometry.to_wkb().tolist(), shapefile["id"].tolist(), ortho_path, title, max_fps,
+                  output_path, self._status, self._current, self._stop),
+            daemon=True,
+        )
+        self._process.start()
+
+    def mark(self, index, state):
+        """Sets the state of the plot at position index (a byte write; the renderer picks it up)."""
+        self._status[index] = state
+        if state == PROCESSING:
+            self._current.value = index
+
+    def processing(self, index):
+        self.mark(index, PROCESSING)
+
+    def processed(self, index):
+        self.mark(index, PROCESSED)
+
+    def skipped(self, index):
+        self.mark(index, SKIPPED)
+
+    def close(self, timeout=10):
+        """Draws the final frame and stops the renderer."""
+        self._stop.value = 1
+        self._process.join(timeout)
+        if self._process.is_alive():
+            self._process.terminate()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,119 @@
+import os
+import re
+import glob
+import numpy as np
+import pandas as pd
+
+# Columnar results store for the plot statistics.
+# Each flight is written as one Parquet file of typed float32 columns into a dataset partitioned by
+# project, flight type and date (project=<name>/flight_type=<MS|3D>/date=<YYYY-MM-DD>/<flight>.parquet),
+# so season-level analyses read only the columns and partitions they need instead of parsing every CSV.
+
+# Default folder name of the results dataset inside the output root folder
+RESULTS_DATASET_FOLDER = "results_dataset"
+
+
+def flight_date(flight):
+    """
+    Extracts the flight date from a flight folder name starting with YYYYMMDD.
+
+    Parameters:
+    - flight (str): Flight folder name, e.g. '20240612 E166 M3M 30m MS'.
+
+    Returns:
+    - str: Date as 'YYYY-MM-DD', or 'unknown' if the name does not start with a date.
+    """
+    match = re.match(r"(\d{4})(\d{2})(\d{2})", os.path.basename(flight))
+    return "-".join(match.groups()) if match else "unknown"
+
+
+def results_partition_path(dataset_root, project_name, flight_type, flight):
+    """
+    Returns the Parquet file path of a flight inside the partitioned results dataset.
+
+    Parameters:
+    - dataset_root (str): Root folder of the results dataset.
+    - project_name (str): Name of the field project.
+    - flight_type (str): Flight type ('MS' or '3D').
+    - flight (str): Flight folder name.
+
+    Returns:
+    - str: Path of the flight's Parquet file.
+    """
+    return os.path.join(
+        dataset_root,
+        f"project={project_name}",
+        f"flight_type={flight_type}",
+        f"date={flight_date(flight)}",
+        f"{os.path.basename(flight)}.parquet"
+    )
+
+
+def write_results_parquet(stats_df, output_parquet_path, flight):
+    """
+    Writes the statistics of one flight as typed float32 columns to a Parquet file.
+    The file is written through a temporary '.partial' file that is renamed into place.
+
+    Parameters:
+    - stats_df (DataFrame): Statistics indexed by plot ID.
+    - output_parquet_path (str): Path from results_partition_path().
+    - flight (str): Flight folder name, stored as a column so files can be told apart after loading.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    columns = {
+        "id": pa.array(stats_df.index.astype(str)),
+        "flight": pa.array(np.full(len(stats_df), os.path.basename(flight), dtype=object), type=pa.string()),
+    }
+    values = stats_df.to_numpy(dtype=np.float32, na_value=np.nan)
+    for i, column in enumerate(stats_df.columns):
+        columns[column] = pa.array(values[:, i], type=pa.float32(), from_pandas=True)
+
+    os.makedirs(os.path.dirname(output_parquet_path), exist_ok=True)
+    partial_path = output_parquet_path + ".partial"
+    pq.write_table(pa.table(columns), partial_path, compression="zstd")
+    os.replace(partial_path, output_parquet_path)
+
+
+def load_results(dataset_root, columns=None, projects=None, flight_types=None, dates=None):
+    """
+    Loads plot statistics from the partitioned results dataset, reading only the requested columns
+    and partitions.
+
+    Parameters:
+    - dataset_root (str): Root folder of the results dataset.
+    - columns (list of str, optional): Statistics columns to read (e.g. ['NDVI_mean', 'NDVI_median']).
+      The 'id', 'flight' and partition columns are always included. Default: all columns.
+    - projects (list of str, optional): Projects to load. Default: all.
+    - flight_types (list of str, optional): Flight types to load. Default: all.
+    - dates (list of str, optional): Dates ('YYYY-MM-DD') to load. Default: all.
+
+    Returns:
+    - DataFrame: One row per plot and flight.
+    """
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    partitioning = ds.partitioning(
+        pa.schema([("project", pa.string()), ("flight_type", pa.string()), ("date", pa.string())]),
+        flavor="hive"
+    )
+    # Only complete files; '.partial' files of interrupted writes are left out
+    files = sorted(glob.glob(os.path.join(dataset_root, "**", "*.parquet"), recursive=True))
+    if not files:
+        print(f"⚠️ No results found in {dataset_root}")
+        return pd.DataFrame()
+
+    dataset = ds.dataset(files, format="parquet", partitioning=partitioning, partition_base_dir=dataset_root)
+
+    filters = None
+    for field, values in [("project", projects), ("flight_type", flight_types), ("date", dates)]:
+        if values is not None:
+            condition = ds.field(field).isin(list(values))
+            filters = condition if filters is None else filters & condition
+
+    if columns is not None:
+        columns = ["id", "flight", "project", "flight_type", "date", *[c for c in columns if c not in ("id", "flight")]]
+
+    return dataset.to_table(columns=columns, filter=filters).to_pandas()
@@ -0,0 +1,445 @@
+import os
+import math
+import multiprocessing
+import numpy as np
+import numba
+from numba import njit, prange
+
+# Compiled kernels of the per-plot hot loops.
+# The grouped kernels take pixel values sorted by plot (as in grouped_band_statistics()) and loop over the
+# plots in parallel, one plot per iteration, so no two threads write the same output. The element-wise
+# kernels are serial and release the GIL: they are called from thread pools, and a parallel kernel
+# launched from several threads at once aborts the default (workqueue) threading layer.
+# Every kernel is cached on disk (see NUMBA_CACHE_DIR), so a new process loads the machine code instead
+# of compiling it; warmup_kernels() does that load up front, e.g. as a process pool initializer.
+# Process pools running the kernels must not fork: a process forked after a parallel kernel ran hangs on
+# its first parallel kernel, so they use kernel_pool_context() (spawn, as on Windows).
+
+# Options shared by the kernels
+KERNEL_OPTIONS = {"cache": True, "nogil": True}
+
+_warmed_up = False
+
+
+@njit(**KERNEL_OPTIONS)
+def _ndvi_kernel(nir, red, valid, use_valid, out):
+    for i in range(nir.shape[0]):
+        for j in range(nir.shape[1]):
+            n = np.float32(nir[i, j])
+            r = np.float32(red[i, j])
+            total = n + r
+            if (use_valid and not valid[i, j]) or total == 0:
+                out[i, j] = np.nan
+            else:
+                out[i, j] = (n - r) / total
+
+
+def masked_ndvi(nir, red, valid=None):
+    """
+    Computes NDVI in float32 in one pass over the bands, NaN where nir + red is 0 or valid is False.
+
+    Parameters:
+    - nir, red (np.ndarray): Bands (or pixel vectors) of the same shape, any numeric dtype.
+    - valid (np.ndarray, optional): Boolean mask of the valid pixels (see window_validity()), same shape.
+
+    Returns:
+    - np.ndarray: float32 NDVI of the shape of the bands.
+    """
+    nir, red = np.asarray(nir), np.asarray(red)
+    out = np.empty(nir.shape, dtype=np.float32)
+    # The kernel runs over rows of the last axis
+    rows = (math.prod(nir.shape[:-1]), nir.shape[-1]) if nir.ndim else (1, 1)
+    use_valid = valid is not None
+    valid = np.asarray(valid, dtype=np.bool_).reshape(rows) if use_valid else np.empty((0, 0), dtype=np.bool_)
+    _ndvi_kernel(nir.reshape(rows), red.reshape(rows), valid, use_valid, out.reshape(rows))
+    return out
+
+
+@njit(parallel=True, **KERNEL_OPTIONS)
+def _grouped_moments_kernel(values, starts, counts):
+    n_groups = starts.size
+    n_valid = np.zeros(n_groups, dtype=np.int64)
+    total = np.zeros(n_groups)
+    m2 = np.zeros(n_groups)
+    m3 = np.zeros(n_groups)
+    m4 = np.zeros(n_groups)
+    for g in prange(n_groups):
+        k = 0
+        s = 0.0
+        for i in range(starts[g], starts[g] + counts[g]):
+            if not np.isnan(values[i]):
+                k += 1
+                s += values[i]
+        n_valid[g] = k
+        total[g] = s
+        if k == 0:
+            continue
+        mean = s / k
+        a2 = 0.0
+        a3 = 0.0
+        a4 = 0.0
+        for i in range(starts[g], starts[g] + counts[g]):
+            if not np.isnan(values[i]):
+                deviation = values[i] - mean
+                deviation2 = deviation * deviation
+                a2 += deviation2
+                a3 += deviation2 * deviation
+                a4 += deviation2 * deviation2
+        m2[g] = a2
+        m3[g] = a3
+        m4[g] = a4
+    return n_valid, total, m2, m3, m4
+
+
+def grouped_moments(values, starts, counts):
+    """
+    Computes the number of valid values, the sum and the summed central moments of every plot.
+
+    Parameters:
+    - values (np.ndarray): float64 pixel values sorted by plot (NaNs are ignored).
+    - starts (np.ndarray): int64 position of the first value of every plot.
+    - counts (np.ndarray): int64 number of values of every plot.
+
+    Returns:
+    - tuple: (n_valid, sum, m2, m3, m4) arrays with one entry per plot; m2..m4 are sums of the
+      squared, cubed and fourth-power deviations from the plot mean (0 for plots without valid values).
+    """
+    return _grouped_moments_kernel(
+        np.ascontiguousarray(values, dtype=np.float64),
+        np.ascontiguousarray(starts, dtype=np.int64),
+        np.ascontiguousarray(counts, dtype=np.int64),
+    )
+
+
+@njit(parallel=True, **KERNEL_OPTIONS)
+def _grouped_histogram_kernel(values, starts, counts, low, high, hist):
+    n_bins = hist.shape[1]
+    scale = n_bins / (high - low)
+    for g in prange(starts.size):
+        for i in range(starts[g], starts[g] + counts[g]):
+            value = values[i]
+            if np.isnan(value) or value < low or value > high:
+                continue
+            b = int((value - low) * scale)
+            if b >= n_bins:
+                b = n_bins - 1  # The upper edge belongs to the last bin, as in np.histogram
+            hist[g, b] += 1
+
+
+def accumulate_grouped_histogram(values, starts, counts, low, high, hist):
+    """
+    Adds the values of every plot to its row of a histogram with equal-width bins.
+
+    Parameters:
+    - values (np.ndarray): float64 pixel values sorted by plot.
+    - starts, counts (np.ndarray): int64 position of the first value and number of values of every plot.
+    - low, high (float): Range of the bins; NaNs and values outside the range are not counted.
+    - hist (np.ndarray): int64 array of shape (n_plots, n_bins), updated in place.
+
+    Returns:
+    - np.ndarray: hist.
+    """
+    if high <= low:
+        raise ValueError("The histogram range must have high > low.")
+    _grouped_histogram_kernel(
+        np.ascontiguousarray(values, dtype=np.float64),
+        np.ascontiguousarray(starts, dtype=np.int64),
+        np.ascontiguousarray(counts, dtype=np.int64),
+        float(low), float(high), hist,
+    )
+    return hist
+
+
+def warmup_kernels(n_threads=None):
+    """
+    Loads (or compiles, on the first run) every kernel for the dtypes the extraction uses, once per process.
+    Use it as a process pool initializer so no task pays the compilation.
+
+    Parameters:
+    - n_threads (int, optional): Threads of the parallel kernels in this process, e.g. the CPUs divided
+      by the number of pool workers to avoid oversubscription.
+    """
+    global _warmed_up
+    if n_threads:
+        numba.set_num_threads(max(1, min(int(n_threads), numba.config.NUMBA_NUM_THREADS)))
+    if _warmed_up:
+        return
+
+    band = np.ones((2, 2), dtype=np.float32)
+    masked_ndvi(band, band)
+    masked_ndvi(band, band, np.ones((2, 2), dtype=bool))
+    values = np.array([1.0, 2.0, np.nan])
+    starts = np.array([0, 2], dtype=np.int64)
+    counts = np.array([2, 1], dtype=np.int64)
+    grouped_moments(values, starts, counts)
+    accumulate_grouped_histogram(values, starts, counts, 0.0, 2.0, np.zeros((2, 4), dtype=np.int64))
+    accumulator = PlotHistogramAccumulator(2, n_bins=4)
+    accumulator.add(values, np.array([0, 0, 1]))
+    accumulator.summary(np.arange(2), (0.5,), np.ones((2, 1), dtype=np.int64))
+    _warmed_up = True
+
+
+def pool_threads(max_workers):
+    """Returns the kernel threads per worker process that share the CPUs between max_workers processes."""
+    return max(1, (os.cpu_count() or 1) // max(1, max_workers or os.cpu_count() or 1))
+
+
+def kernel_pool_context():
+    """Returns the multiprocessing context of process pools that run the kernels (spawn, see above)."""
+    return multiprocessing.get_context("spawn")
+
+
+# Streaming accumulation: per-plot moments and fixed-bin histograms updated block by block.
+# Every plot keeps n_bins equal-width bins. Its range starts at the spread of its first block and is
+# doubled (merging neighbouring bins) whenever a later value falls outside, so the memory per plot is
+# fixed and every value is counted in a bin of the plot's final width. Values reconstructed from the
+# histogram (quantiles, top fractions) are therefore within one bin width of the exact values, and the
+# majority and minority are the centres of the fullest and emptiest bins. Integer bands start with unit
+# bins centred on the integers, which stay exact while the plot's values span fewer than n_bins levels.
+
+# Default number of histogram bins per plot and band
+HISTOGRAM_BINS = 1024
+
+
+@njit(**KERNEL_OPTIONS)
+def _double_bin_width(row, low, width, downwards):
+    """Merges neighbouring bins of a histogram row, extending its range down or up; returns the new low."""
+    n_bins = row.size
+    half = n_bins // 2
+    if downwards:
+        for j in range(n_bins - 1, half - 1, -1):
+            row[j] = row[2 * (j - half)] + row[2 * (j - half) + 1]
+        row[:half] = 0
+        return low - width * n_bins
+    for j in range(half):
+        row[j] = row[2 * j] + row[2 * j + 1]
+    row[half:] = 0
+    return low
+
+
+@njit(**KERNEL_OPTIONS)
+def _accumulate_kernel(values, groups, count, n_valid, mean, m2, m3, m4, minimum, maximum, low, width, hist, integer):
+    n_bins = hist.shape[1]
+
+    # Bin ranges of the plots seen for the first time, from the spread of their values in this block
+    block_low = np.full(count.size, np.inf)
+    block_high = np.full(count.size, -np.inf)
+    for i in range(values.size):
+        g = groups[i]
+        value = values[i]
+        if width[g] == 0 and np.isfinite(value):
+            block_low[g] = min(block_low[g], value)
+            block_high[g] = max(block_high[g], value)
+    for g in range(count.size):
+        if width[g] == 0 and block_low[g] <= block_high[g]:
+            if integer:
+                low[g] = np.floor(block_low[g]) - 0.5
+                width[g] = 1.0
+            else:
+                spread = block_high[g] - block_low[g]
+                low[g] = block_low[g]
+                width[g] = spread / n_bins * (1 + 1e-9) if spread > 0 else max(abs(block_low[g]), 1.0) * 1e-9
+
+    for i in range(values.size):
+        g = groups[i]
+        value = values[i]
+        count[g] += 1
+        if np.isnan(value):
+            continue
+
+        # Online central moments (Welford / Terriberry)
+        n1 = float(n_valid[g])
+        n = n1 + 1
+        n_valid[g] += 1
+        delta = value - mean[g]
+        delta_n = delta / n
+        delta_n2 = delta_n * delta_n
+        term = delta * delta_n * n1
+        mean[g] += delta_n
+        m4[g] += term * delta_n2 * (n * n - 3 * n + 3) + 6 * delta_n2 * m2[g] - 4 * delta_n * m3[g]
+        m3[g] += term * delta_n * (n - 2) - 3 * delta_n * m2[g]
+        m2[g] += term
+        minimum[g] = min(minimum[g], value)
+        maximum[g] = max(maximum[g], value)
+
+        if not np.isfinite(value):
+            continue  # Infinities have no bin
+        while value < low[g]:
+            low[g] = _double_bin_width(hist[g], low[g], width[g], True)
+            width[g] *= 2
+        while value >= low[g] + width[g] * n_bins:
+            low[g] = _double_bin_width(hist[g], low[g], width[g], False)
+            width[g] *= 2
+        b = min(int((value - low[g]) / width[g]), n_bins - 1)
+        hist[g, b] += 1
+
+
+@njit(**KERNEL_OPTIONS)
+def _rank_value(row, cumulative, low, width, exact, rank, minimum, maximum):
+    """Value of the pixel of a given rank (0-based), spreading the values of a bin evenly over the bin."""
+    total = cumulative[-1]
+    if rank <= 0:
+        return minimum
+    if rank >= total - 1:
+        return maximum
+    b = np.searchsorted(cumulative, rank, side="right")
+    if exact:
+        value = low + width * (b + 0.5)
+    else:
+        before = cumulative[b - 1] if b > 0 else 0
+        value = low + width * (b + (rank - before + 0.5) / row[b])
+    return min(max(value, minimum), maximum)
+
+
+@njit(**KERNEL_OPTIONS)
+def _position_value(row, cumulative, low, width, exact, position, minimum, maximum):
+    """Linear-interpolated value at a fractional rank, as np.nanpercentile."""
+    lower = np.floor(position)
+    upper = min(lower + 1, cumulative[-1] - 1)
+    lower_value = _rank_value(row, cumulative, low, width, exact, lower, minimum, maximum)
+    upper_value = _rank_value(row, cumulative, low, width, exact, upper, minimum, maximum)
+    return lower_value + (position - lower) * (upper_value - lower_value)
+
+
+@njit(parallel=True, **KERNEL_OPTIONS)
+def _histogram_summary_kernel(hist, low, width, exact, minimum, maximum, quantiles, top_counts):
+    n_plots, n_bins = hist.shape
+    quantile_values = np.full((n_plots, quantiles.size), np.nan)
+    top_mean = np.full(top_counts.shape, np.nan)
+    top_median = np.full(top_counts.shape, np.nan)
+    top_std = np.full(top_counts.shape, np.nan)
+    majority = np.full(n_plots, np.nan)
+    minority = np.full(n_plots, np.nan)
+    majority_count = np.zeros(n_plots)
+    minority_count = np.zeros(n_plots)
+    occupied = np.zeros(n_plots)
+    for p in prange(n_plots):
+        row = hist[p]
+        cumulative = np.cumsum(row)
+        total = cumulative[-1]
+        if total == 0:
+            continue
+        for k in range(quantiles.size):
+            quantile_values[p, k] = _position_value(row, cumulative, low[p], width[p], exact[p], quantiles[k] * (total - 1), minimum[p], maximum[p])
+
+        most = 0
+        fewest = 0
+        for b in range(n_bins):
+            if row[b] > 0:
+                occupied[p] += 1
+                if row[b] > row[most]:
+                    most = b
+                if row[fewest] == 0 or row[b] < row[fewest]:
+                    fewest = b
+        majority[p] = min(max(low[p] + width[p] * (most + 0.5), minimum[p]), maximum[p])
+        minority[p] = min(max(low[p] + width[p] * (fewest + 0.5), minimum[p]), maximum[p])
+        majority_count[p] = row[most]
+        minority_count[p] = row[fewest]
+
+        # Top fractions: the highest k values, taken from the top bins (evenly spread within each bin)
+        for f in range(top_counts.shape[1]):
+            k = float(min(top_counts[p, f], total))
+            remaining = k
+            offset_sum = 0.0
+            offset_squares = 0.0
+            for b in range(n_bins - 1, -1, -1):
+                h = float(row[b])
+                if h == 0:
+                    continue
+                m = min(h, remaining)
+                if exact[p]:
+                    base = width[p] * (b + 0.5)
+                    step = 0.0
+                else:
+                    base = width[p] * b
+                    step = width[p] / h
+                # Values base + step * (j + 0.5) for the top m positions j = h - m .. h - 1 of the bin
+                first = h - m
+                positions = m * (first + h) / 2
+                position_squares = (h ** 3 - first ** 3) / 3 - (h - first) / 12
+                offset_sum += m * base + step * positions
+                offset_squares += m * base * base + 2 * base * step * positions + step * step * position_squares
+                remaining -= m
+                if remaining == 0:
+                    break
+            mean = offset_sum / k
+            top_mean[p, f] = min(max(low[p] + mean, minimum[p]), maximum[p])
+            top_std[p, f] = np.sqrt(max(offset_squares / k - mean * mean, 0.0))
+            top_median[p, f] = _position_value(row, cumulative, low[p], width[p], exact[p], total - k + (k - 1) / 2, minimum[p], maximum[p])
+    return quantile_values, top_mean, top_median, top_std, majority, minority, majority_count, minority_count, occupied
+
+
+class PlotHistogramAccumulator:
+    """
+    Streaming per-plot statistics of one band: pixel counts, exact moments, min and max, and a
+    fixed-size histogram per plot (see above), updated with the pixels of one block at a time.
+
+    Parameters:
+    - n_plots (int): Number of plots.
+    - n_bins (int): Histogram bins per plot (even); memory is n_plots * n_bins * 4 bytes.
+    - integer (bool): The band has integer values (unit bins centred on the integers).
+
+    Attributes:
+    - count, n_valid, mean, m2, m3, m4, minimum, maximum: Per-plot pixel count (NaNs included), valid
+      count, mean and summed central moments of the valid values, and their range.
+    - low, width, hist: Per-plot histogram range start, bin width and bin counts. width is the error
+      bound of the values reconstructed from the histogram (see summary()).
+    """
+
+    def __init__(self, n_plots, n_bins=HISTOGRAM_BINS, integer=False):
+        if n_bins < 2 or n_bins % 2:
+            raise ValueError("n_bins must be an even number of at least 2.")
+        self.integer = integer
+        self.count = np.zeros(n_plots, dtype=np.int64)
+        self.n_valid = np.zeros(n_plots, dtype=np.int64)
+        self.mean = np.zeros(n_plots)
+        self.m2 = np.zeros(n_plots)
+        self.m3 = np.zeros(n_plots)
+        self.m4 = np.zeros(n_plots)
+        self.minimum = np.full(n_plots, np.inf)
+        self.maximum = np.full(n_plots, -np.inf)
+        self.low = np.zeros(n_plots)
+        self.width = np.zeros(n_plots)
+        self.hist = np.zeros((n_plots, n_bins), dtype=np.int32)
+
+    def add(self, values, groups):
+        """
+        Adds pixel values to their plots.
+
+        Parameters:
+        - values (np.ndarray): Pixel values, in any order.
+        - groups (np.ndarray): Plot index (0-based) of every value.
+        """
+        _accumulate_kernel(
+            np.ascontiguousarray(values, dtype=np.float64), np.ascontiguousarray(groups, dtype=np.int64),
+            self.count, self.n_valid, self.mean, self.m2, self.m3, self.m4, self.minimum, self.maximum,
+            self.low, self.width, self.hist, self.integer,
+        )
+
+    def summary(self, rows, quantiles, top_counts):
+        """
+        Reconstructs histogram statistics for some plots.
+
+        Quantiles (linear interpolation between ranks, as np.nanpercentile) and the mean, median and std of
+        the top values are within one bin width (self.width) of the exact values. The majority and minority
+        are the centres of the fullest and emptiest occupied bins (ties: the lowest bin), i.e. the mode of the
+        binned values. All are exact for integer plots still on unit bins. "occupied" counts the non-empty bins.
+
+        Parameters:
+        - rows (np.ndarray): Plot indices.
+        - quantiles (sequence of float): Quantiles in [0, 1].
+        - top_counts (np.ndarray): int64 (len(rows), n_fractions) number of top values of every plot and fraction.
+
+        Returns:
+        - dict: {"quantiles": (len(rows), len(quantiles)), "top_mean", "top_median", "top_std":
+          (len(rows), n_fractions), "majority", "minority", "majority_count", "minority_count" (pixels in
+          those bins), "occupied": (len(rows),)} float arrays.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        exact = self.integer & (self.width[rows] == 1.0)
+        results = _histogram_summary_kernel(
+            self.hist[rows], self.low[rows], self.width[rows], exact, self.minimum[rows], self.maximum[rows],
+            np.asarray(quantiles, dtype=np.float64), np.ascontiguousarray(top_counts, dtype=np.int64),
+        )
+        names = ("quantiles", "top_mean", "top_median", "top_std", "majority", "minority", "majority_count", "minority_count", "occupied")
+        return dict(zip(names, results))
@@ -0,0 +1,243 @@
+import os
+import json
+import hashlib
+import concurrent.futures
+import rasterio
+from rasterio.io import MemoryFile
+from rasterio.enums import Resampling
+
+# Thumbnail and downscale service for the orthomosaics.
+# Each mosaic is read once, at the largest requested preview scale, from its internal overviews when it
+# has them (GDAL picks the overview level matching the output size) or as a decimated nearest-neighbour
+# read otherwise. The smaller scales are resampled from that in-memory preview, so one pass writes every
+# scale. Outputs that are already up to date with their mosaic (by mtime, or by content hash) are skipped,
+# and whole project folders are processed in a process pool.
+
+# Default search criteria: keyword -> (file suffix, preview scale or tuple of scales)
+THUMBNAIL_SEARCH_CONFIG = {
+    "RGB": ("_transparent_mosaic_group1.tif", (0.05, 0.25)),
+    "NDVI": ("_index_ndvi.tif", 0.5),
+}
+
+# Up-to-date checks: "mtime" compares modification times, "hash" the SHA-256 of the mosaic content
+# (stored next to every output as "<output>.source.json")
+UP_TO_DATE_CHECKS = ("mtime", "hash")
+
+
+def thumbnail_file_name(file_path, scale_factor):
+    """Returns the file name of a preview, e.g. 'mosaic_25%.tif' for 'mosaic.tif' at 0.25."""
+    name, ext = os.path.splitext(os.path.basename(file_path))
+    return f"{name}_{round(scale_factor * 100):g}%{ext}"
+
+
+def _source_digest(file_path):
+    """Returns the SHA-256 hex digest of a file's content."""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _source_record_path(output_path):
+    return f"{output_path}.source.json"
+
+
+def is_thumbnail_up_to_date(file_path, output_path, check="mtime", source_digest=None):
+    """
+    Checks whether a preview is up to date with its mosaic.
+
+    Parameters:
+    - file_path (str): Mosaic path.
+    - output_path (str): Preview path.
+    - check (str): "mtime" (the preview is newer than the mosaic) or "hash" (the preview was made from a
+      mosaic with the same content, see write_thumbnails()).
+    - source_digest (str, optional): Precomputed digest of the mosaic for "hash".
+
+    Returns:
+    - bool: True if the preview exists and is up to date.
+    """
+    if check not in UP_TO_DATE_CHECKS:
+        raise ValueError(f"Unknown up-to-date check: {check}. Use one of {UP_TO_DATE_CHECKS}.")
+    if not os.path.exists(output_path):
+        return False
+    if check == "mtime":
+        return os.path.getmtime(output_path) >= os.path.getmtime(file_path)
+
+    try:
+        with open(_source_record_path(output_path)) as f:
+            record = json.load(f)
+    except (OSError, ValueError):
+        return False
+    return record.get("sha256") == (source_digest or _source_digest(file_path))
+
+
+def _preview_profile(profile, width, height, transform):
+    profile = profile.copy()
+    profile.update(width=width, height=height, transform=transform)
+    # Tiles larger than a small preview are not allowed by every driver
+    if profile.get("tiled") and (width < profile.get("blockxsize", 0) or height < profile.get("blockysize", 0)):
+        profile.update(tiled=False)
+        profile.pop("blockxsize", None)
+        profile.pop("blockysize", None)
+    return profile
+
+
+def _write_preview(output_path, profile, array):
+    """Writes a preview through a temporary file, so an interrupted run never leaves a partial preview."""
+    os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+    name, ext = os.path.splitext(output_path)
+    partial_path = f"{name}.partial{ext}"
+    with rasterio.open(partial_path, "w", **profile) as dst:
+        dst.write(array)
+    os.replace(partial_path, output_path)
+
+
+def write_thumbnails(file_path, output_paths, check="mtime", overwrite=False):
+    """
+    Writes downscaled previews of a mosaic at several scales in one pass.
+
+    Parameters:
+    - file_path (str): Mosaic path.
+    - output_paths (dict): {scale_factor: output path}, e.g. {0.05: 'thumb_5%.tif', 0.25: 'thumb_25%.tif'}.
+    - check (str): Up-to-date check of existing previews, see is_thumbnail_up_to_date().
+    - overwrite (bool): Rewrite the previews even if they are up to date.
+
+    Returns:
+    - dict: {scale_factor: output path}, including the previews that were already up to date.
+    """
+    source_digest = _source_digest(file_path) if check == "hash" else None
+    pending = {
+        scale: path for scale, path in output_paths.items()
+        if overwrite or not is_thumbnail_up_to_date(file_path, path, check, source_digest)
+    }
+    for scale in output_paths:
+        if scale not in pending:
+            print(f"⏩ Up to date: {os.path.basename(output_paths[scale])}")
+    if not pending:
+        return dict(output_paths)
+
+    scales = sorted(pending, reverse=True)
+    with rasterio.open(file_path) as src:
+        # Overviews are bilinear-resampled by GDAL; without them a nearest-neighbour read only decimates
+        resampling = Resampling.bilinear if src.overviews(1) else Resampling.nearest
+        print(f"\n⚙️ Processing: {os.path.basename(file_path)} at {', '.join(f'{int(s * 100)}%' for s in scales)} resolution "
+              f"({'overviews' if src.overviews(1) else 'decimated read'})")
+
+        source_width, source_height, source_transform = src.width, src.height, src.transform
+        largest_width = max(1, int(source_width * scales[0]))
+        largest_height = max(1, int(source_height * scales[0]))
+        largest = src.read(out_shape=(src.count, largest_height, largest_width), resampling=resampling)
+        largest_transform = source_transform * source_transform.scale(source_width / largest_width, source_height / largest_height)
+        profile = src.profile
+
+    _write_preview(pending[scales[0]], _preview_profile(profile, largest_width, largest_height, largest_transform), largest)
+
+    if len(scales) > 1:
+        # The smaller scales are resampled from the in-memory largest preview
+        memory_profile = {
+            "driver": "GTiff", "width": largest_width, "height": largest_height, "count": largest.shape[0],
+            "dtype": largest.dtype, "crs": profile.get("crs"), "transform": largest_transform, "nodata": profile.get("nodata"),
+        }
+        with MemoryFile() as memfile:
+            with memfile.open(**memory_profile) as mem:
+                mem.write(largest)
+            with memfile.open() as mem:
+                for scale in scales[1:]:
+                    width, height = max(1, int(source_width * scale)), max(1, int(source_height * scale))
+                    array = mem.read(out_shape=(mem.count, height, width), resampling=Resampling.bilinear)
+                    transform = source_transform * source_transform.scale(source_width / width, source_height / height)
+                    _write_preview(pending[scale], _preview_profile(profile, width, height, transform), array)
+
+    if check == "hash":
+        for path in pending.values():
+            with open(_source_record_path(path), "w") as f:
+                json.dump({"source": file_path, "sha256": source_digest}, f)
+
+    print(f"✅ Successfully downscaled: {os.path.basename(file_path)}")
+    return dict(output_paths)
+
+
+def find_orthomosaic_files(root_folder, search_config=THUMBNAIL_SEARCH_CONFIG):
+    """
+    Finds orthomosaic files of all projects based on a dictionary defining search criteria.
+
+    Parameters:
+    - root_folder (str): The directory containing the field_name project folders
+      (<field_name>/MS WORK STATION/<flight>/2_Orthomosaics/).
+    - search_config (dict): keyword -> (file suffix, scale or tuple of scales), see THUMBNAIL_SEARCH_CONFIG.
+
+    Returns:
+    - dict: {keyword: [list of matching file paths]}
+    """
+    matching_files = {key: [] for key in search_config}
+
+    for field_name in sorted(os.listdir(root_folder)):
+        ms_folder = os.path.join(root_folder, field_name, "MS WORK STATION")
+        if not os.path.isdir(ms_folder):
+            continue
+        for flight_folder in sorted(os.listdir(ms_folder)):
+            orthomosaic_folder = os.path.join(ms_folder, flight_folder, "2_Orthomosaics")
+            if not os.path.isdir(orthomosaic_folder):
+                continue
+            for file in sorted(os.listdir(orthomosaic_folder)):
+                for key_word, (suffix, _) in search_config.items():
+                    if file.endswith(suffix):
+                        matching_files[key_word].append(os.path.join(orthomosaic_folder, file))
+
+    return matching_files
+
+
+def _thumbnail_job(job):
+    """Process pool task: writes the previews of one mosaic; errors are reported, not raised."""
+    file_path, output_paths, check, overwrite = job
+    try:
+        return file_path, write_thumbnails(file_path, output_paths, check=check, overwrite=overwrite)
+    except Exception as e:
+        print(f"❌ ERROR processing {file_path}: {str(e)}")
+        return file_path, None
+
+
+def run_thumbnail_service(root_folder, output_folder, search_config=THUMBNAIL_SEARCH_CONFIG, max_workers=None, check="mtime", overwrite=False):
+    """
+    Writes the previews of every orthomosaic of every project, one mosaic per process pool task.
+
+    Previews are stored as <output_folder>/<field_name>/<keyword>/<mosaic name>_<percent>%<ext>.
+
+    Parameters:
+    - root_folder (str): The directory containing the field_name project folders.
+    - output_folder (str): Base output directory.
+    - search_config (dict): keyword -> (file suffix, scale or tuple of scales), see THUMBNAIL_SEARCH_CONFIG.
+    - max_workers (int, optional): Number of worker processes (default: number of CPUs).
+    - check (str): Up-to-date check, "mtime" or "hash" (see is_thumbnail_up_to_date()).
+    - overwrite (bool): Rewrite previews even if they are up to date.
+
+    Returns:
+    - dict: {mosaic path: {scale: preview path}, or None if it failed}.
+    """
+    if check not in UP_TO_DATE_CHECKS:
+        raise ValueError(f"Unknown up-to-date check: {check}. Use one of {UP_TO_DATE_CHECKS}.")
+
+    jobs = []
+    for key_word, file_list in find_orthomosaic_files(root_folder, search_config).items():
+        scales = search_config[key_word][1]
+        scales = scales if isinstance(scales, (tuple, list)) else (scales,)
+        for file_path in file_list:
+            field_name = os.path.relpath(file_path, root_folder).split(os.sep)[0]
+            final_output_folder = os.path.join(output_folder, field_name, key_word)
+            jobs.append((file_path, {scale: os.path.join(final_output_folder, thumbnail_file_name(file_path, scale)) for scale in scales}, check, overwrite))
+
+    print(f"🔍 Found {len(jobs)} orthomosaics")
+    results = {}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        for file_path, outputs in executor.map(_thumbnail_job, jobs):
+            results[file_path] = outputs
+    return results
+
+
+if __name__ == "__main__":
+    # Example Usage
+    root_folder = r"D:\PhenoCrop\2_pix4d"  # Change to your actual root folder
+    output_folder = r"D:\PhenoCrop\2_2_Orthomosaics_resized"  # Base output directory
+
+    run_thumbnail_service(root_folder, output_folder, THUMBNAIL_SEARCH_CONFIG, max_workers=4, check="mtime")
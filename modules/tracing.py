@@ -0,0 +1,292 @@
+import os
+import re
+import json
+import time
+import threading
+import functools
+from datetime import datetime
+
+# Lightweight tracing of the processing pipeline.
+# Spans (timed blocks and functions) and counters are aggregated in memory per process: every span name
+# keeps its call count, total, min and max duration. Nothing is printed per call. At the end of a run the
+# aggregates are exported as JSON and as a Prometheus text file (for the node_exporter textfile collector).
+# Tracing is disabled by default; disabled spans, counters and traced functions cost one flag check.
+
+# Environment variable enabling tracing (inherited by worker processes)
+TRACING_ENV_VAR = "UAV_TRACING"
+
+# Prefix of the exported Prometheus metric names
+METRIC_PREFIX = "uav"
+
+_enabled = os.environ.get(TRACING_ENV_VAR, "") == "1"
+_lock = threading.Lock()
+_timers = {}  # (name, labels) -> [count, total seconds, min seconds, max seconds]
+_counters = {}  # (name, labels) -> value
+_run_started = datetime.now()
+
+
+def enable_tracing(enabled=True):
+    """
+    Turns tracing on or off for this process and the worker processes it starts afterwards.
+
+    Parameters:
+    - enabled (bool): True to record spans and counters.
+    """
+    global _enabled
+    _enabled = enabled
+    os.environ[TRACING_ENV_VAR] = "1" if enabled else "0"
+
+
+def tracing_enabled():
+    """Returns True if spans and counters are being recorded."""
+    return _enabled
+
+
+def _key(name, labels):
+    return name, tuple(sorted((label, str(value)) for label, value in labels.items()))
+
+
+def observe(name, seconds, **labels):
+    """
+    Records one duration of a timer.
+
+    Parameters:
+    - name (str): Timer (span) name.
+    - seconds (float): Duration.
+    - labels: Optional labels, e.g. flight="...", exported as Prometheus labels.
+    """
+    if not _enabled:
+        return
+    key = _key(name, labels)
+    with _lock:
+        timer = _timers.get(key)
+        if timer is None:
+            _timers[key] = [1, seconds, seconds, seconds]
+        else:
+            timer[0] += 1
+            timer[1] += seconds
+            timer[2] = min(timer[2], seconds)
+            timer[3] = max(timer[3], seconds)
+
+
+def count(name, value=1, **labels):
+    """
+    Adds value to a counter.
+
+    Parameters:
+    - name (str): Counter name, e.g. "bytes_copied".
+    - value (int or float): Increment.
+    - labels: Optional labels.
+    """
+    if not _enabled:
+        return
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+class _Span:
+    __slots__ = ("name", "labels", "start")
+
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        observe(self.name, time.perf_counter() - self.start, **self.labels)
+        if exc_type is not None:
+            count(f"{self.name}_errors", **self.labels)
+        return False
+
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+def span(name, **labels):
+    """
+    Times a block: `with span("copy_file"): ...`. Exceptions are counted as "<name>_errors".
+
+    Parameters:
+    - name (str): Span name.
+    - labels: Optional labels.
+
+    Returns:
+    - A context manager (a shared no-op one while tracing is disabled).
+    """
+    if not _enabled:
+        return _NOOP_SPAN
+    return _Span(name, labels)
+
+
+def traced(func):
+    """Decorator timing every call of a function as a span named after the function."""
+    name = func.__name__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not _enabled:
+            return func(*args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            observe(name, time.perf_counter() - start)
+    return wrapper
+
+
+def tracing_snapshot():
+    """
+    Returns the aggregates recorded so far.
+
+    Returns:
+    - dict: {"spans": [{name, labels, count, total_seconds, min_seconds, max_seconds, mean_seconds}],
+      "counters": [{name, labels, value}]}, sorted by name.
+    """
+    with _lock:
+        timers = sorted(_timers.items())
+        counters = sorted(_counters.items())
+    return {
+        "spans": [
+            {"name": name, "labels": dict(labels), "count": n, "total_seconds": total, "min_seconds": low,
+             "max_seconds": high, "mean_seconds": total / n}
+            for (name, labels), (n, total, low, high) in timers
+        ],
+        "counters": [{"name": name, "labels": dict(labels), "value": value} for (name, labels), value in counters],
+    }
+
+
+def merge_tracing(snapshot):
+    """
+    Adds the aggregates of another process (a tracing_snapshot()) to this process.
+
+    Parameters:
+    - snapshot (dict): Output of tracing_snapshot(), e.g. returned by a process pool worker.
+    """
+    if not snapshot:
+        return
+    with _lock:
+        for entry in snapshot["spans"]:
+            key = _key(entry["name"], entry["labels"])
+            timer = _timers.get(key)
+            if timer is None:
+                _timers[key] = [entry["count"], entry["total_seconds"], entry["min_seconds"], entry["max_seconds"]]
+            else:
+                timer[0] += entry["count"]
+                timer[1] += entry["total_seconds"]
+                timer[2] = min(timer[2], entry["min_seconds"])
+                timer[3] = max(timer[3], entry["max_seconds"])
+        for entry in snapshot["counters"]:
+            key = _key(entry["name"], entry["labels"])
+            _counters[key] = _counters.get(key, 0) + entry["value"]
+
+
+def reset_tracing():
+    """Clears the aggregates and starts a new run."""
+    global _run_started
+    with _lock:
+        _timers.clear()
+        _counters.clear()
+        _run_started = datetime.now()
+
+
+def _metric_name(name):
+    return f"{METRIC_PREFIX}_{re.sub(r'[^a-zA-Z0-9_]', '_', name)}"
+
+
+def _label_text(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for value in labels.values())
+    return "{" + ",".join(f'{re.sub(r"[^a-zA-Z0-9_]", "_", label)}="{value}"' for label, value in zip(labels, escaped)) + "}"
+
+
+def prometheus_text(snapshot=None):
+    """
+    Formats aggregates in the Prometheus text exposition format.
+
+    Spans become uav_span_seconds_count / _sum / _max with a span label, counters uav_<name>_total.
+
+    Parameters:
+    - snapshot (dict, optional): Output of tracing_snapshot(); default: the current aggregates.
+
+    Returns:
+    - str: Metrics text.
+    """
+    snapshot = snapshot or tracing_snapshot()
+    span_metric = _metric_name("span_seconds")
+    lines = []
+    if snapshot["spans"]:
+        lines.append(f"# HELP {span_metric} Time spent in each traced span.")
+        lines.append(f"# TYPE {span_metric} summary")
+        for entry in snapshot["spans"]:
+            labels = _label_text({"span": entry["name"], **entry["labels"]})
+            lines.append(f"{span_metric}_count{labels} {entry['count']}")
+            lines.append(f"{span_metric}_sum{labels} {entry['total_seconds']!r}")
+        lines.append(f"# TYPE {span_metric}_max gauge")
+        for entry in snapshot["spans"]:
+            lines.append(f"{span_metric}_max{_label_text({'span': entry['name'], **entry['labels']})} {entry['max_seconds']!r}")
+
+    typed = set()
+    for entry in snapshot["counters"]:
+        metric = f"{_metric_name(entry['name'])}_total"
+        if metric not in typed:
+            lines.append(f"# TYPE {metric} counter")
+            typed.add(metric)
+        lines.append(f"{metric}{_label_text(entry['labels'])} {entry['value']!r}")
+    return "\n".join(lines) + "\n"
+
+
+def _write_text_atomically(path, text):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    partial_path = f"{path}.{os.getpid()}.partial"
+    with open(partial_path, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(partial_path, path)
+
+
+def export_run(output_folder, run_name):
+    """
+    Writes the aggregates of this run to <output_folder>/<run_name>_metrics.json and <run_name>_metrics.prom.
+
+    Parameters:
+    - output_folder (str): Folder of the metric files.
+    - run_name (str): Run name, e.g. "extraction_20250612_1030".
+
+    Returns:
+    - tuple: (JSON path, Prometheus text path).
+    """
+    snapshot = tracing_snapshot()
+    json_path = os.path.join(output_folder, f"{run_name}_metrics.json")
+    prometheus_path = os.path.join(output_folder, f"{run_name}_metrics.prom")
+    _write_text_atomically(json_path, json.dumps({
+        "run": run_name,
+        "started": _run_started.isoformat(timespec="seconds"),
+        "exported": datetime.now().isoformat(timespec="seconds"),
+        **snapshot,
+    }, indent=2))
+    _write_text_atomically(prometheus_path, prometheus_text(snapshot))
+    return json_path, prometheus_path
+
+
+def tracing_summary(top=15):
+    """Returns the spans with the largest total time as printable lines."""
+    spans = sorted(tracing_snapshot()["spans"], key=lambda entry: entry["total_seconds"], reverse=True)[:top]
+    return [
+        f"⏳ {entry['name']}: {entry['total_seconds']:.3f} s in {entry['count']} calls "
+        f"(mean {entry['mean_seconds'] * 1000:.2f} ms, max {entry['max_seconds'] * 1000:.2f} ms)"
+        for entry in spans
+    ]
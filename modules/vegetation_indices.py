@@ -0,0 +1,153 @@
+import ast
+import numpy as np
+
+# Vegetation-index expression engine.
+# Indices are written as band formulas (e.g. "(nir - red) / (nir + red)"), compiled once, and evaluated
+# in float32 on whatever window or pixel vector the extraction engine already holds, right before the
+# statistics pass. No full-size index raster is materialized, and divisions by zero give NaN without
+# evaluating the division there.
+
+# Band names that may appear in a formula
+INDEX_BANDS = ("red", "green", "nir", "rededge", "blue")
+
+# Built-in indices
+INDEX_FORMULAS = {
+    "NDVI": "(nir - red) / (nir + red)",
+    "NDRE": "(nir - rededge) / (nir + rededge)",
+    "GNDVI": "(nir - green) / (nir + green)",
+    "OSAVI": "(nir - red) / (nir + red + 0.16)",
+}
+
+_BINARY_OPERATORS = {
+    ast.Add: np.add,
+    ast.Sub: np.subtract,
+    ast.Mult: np.multiply,
+    ast.Pow: np.power,
+}
+
+_FUNCTIONS = {
+    "sqrt": np.sqrt,
+    "abs": np.abs,
+    "log": np.log,
+    "exp": np.exp,
+}
+
+
+def _validate(node):
+    """Checks that a parsed formula only uses band names, numbers, + - * / ** and the whitelisted functions."""
+    if isinstance(node, ast.Expression):
+        _validate(node.body)
+    elif isinstance(node, ast.BinOp):
+        if not isinstance(node.op, (ast.Div, *_BINARY_OPERATORS)):
+            raise ValueError(f"Unsupported operator: {type(node.op).__name__}")
+        _validate(node.left)
+        _validate(node.right)
+    elif isinstance(node, ast.UnaryOp):
+        if not isinstance(node.op, (ast.USub, ast.UAdd)):
+            raise ValueError(f"Unsupported operator: {type(node.op).__name__}")
+        _validate(node.operand)
+    elif isinstance(node, ast.Call):
+        if not isinstance(node.func, ast.Name) or node.func.id not in _FUNCTIONS or len(node.args) != 1 or node.keywords:
+            raise ValueError(f"Unsupported function call; allowed: {', '.join(_FUNCTIONS)} with one argument")
+        _validate(node.args[0])
+    elif isinstance(node, ast.Name):
+        if node.id not in INDEX_BANDS:
+            raise ValueError(f"Unknown band '{node.id}'; allowed: {', '.join(INDEX_BANDS)}")
+    elif isinstance(node, ast.Constant):
+        if not isinstance(node.value, (int, float)) or isinstance(node.value, bool):
+            raise ValueError(f"Unsupported constant: {node.value!r}")
+    else:
+        raise ValueError(f"Unsupported expression element: {type(node).__name__}")
+
+
+def compile_index(formula):
+    """
+    Parses and validates a band formula.
+
+    Parameters:
+    - formula (str): Expression over the bands red, green, nir, rededge and blue, using numbers,
+      + - * / ** and sqrt(), abs(), log(), exp().
+
+    Returns:
+    - dict: {"formula": str, "tree": ast.Expression, "bands": tuple of band names used}.
+    """
+    try:
+        tree = ast.parse(formula, mode="eval")
+    except SyntaxError as e:
+        raise ValueError(f"Invalid index formula '{formula}': {e}") from e
+
+    _validate(tree)
+    bands = tuple(band for band in INDEX_BANDS if any(isinstance(node, ast.Name) and node.id == band for node in ast.walk(tree)))
+    return {"formula": formula, "tree": tree, "bands": bands}
+
+
+def resolve_indices(indices):
+    """
+    Compiles the requested indices.
+
+    Parameters:
+    - indices (list or dict): Built-in index names (e.g. ["NDVI", "NDRE"]), or a dict of
+      {name: formula} where a formula of None selects the built-in index of that name.
+
+    Returns:
+    - dict: {name: compiled index from compile_index()}, in the requested order.
+    """
+    if isinstance(indices, str):
+        indices = [indices]
+    if not isinstance(indices, dict):
+        indices = {name: None for name in indices}
+
+    compiled = {}
+    for name, formula in indices.items():
+        if formula is None:
+            if name not in INDEX_FORMULAS:
+                raise ValueError(f"Unknown index '{name}'; built-in indices: {', '.join(INDEX_FORMULAS)}")
+            formula = INDEX_FORMULAS[name]
+        compiled[name] = compile_index(formula)
+    return compiled
+
+
+def required_bands(compiled_indices):
+    """Returns the band names needed by a set of compiled indices."""
+    return [band for band in INDEX_BANDS if any(band in index["bands"] for index in compiled_indices.values())]
+
+
+def _evaluate(node, band_values):
+    if isinstance(node, ast.Expression):
+        return _evaluate(node.body, band_values)
+    if isinstance(node, ast.Name):
+        return band_values[node.id]
+    if isinstance(node, ast.Constant):
+        return np.float32(node.value)
+    if isinstance(node, ast.UnaryOp):
+        operand = _evaluate(node.operand, band_values)
+        return -operand if isinstance(node.op, ast.USub) else operand
+    if isinstance(node, ast.Call):
+        return _FUNCTIONS[node.func.id](_evaluate(node.args[0], band_values))
+
+    left = _evaluate(node.left, band_values)
+    right = _evaluate(node.right, band_values)
+    if isinstance(node.op, ast.Div):
+        # The division is only evaluated where the denominator is non-zero
+        left, right = np.broadcast_arrays(left, right)
+        out = np.full(left.shape, np.nan, dtype=np.float32)
+        return np.divide(left, right, out=out, where=right != 0)
+    return _BINARY_OPERATORS[type(node.op)](left, right)
+
+
+def evaluate_index(compiled_index, band_values):
+    """
+    Evaluates a compiled index in float32.
+
+    Parameters:
+    - compiled_index (dict): Output of compile_index().
+    - band_values (dict): {band: array} for the bands of the index, all of the same shape
+      (a window on a common grid, or the pixel values of the plots).
+
+    Returns:
+    - np.ndarray: float32 index values; NaN where a denominator is zero.
+    """
+    values = {band: np.asarray(band_values[band], dtype=np.float32) for band in compiled_index["bands"]}
+    with np.errstate(invalid="ignore", over="ignore", divide="ignore"):
+        result = _evaluate(compiled_index["tree"], values)
+    return np.asarray(result, dtype=np.float32)